@@ -0,0 +1,37 @@
+"""add file progress
+
+Revision ID: 5d2e8c41a7f3
+Revises: abf6ab1b16d2
+Create Date: 2026-10-18 10:12:41.207316
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d2e8c41a7f3'
+down_revision: Union[str, Sequence[str], None] = 'abf6ab1b16d2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('files', sa.Column('chunk_total', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('files', sa.Column('chunk_done', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('files', sa.Column('error_msg', sqlmodel.sql.sqltypes.AutoString(length=1024), nullable=True))
+    op.add_column('files', sa.Column('process_start_at', sa.DateTime(), nullable=True))
+    op.add_column('files', sa.Column('status_update_at', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('files', 'status_update_at')
+    op.drop_column('files', 'process_start_at')
+    op.drop_column('files', 'error_msg')
+    op.drop_column('files', 'chunk_done')
+    op.drop_column('files', 'chunk_total')
@@ -0,0 +1,39 @@
+"""reingest legacy files
+
+Revision ID: 7c3a9d15e2b8
+Revises: f4b81d2e7a63
+Create Date: 2026-10-20 09:41:17.503862
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c3a9d15e2b8'
+down_revision: Union[str, Sequence[str], None] = 'f4b81d2e7a63'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 旧版本的向量都保存在全局 collection 中，按 title 检索时查不到，没有开始时间的文件都是旧版本入库的，
+    # 删除旧的段落记录并重置为待处理，启动时重新入库到 title 对应的 collection，旧的全局 collection 在启动时删除
+    op.execute(
+        "DELETE FROM \"document_chunks\" WHERE document_id IN "
+        "(SELECT id FROM \"files\" WHERE process_start_at IS NULL)"
+    )
+    op.execute(
+        "UPDATE \"files\" SET status = 'LOADED', chunk_total = 0, chunk_done = 0, error_msg = NULL "
+        "WHERE process_start_at IS NULL AND status <> 'LOADING'"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # 删除的段落记录无法恢复，降级后需要重新上传
+    pass
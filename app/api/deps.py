@@ -1,16 +1,21 @@
 import uuid
-from typing import Generator, Annotated
+from dataclasses import dataclass
+from typing import Any, Generator, Annotated, AsyncGenerator, Optional, Tuple
 
 import jwt
 from fastapi import Depends, HTTPException, status, Path
 from fastapi.security import OAuth2PasswordBearer
 from pydantic import PostgresDsn
 from pydantic_core import MultiHostUrl
-from sqlalchemy import create_engine
-from sqlmodel import Session, select
+from sqlalchemy import create_engine, and_, select as sa_select
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import Session
+from starlette.requests import Request
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.db_model import User, TokenPayload, Title, File
 from app.security import ALGORITHM
+from app.service.principal_cache import global_principal_cache
 from app.settings import settings
 
 
@@ -28,7 +33,19 @@ def get_db_url() -> PostgresDsn:
     return result
 
 
-engine = create_engine(str(get_db_url()))
+def get_engine_options() -> dict:
+    return {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_pre_ping": True,
+    }
+
+
+engine = create_engine(str(get_db_url()), **get_engine_options())
+# 异步引擎，psycopg3 同时支持同步和异步，async 路由中使用，避免数据库 I/O 阻塞事件循环
+async_engine = create_async_engine(str(get_db_url()), **get_engine_options())
 
 
 def get_db() -> Generator[Session, None, None]:
@@ -36,74 +53,229 @@ def get_db() -> Generator[Session, None, None]:
         yield session
 
 
+async def get_async_db() -> AsyncGenerator[AsyncSession, None]:
+    # commit 后不过期对象，避免访问属性时触发隐式的异步加载
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
+
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/login/token")
 
 SessionDep = Annotated[Session, Depends(get_db)]
+AsyncSessionDep = Annotated[AsyncSession, Depends(get_async_db)]
 TokenDep = Annotated[str, Depends(oauth2_scheme)]
 
 
-def get_current_user(session: SessionDep, token: TokenDep) -> User:
+@dataclass
+class Principal:
     """
-    通过token获取当前用户，token由{"exp": 截止时间戳, "sub": str(user.id)} 生成
-    :param session:
+    当前请求的用户，以及路径中 title_id、file_id 对应的 title 和文件（属于该用户时）
+    """
+    user: User
+    title: Optional[Title] = None
+    file: Optional[File] = None
+
+
+def decode_token(token: str) -> Tuple[uuid.UUID, Optional[float]]:
+    """
+    解码 token，token由{"exp": 截止时间戳, "sub": str(user.id)} 生成
     :param token:
-    :return:
+    :return: (用户id, 过期时间戳)
     """
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[ALGORITHM])
-        print(f'payload: {payload}')
         token_data = TokenPayload(**payload)
-        print(f'token_data: {token_data}')
+        return uuid.UUID(token_data.sub), payload.get("exp", None)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid token")
-    # token_data.sub 的值是user.id
-    user = session.get(User, token_data.sub)
-    print(f'type user is {type(user)}')
-    if not user:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-    return user
 
 
-CurrentUser = Annotated[User, Depends(get_current_user)]
+def get_path_uuid(request: Request, name: str) -> Optional[uuid.UUID]:
+    value = request.path_params.get(name, None)
+    if value is None:
+        return None
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"Invalid {name}")
+
+
+@dataclass
+class PrincipalQuery:
+    """
+    认证查询：缓存命中时 cached_user 为用户快照，statement 只查询 title 和文件；
+    未命中时 statement 同时查询用户。statement 为 None 时不需要查询数据库
+    """
+    token: str
+    title_id: Optional[uuid.UUID]
+    file_id: Optional[uuid.UUID]
+    cached_user: Optional[User] = None
+    token_expires_at: Optional[float] = None
+    statement: Any = None
 
 
-def get_current_title(session: SessionDep, current_user: CurrentUser, title_id: uuid.UUID = Path(...)) -> Title:
+def build_principal_query(request: Request, token: str) -> PrincipalQuery:
     """
-    通过title_id获取当前title，title_id由uuid生成
+    生成一次查询当前用户、title 和文件的语句，同步和异步的认证依赖共用
+    :param request:
+    :param token:
+    :return:
+    """
+    title_id = get_path_uuid(request, "title_id")
+    file_id = get_path_uuid(request, "file_id") if title_id is not None else None
+    query = PrincipalQuery(token=token, title_id=title_id, file_id=file_id)
+
+    query.cached_user = global_principal_cache.get(token)
+    if query.cached_user is not None:
+        if title_id is None:
+            return query
+        statement = sa_select(Title).where(Title.id == title_id, Title.user_id == query.cached_user.id)
+    else:
+        user_id, query.token_expires_at = decode_token(token)
+        statement = sa_select(User).where(User.id == user_id)
+        if title_id is not None:
+            statement = statement.add_columns(Title).outerjoin(
+                Title, and_(Title.user_id == User.id, Title.id == title_id))
+
+    if file_id is not None:
+        statement = statement.add_columns(File).outerjoin(
+            File, and_(File.title_id == Title.id, File.id == file_id))
+    query.statement = statement
+    return query
+
+
+def to_principal(query: PrincipalQuery, user: Optional[User], row: Any) -> Principal:
+    """
+    查询结果转换为 Principal，未命中缓存时缓存查询到的用户
+    :param query:
+    :param user: 缓存命中时合并到当前 session 的用户
+    :param row: 查询结果，不需要查询时为 None
+    :return:
+    """
+    if query.cached_user is None:
+        if row is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+        user, row = row[0], row[1:]
+        global_principal_cache.put(query.token, user, query.token_expires_at)
+    row = tuple(row) if row is not None else (None, None)
+    title = row[0] if len(row) > 0 else None
+    file = row[1] if len(row) > 1 else None
+    return Principal(user=user, title=title, file=file)
+
+
+def get_principal(request: Request, session: SessionDep, token: TokenDep) -> Principal:
+    """
+    一次查询得到当前用户、title 和文件，并检查 title 属于该用户、文件属于该 title。
+    同一请求中 CurrentUser、CurrentTitle、CurrentFile 共用结果；已验证的用户在短时间内缓存，命中时只查询 title 和文件
+    :param request:
+    :param session:
+    :param token:
+    :return:
+    """
+    query = build_principal_query(request, token)
+    # 快照不访问数据库，merge 得到属于当前 session 的对象，路由中可以修改
+    user = session.merge(query.cached_user, load=False) if query.cached_user is not None else None
+    row = session.execute(query.statement).first() if query.statement is not None else None
+    return to_principal(query, user, row)
+
+
+async def get_async_principal(request: Request, session: AsyncSessionDep, token: TokenDep) -> Principal:
+    """
+    async 路由使用的 get_principal，和路由共用同一个异步 session，一个请求只占用一个数据库连接
+    :param request:
     :param session:
+    :param token:
+    :return:
+    """
+    query = build_principal_query(request, token)
+    user = await session.merge(query.cached_user, load=False) if query.cached_user is not None else None
+    row = (await session.execute(query.statement)).first() if query.statement is not None else None
+    return to_principal(query, user, row)
+
+
+PrincipalDep = Annotated[Principal, Depends(get_principal)]
+AsyncPrincipalDep = Annotated[Principal, Depends(get_async_principal)]
+
+
+def principal_title(principal: Principal) -> Title:
+    if principal.title is None:
+        raise HTTPException(status_code=404, detail="Title not found")
+    return principal.title
+
+
+def principal_file(principal: Principal) -> File:
+    if principal.file is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return principal.file
+
+
+def get_current_user(principal: PrincipalDep) -> User:
+    """
+    获取当前用户
+    :param principal:
+    :return:
+    """
+    return principal.user
+
+
+CurrentUser = Annotated[User, Depends(get_current_user)]
+
+
+def get_current_superuser(current_user: CurrentUser) -> User:
+    """
+    获取当前用户，不是超级用户时返回 403，用于运维接口
     :param current_user:
+    :return:
+    """
+    if not current_user.is_superuser:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="The user doesn't have enough privileges")
+    return current_user
+
+
+def get_current_title(principal: PrincipalDep, title_id: uuid.UUID = Path(...)) -> Title:
+    """
+    获取当前title，title_id由uuid生成
+    :param principal:
     :param title_id: Path表示参数在请求路径中，...表示必传
     :return:
     """
-    statement = select(Title).where(
-        Title.user_id == current_user.id,
-        Title.id == title_id
-    )
-    title = session.exec(statement).first()
-    if not title:
-        raise HTTPException(status_code=404, detail="Title not found")
-    return title
+    return principal_title(principal)
 
 
 CurrentTitle = Annotated[Title, Depends(get_current_title)]
 
 
-def get_current_file(session: SessionDep, current_title: CurrentTitle, file_id: uuid.UUID = Path(...)) -> File:
+def get_current_file(principal: PrincipalDep, current_title: CurrentTitle, file_id: uuid.UUID = Path(...)) -> File:
     """
-    通过file_id获取当前file，file_id由uuid生成
-    :param session:
+    获取当前file，file_id由uuid生成
+    :param principal:
     :param current_title:
     :param file_id: Path表示参数在请求路径中，...表示必传
     :return:
     """
-    statement = select(File).where(
-        File.title_id == current_title.id,
-        File.id == file_id
-    )
-    file = session.exec(statement).first()
-    if not file:
-        raise HTTPException(status_code=404, detail="File not found")
-    return file
+    return principal_file(principal)
 
 
 CurrentFile = Annotated[File, Depends(get_current_file)]
+
+
+async def get_async_current_user(principal: AsyncPrincipalDep) -> User:
+    return principal.user
+
+
+AsyncCurrentUser = Annotated[User, Depends(get_async_current_user)]
+
+
+async def get_async_current_title(principal: AsyncPrincipalDep, title_id: uuid.UUID = Path(...)) -> Title:
+    return principal_title(principal)
+
+
+AsyncCurrentTitle = Annotated[Title, Depends(get_async_current_title)]
+
+
+async def get_async_current_file(principal: AsyncPrincipalDep, current_title: AsyncCurrentTitle,
+                                 file_id: uuid.UUID = Path(...)) -> File:
+    return principal_file(principal)
+
+
+AsyncCurrentFile = Annotated[File, Depends(get_async_current_file)]
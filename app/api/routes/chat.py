@@ -1,35 +1,56 @@
+import time
 import uuid
 
-from app.api.deps import SessionDep, CurrentUser, CurrentTitle
+from app.api.deps import AsyncCurrentUser, AsyncCurrentTitle
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.background import BackgroundTask
 from starlette.responses import StreamingResponse
 from fastapi import APIRouter
 
 from app.retriever.query_answers import global_query_answers_cache, QueryAnswers
+from app.service.chat_stream import sse_event_stream
+from app.service.scheduler import chat_scheduler, RateLimitExceeded
 from app.utils.user_base_model import BaseResponse
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 
 
-def get_query_answers(current_user: CurrentUser, current_title: CurrentTitle):
+def get_query_answers(current_user: AsyncCurrentUser, current_title: AsyncCurrentTitle):
     """
     获取查询对象
     :param current_title:
     :param current_user:
     :return:
     """
-    user_id = current_user.id
-    if user_id in global_query_answers_cache:
-        query_answers = global_query_answers_cache[user_id]
-        query_answers.reload_if_needed()
-    else:
-        query_answers = QueryAnswers(user_id=user_id, title_id=current_title.id)
+    # 切换 title 或修改配置后，对应不同的缓存对象
+    cache_key = (current_user.id, current_title.id, current_user.cur_llm_config_id, current_title.load_config_id)
+    query_answers = global_query_answers_cache.get(cache_key, None)
+    if query_answers is None or query_answers.is_stale():
+        # 版本变化时创建新的对象替换缓存，正在使用旧对象的请求继续使用旧的检索链
+        query_answers = QueryAnswers(user_id=current_user.id, title_id=current_title.id,
+                                     llm_config_id=current_user.cur_llm_config_id,
+                                     load_config_id=current_title.load_config_id)
         query_answers.load()
-        global_query_answers_cache[user_id] = query_answers
+        global_query_answers_cache.put(cache_key, query_answers)
     return query_answers
 
 
+def acquire_chat_slot(user_id: uuid.UUID, title_id: uuid.UUID):
+    """
+    按用户、title 限制请求速率和并发数，超出时返回 429 和 Retry-After
+    :param user_id:
+    :param title_id:
+    :return:
+    """
+    try:
+        chat_scheduler.acquire(user_id, title_id)
+    except RateLimitExceeded as e:
+        raise e.to_http_exception()
+
+
 @router.get("/once/{title_id}/{question}", response_model=BaseResponse)
-async def query(current_user: CurrentUser, current_title: CurrentTitle, question: str):
+async def query(current_user: AsyncCurrentUser, current_title: AsyncCurrentTitle, question: str):
     """
     提问
     :param current_title:
@@ -38,20 +59,58 @@ async def query(current_user: CurrentUser, current_title: CurrentTitle, question
     :return:
     """
     response_model = BaseResponse(code="000000", msg="success")
-    query_answers = get_query_answers(current_user=current_user, current_title=current_title)
-    response_model.msg = await query_answers.query(question)
+    acquire_chat_slot(current_user.id, current_title.id)
+    try:
+        # 创建查询对象时会读取数据库，放到线程池中执行，避免阻塞事件循环
+        query_answers = await run_in_threadpool(get_query_answers, current_user=current_user,
+                                                current_title=current_title)
+        response_model.msg = await query_answers.query(question)
+    finally:
+        chat_scheduler.release(current_user.id)
     return response_model
 
 
 @router.get("/stream/{title_id}/{question}")
-async def query_stream(current_user: CurrentUser, current_title: CurrentTitle, question: str):
+async def query_stream(request: Request, current_user: AsyncCurrentUser, current_title: AsyncCurrentTitle, question: str):
     """
-    提问，流式回答
+    提问，流式回答。客户端断开时取消生成
+    :param request:
     :param current_title:
     :param current_user:
     :param question:
     :return: StreamingResponse
     """
-    query_answers = get_query_answers(current_user=current_user, current_title=current_title)
+    started_at = time.monotonic()
+    acquire_chat_slot(current_user.id, current_title.id)
+    released = False
+
+    def release_slot():
+        # 生成器结束和响应结束时都会调用，只释放一次
+        nonlocal released
+        if not released:
+            released = True
+            chat_scheduler.release(current_user.id)
+
+    try:
+        query_answers = await run_in_threadpool(get_query_answers, current_user=current_user,
+                                                current_title=current_title)
+    except BaseException:
+        release_slot()
+        raise
+
+    async def release_after_stream():
+        # 流式回答结束或客户端断开后释放并发名额
+        try:
+            async for event in sse_event_stream(request, query_answers.stream_tokens(question), started_at):
+                yield event
+        finally:
+            release_slot()
 
-    return StreamingResponse(query_answers.event_generator(question), media_type="text/event-stream")
+    return StreamingResponse(
+        release_after_stream(),
+        media_type="text/event-stream",
+        # 关闭 nginx 缓冲，token 及时发送到客户端
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # 客户端在开始迭代前断开时生成器不会执行，由响应结束后的后台任务释放
+        background=BackgroundTask(release_slot)
+    )
@@ -1,18 +1,20 @@
+import asyncio
 import uuid
 
-from app.api.deps import SessionDep, CurrentUser
+from app.api.deps import AsyncSessionDep, AsyncCurrentUser
 from fastapi import APIRouter, HTTPException
 from app.api.routes.info import SUPPER_USER_ID
 from app.db_model import QueryConfigCreate, LoadConfigCreate, LoadConfigUserUpdate, LoadConfigBase
-from app.db_option import upload_query_config, get_query_config_by_id, get_all_query_config_by_user_id, \
-    create_load_config, get_load_config_by_id, get_all_load_config_by_user_id
+from app.db_option import aupload_query_config, aget_query_config_by_id, aget_all_query_config_by_user_id, \
+    acreate_load_config, aget_load_config_by_id, aget_all_load_config_by_user_id, aget_title_ids_by_load_config_id
+from app.service.title_version import title_version_registry, EVENT_QUERY_CONFIG, EVENT_LOAD_CONFIG
 from app.utils.user_base_model import TaskConfig, LLmConfig
 
 router = APIRouter(prefix="/configure", tags=["configure"])
 
 
 @router.post("/query/upload")
-async def send_config(session: SessionDep, current_user: CurrentUser, config: LLmConfig):
+async def send_config(session: AsyncSessionDep, current_user: AsyncCurrentUser, config: LLmConfig):
     """
     发送配置信息
     :param current_user:
@@ -20,12 +22,12 @@ async def send_config(session: SessionDep, current_user: CurrentUser, config: LL
     :param config:
     :return:
     """
-    query_llm_config = upload_query_config(session=session, user_id=current_user.id, query_config=config)
+    query_llm_config = await aupload_query_config(session=session, user_id=current_user.id, query_config=config)
     return query_llm_config
 
 
 @router.delete("/query/delete/{query_config_id}")
-async def delete_query(session: SessionDep, current_user: CurrentUser, query_config_id: uuid.UUID):
+async def delete_query(session: AsyncSessionDep, current_user: AsyncCurrentUser, query_config_id: uuid.UUID):
     """
     删除查询
     :param query_config_id:
@@ -34,30 +36,35 @@ async def delete_query(session: SessionDep, current_user: CurrentUser, query_con
     :return:
     """
     try:
-        query_config = get_query_config_by_id(session=session, user_id=current_user.id, query_config_id=query_config_id)
+        query_config = await aget_query_config_by_id(session=session, user_id=current_user.id,
+                                                     query_config_id=query_config_id)
         if query_config is None:
             raise HTTPException(status_code=404, detail="query_config not found")
-        session.delete(query_config)
-        session.commit()
+        await session.delete(query_config)
+        await session.commit()
+    except HTTPException:
+        raise
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         raise HTTPException(status_code=400, detail=str(e))
+    # 各 worker 淘汰使用该配置的大模型和查询对象
+    await asyncio.to_thread(title_version_registry.publish_config_change, EVENT_QUERY_CONFIG, query_config_id)
     return {"message": "success"}
 
 
 @router.get("/query/list")
-async def get_query_list(session: SessionDep, current_user: CurrentUser):
+async def get_query_list(session: AsyncSessionDep, current_user: AsyncCurrentUser):
     """
     获取查询配置列表
     :param session:
     :param current_user:
     :return:
     """
-    return get_all_query_config_by_user_id(session=session, user_id=current_user.id)
+    return await aget_all_query_config_by_user_id(session=session, user_id=current_user.id)
 
 
 @router.post("/load_config/upload")
-async def upload_load_config(session: SessionDep, current_user: CurrentUser, config: LoadConfigUserUpdate):
+async def upload_load_config(session: AsyncSessionDep, current_user: AsyncCurrentUser, config: LoadConfigUserUpdate):
     """
     上传加载配置
     :param session:
@@ -68,12 +75,12 @@ async def upload_load_config(session: SessionDep, current_user: CurrentUser, con
     load_config_base = LoadConfigBase(**config.dict())
     load_config_create = LoadConfigCreate(**config.dict(), user_id=current_user.id,
                                           config_hash=str(hash(load_config_base)))
-    load_config = create_load_config(session=session, load_llm_config=load_config_create)
+    load_config = await acreate_load_config(session=session, load_llm_config=load_config_create)
     return load_config
 
 
 @router.delete("/load_config/delete/{load_config_id}")
-async def delete_load_config(session: SessionDep, current_user: CurrentUser, load_config_id: uuid.UUID):
+async def delete_load_config(session: AsyncSessionDep, current_user: AsyncCurrentUser, load_config_id: uuid.UUID):
     """
     删除加载配置
     :param session:
@@ -81,18 +88,26 @@ async def delete_load_config(session: SessionDep, current_user: CurrentUser, loa
     :param load_config_id:
     :return:
     """
-    load_config = get_load_config_by_id(session=session, user_id=current_user.id, load_config_id=load_config_id)
-    session.delete(load_config)
-    session.commit()
+    load_config = await aget_load_config_by_id(session=session, user_id=current_user.id,
+                                                load_config_id=load_config_id)
+    if load_config is None:
+        raise HTTPException(status_code=404, detail="load_config not found")
+    title_ids = await aget_title_ids_by_load_config_id(session=session, load_config_id=load_config_id)
+    await session.delete(load_config)
+    await session.commit()
+    # 各 worker 淘汰使用该配置的查询对象，使用该配置的 title 重新生成检索链
+    await asyncio.to_thread(title_version_registry.publish_config_change, EVENT_LOAD_CONFIG, load_config_id)
+    for title_id in title_ids:
+        await asyncio.to_thread(title_version_registry.bump, title_id)
     return {"message": "success"}
 
 
 @router.get("/load_config/list")
-async def get_load_config_list(session: SessionDep, current_user: CurrentUser):
+async def get_load_config_list(session: AsyncSessionDep, current_user: AsyncCurrentUser):
     """
     获取加载配置列表
     :param session:
     :param current_user:
     :return:
     """
-    return get_all_load_config_by_user_id(session=session, user_id=current_user.id)
+    return await aget_all_load_config_by_user_id(session=session, user_id=current_user.id)
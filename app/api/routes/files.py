@@ -1,12 +1,30 @@
-import hashlib
+import asyncio
 import os
+import re
+import time
 import uuid
+from typing import List, Dict, Optional, Tuple
 
-from app.api.deps import SessionDep, CurrentTitle, CurrentFile
-from fastapi import UploadFile, APIRouter, File
-from app.db_model import FileCreate, FileStatus
+from sqlalchemy.exc import IntegrityError
+from sqlmodel.ext.asyncio.session import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+
+from app.api.deps import AsyncSessionDep, AsyncCurrentTitle, AsyncCurrentFile, async_engine
+from fastapi import UploadFile, APIRouter, File, Header, HTTPException
+from app.db_model import FileCreate, FileStatus, File as DBFile, FileStatusPublic, Title, UploadSessionCreate, \
+    UploadSessionPublic
 from app.retriever.load_file_thread import load_file_thread, ParentDocumentInfo
-from app.db_option import get_file_by_hash, get_file_by_name, create_file
+from app.db_option import aget_file_by_hash, aget_file_by_name, acreate_file, aget_files_by_title_id, \
+    aacquire_blob, arelease_blob, adelete_unreferenced_blob, aget_chroma_doc_ids_by_file_id, \
+    adelete_doc_chunks_by_file_id, aretry_failed_file
+from app.service.blob_store import global_blob_store
+from app.service.embeddings_pro.tasks import process_document
+from app.service.file_status_notifier import file_status_notifier
+from app.service.scheduler import RateLimitExceeded
+from app.service.upload_session import global_upload_session_manager, UploadSession, UploadSessionError
+from app.settings import settings
 from app.utils.user_base_model import BaseResponse
 
 router = APIRouter(prefix="/files", tags=["files"])
@@ -14,101 +32,423 @@ router = APIRouter(prefix="/files", tags=["files"])
 UPLOAD_DIR = 'upload_files'
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-MAX_PROCESSING_FILE_COUNT = 3
 
+def check_ingest_queue(title: Title):
+    """
+    每个用户的排队文件数有上限，超出时抛出 RateLimitExceeded，不影响其他用户
+    :param title:
+    :return:
+    """
+    if settings.INGEST_BACKEND == "local":
+        load_file_thread.file_path_queue.check(title.user_id)
 
-@router.post("/{title_id}/upload_file")
-async def upload(session: SessionDep, title: CurrentTitle, file: UploadFile = File(...)):
+
+def check_ingest_admission(title: Title):
     """
-    上传文档到数据库，用作资料库
+    排队文件数超出上限时返回 429 和排队位置
     :param title:
-    :param session:
-    :param file:
     :return:
     """
-    response_model = BaseResponse(code="000000", msg="success")
-    if load_file_thread.file_path_queue.qsize() > MAX_PROCESSING_FILE_COUNT:
-        response_model.code = "000003"
-        response_model.msg = "system is busy."
-        return response_model
+    try:
+        check_ingest_queue(title)
+    except RateLimitExceeded as e:
+        raise e.to_http_exception()
+
 
+async def check_upload_filename(session: AsyncSession, title: Title, filename: str) -> Tuple[str, BaseResponse]:
+    """
+    检查文件类型和同名文件
+    :param session:
+    :param title:
+    :param filename: 上传的文件名
+    :return: (文件记录中保存的文件名, 检查结果)
+    """
+    response_model = BaseResponse(code="000000", msg="success")
+    # 文件名只用于显示和同名检查，内容按 hash 保存在 blob 中
+    file_path = os.path.join(UPLOAD_DIR, str(title.user_id), str(title.id), os.path.basename(filename))
     # 检查文件类型
-    if not (file.filename.endswith("pdf") or file.filename.endswith("txt")):
+    if not (filename.endswith("pdf") or filename.endswith("txt")):
         response_model.code = "000001"
         response_model.msg = "file type error, support txt and pdf file."
-        return response_model
-
-    file_path = os.path.join(UPLOAD_DIR, str(title.user_id), str(title.id), file.filename)
-    if not os.path.exists(os.path.dirname(file_path)):
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    if get_file_by_name(session=session, filename=file_path, title_id=title.id) is not None:
+    elif await aget_file_by_name(session=session, filename=file_path, title_id=title.id) is not None:
         response_model.code = "000002"
         response_model.msg = "file exists, check filename."
+    return file_path, response_model
+
+
+def enqueue_ingest(title: Title, file: DBFile, force: bool = False):
+    """
+    文件开始入库，其他 title 已经入库的相同内容，入库时直接复制段落和向量
+    :param title:
+    :param file:
+    :param force: 本地入库时是否忽略用户的排队上限
+    :return:
+    """
+    if settings.INGEST_BACKEND == "celery":
+        process_document.delay(str(file.id))
+    else:
+        document_info = ParentDocumentInfo.from_file(file, user_id=title.user_id)
+        load_file_thread.file_path_queue.put(document_info, document_info.get_tenant(), force=force)
+
+
+async def save_blob_file(session: AsyncSession, title: Title, file_path: str, tmp_path: str, file_hash: str,
+                         file_size: int) -> DBFile | BaseResponse:
+    """
+    已经写入临时文件的内容保存为 blob，创建文件记录并开始入库
+    :param session:
+    :param title:
+    :param file_path: 文件记录中保存的文件名
+    :param tmp_path: 临时文件，保存成功时移动到 blob，失败时删除
+    :param file_hash:
+    :param file_size:
+    :return: 文件记录，内容重复时返回错误信息
+    """
+    response_model = BaseResponse(code="000002", msg="file exists.")
+    if await aget_file_by_hash(session=session, file_hash=file_hash, title_id=title.id) is not None:
+        global_blob_store.discard(tmp_path)
         return response_model
 
-    # 保存文件 计算hash值
-    sha256 = hashlib.sha256()
-    with open(file_path, "wb") as f:
-        while chunk := await file.read(1024 * 1024):
-            sha256.update(chunk)
-            f.write(chunk)
-        # shutil.copyfileobj(file.file, f)
-    file_hash = sha256.hexdigest()
-
-    if get_file_by_hash(session=session, file_hash=file_hash, title_id=title.id) is None:
-        print(f'title ')
-        file_data = FileCreate(filename=file_path, file_hash=str(file_hash), title_id=title.id,
+    try:
+        # 引用计数和文件记录一起提交，提交后再移动文件，和并发删除同一内容串行
+        await aacquire_blob(session=session, file_hash=file_hash, size=file_size)
+        file_data = FileCreate(filename=file_path, file_hash=file_hash, title_id=title.id,
                                status=FileStatus.LOADED.value, load_config_id=title.load_config_id)
-        print(f'file_data is {file_data}')
-        file = create_file(session, file_data)
-        print(f'file_id: {file.id}')
-        load_file_thread.file_path_queue.put(ParentDocumentInfo(file_path=file_path, file_id=file.id))
-        return file
-    else:
-        response_model.code = "000002"
-        response_model.msg = "file exists."
-    return response_model
+        file = await acreate_file(session, file_data)
+        blob_path = await run_in_threadpool(global_blob_store.commit, tmp_path, file_hash)
+    except IntegrityError:
+        # 同一 title 并发上传了相同内容
+        await session.rollback()
+        global_blob_store.discard(tmp_path)
+        return response_model
+    except BaseException:
+        global_blob_store.discard(tmp_path)
+        raise
+    print(f'file_id: {file.id}, blob: {blob_path}')
+    # 文件已经入库，检查之后并发上传超出的少量任务也放入队列
+    enqueue_ingest(title, file, force=True)
+    return file
+
+
+@router.post("/{title_id}/upload_file")
+async def upload(session: AsyncSessionDep, title: AsyncCurrentTitle, file: UploadFile = File(...)):
+    """
+    上传文档到数据库，用作资料库
+    :param title:
+    :param session:
+    :param file:
+    :return:
+    """
+    check_ingest_admission(title)
+    file_path, response_model = await check_upload_filename(session, title, file.filename)
+    if response_model.code != "000000":
+        return response_model
+
+    # 写入临时文件的同时计算hash值，在线程池中执行，重复内容不会留在磁盘上
+    tmp_path, file_hash, file_size = await global_blob_store.save_upload(file)
+    return await save_blob_file(session, title, file_path, tmp_path, file_hash, file_size)
+
+
+async def load_upload_session(title: Title, session_id: uuid.UUID) -> UploadSession:
+    upload_session = await run_in_threadpool(global_upload_session_manager.load, session_id)
+    if upload_session is None or upload_session.title_id != title.id:
+        raise HTTPException(status_code=404, detail="upload session not found or expired")
+    return upload_session
+
+
+def upload_session_http_exception(e: UploadSessionError) -> HTTPException:
+    detail = {"msg": e.message}
+    if e.received is not None:
+        detail["received"] = e.received
+    return HTTPException(status_code=e.status_code, detail=detail)
+
+
+def parse_content_range(content_range: Optional[str], size: int) -> int:
+    """
+    解析请求头 Content-Range: bytes start-end/total，返回起始位置
+    :param content_range:
+    :param size: 文件声明的字节数
+    :return:
+    """
+    match = re.fullmatch(r"bytes (\d+)-(\d+)/(\d+|\*)", (content_range or "").strip())
+    if match is None:
+        raise HTTPException(status_code=400, detail="Content-Range header required: bytes start-end/total")
+    if match.group(3) != "*" and int(match.group(3)) != size:
+        raise HTTPException(status_code=400, detail=f"Content-Range total does not match file size {size}")
+    return int(match.group(1))
+
+
+@router.post("/{title_id}/upload_sessions", response_model=UploadSessionPublic)
+async def create_upload_session(session: AsyncSessionDep, title: AsyncCurrentTitle, session_create: UploadSessionCreate):
+    """
+    创建断点续传上传会话，一个会话可以包含多个文件（例如导入文件夹）
+    :param session:
+    :param title:
+    :param session_create: 文件名和字节数列表
+    :return: 会话信息，每个文件已接收的字节数
+    """
+    for upload_file in session_create.files:
+        _, response_model = await check_upload_filename(session, title, upload_file.filename)
+        if response_model.code != "000000":
+            raise HTTPException(status_code=400, detail={"msg": response_model.msg,
+                                                         "filename": upload_file.filename})
+    try:
+        upload_session = await run_in_threadpool(
+            global_upload_session_manager.create, title.id, title.user_id,
+            [(upload_file.filename, upload_file.size) for upload_file in session_create.files])
+    except UploadSessionError as e:
+        raise upload_session_http_exception(e)
+    return await run_in_threadpool(global_upload_session_manager.to_public, upload_session)
+
+
+@router.get("/{title_id}/upload_sessions/{session_id}", response_model=UploadSessionPublic)
+async def get_upload_session(title: AsyncCurrentTitle, session_id: uuid.UUID):
+    """
+    获取上传会话，续传前查询每个文件已接收的字节数
+    :param title:
+    :param session_id:
+    :return:
+    """
+    upload_session = await load_upload_session(title, session_id)
+    return await run_in_threadpool(global_upload_session_manager.to_public, upload_session)
+
+
+@router.put("/{title_id}/upload_sessions/{session_id}/{index}")
+async def upload_session_range(request: Request, title: AsyncCurrentTitle, session_id: uuid.UUID, index: int,
+                               content_range: Optional[str] = Header(default=None)):
+    """
+    上传文件的一段数据，起始位置必须等于已接收的字节数，不一致时返回 409 和已接收的字节数
+    :param request:
+    :param title:
+    :param session_id:
+    :param index: 文件在会话中的序号
+    :param content_range: bytes start-end/total
+    :return: 已接收的字节数
+    """
+    upload_session = await load_upload_session(title, session_id)
+    try:
+        upload_file = global_upload_session_manager.get_file(upload_session, index)
+        start = parse_content_range(content_range, upload_file.size)
+        received = await global_upload_session_manager.write_range(upload_session, index, start, request.stream())
+    except UploadSessionError as e:
+        raise upload_session_http_exception(e)
+    return {"index": index, "size": upload_file.size, "received": received}
+
+
+async def finalize_upload_file(session: AsyncSession, title: Title, upload_session: UploadSession,
+                               index: int) -> dict:
+    """
+    提交会话中的一个文件，锁住文件直到记录提交结果，多个 worker 同时提交同一会话时不会重复入库
+    :param session:
+    :param title:
+    :param upload_session:
+    :param index:
+    :return: 文件的处理结果，之前已经提交过的文件返回上次的结果
+    """
+    async with global_upload_session_manager.lock_file(upload_session, index) as upload_file:
+        result = {"index": upload_file.index, "filename": upload_file.filename}
+        if upload_file.completed:
+            # 之前提交时已经处理的文件，数据已经移动到 blob，直接返回上次的结果
+            result.update({"code": upload_file.code, "msg": upload_file.msg})
+            if upload_file.file_id is not None:
+                result["file_id"] = upload_file.file_id
+            return result
+        # 每个文件入队前单独检查排队上限，超出时文件保留在会话中，稍后再次提交
+        check_ingest_queue(title)
+        part_path, file_hash, file_size = await global_upload_session_manager.complete_file(upload_session, index)
+        file_path, response_model = await check_upload_filename(session, title, upload_file.filename)
+        if response_model.code != "000000":
+            global_blob_store.discard(part_path)
+            result.update({"code": response_model.code, "msg": response_model.msg})
+        else:
+            file = await save_blob_file(session, title, file_path, part_path, file_hash, file_size)
+            if isinstance(file, BaseResponse):
+                result.update({"code": file.code, "msg": file.msg})
+            else:
+                result.update({"code": "000000", "msg": "success", "file_id": file.id})
+        await run_in_threadpool(global_upload_session_manager.mark_completed, upload_session, index,
+                                result["code"], result["msg"], result.get("file_id"))
+        return result
+
+
+@router.post("/{title_id}/upload_sessions/{session_id}/finalize")
+async def finalize_upload_session(session: AsyncSessionDep, title: AsyncCurrentTitle, session_id: uuid.UUID):
+    """
+    完成上传：接收完整的文件保存为 blob 并开始入库，全部文件都处理后删除会话
+    :param session:
+    :param title:
+    :param session_id:
+    :return: 每个文件的处理结果
+    """
+    upload_session = await load_upload_session(title, session_id)
+    results = []
+    pending = 0
+    for index in range(len(upload_session.files)):
+        try:
+            results.append(await finalize_upload_file(session, title, upload_session, index))
+        except UploadSessionError as e:
+            # 未接收完整或正在上传的文件保留在会话中，可以继续上传后再次提交
+            pending += 1
+            upload_file = upload_session.files[index]
+            results.append({"index": index, "filename": upload_file.filename, "code": "000005",
+                            "msg": e.message, "received": e.received})
+        except RateLimitExceeded as e:
+            # 超出排队上限的文件保留在会话中，等待 retry_after 秒后再次提交
+            pending += 1
+            upload_file = upload_session.files[index]
+            results.append({"index": index, "filename": upload_file.filename, "code": "000006",
+                            "msg": e.message, "retry_after": e.retry_after})
+    if pending == 0:
+        await run_in_threadpool(global_upload_session_manager.delete, session_id)
+    return {"session_id": session_id, "pending": pending, "files": results}
+
+
+@router.delete("/{title_id}/upload_sessions/{session_id}", response_model=BaseResponse)
+async def delete_upload_session(title: AsyncCurrentTitle, session_id: uuid.UUID):
+    """
+    取消上传，删除已接收的数据
+    :param title:
+    :param session_id:
+    :return:
+    """
+    await load_upload_session(title, session_id)
+    await run_in_threadpool(global_upload_session_manager.delete, session_id)
+    return BaseResponse(code="000000", msg="success")
 
 
 @router.delete("/{title_id}/{file_id}", response_model=BaseResponse)
-async def delete_file(session: SessionDep, file: CurrentFile):
+async def delete_file(session: AsyncSessionDep, file: AsyncCurrentFile):
     """
     删除指定文件
     :param file:
     :param session:
     :return:
     """
-    file_path = file.filename
+    file_path = global_blob_store.resolve_path(file)
     response_model = BaseResponse(code="000000", msg="success")
 
-    if not os.path.exists(file_path):
-        response_model.code = '000001'
-        response_model.msg = f'file: {file_path} not exists.'
-        return response_model
-
-    if not os.path.isfile(file_path):
+    # 文件已经不在磁盘上时仍然删除记录，只检查路径存在但不是文件的情况
+    if os.path.exists(file_path) and not os.path.isfile(file_path):
         response_model.code = '000002'
         response_model.msg = f'path: {file_path} not file.'
         return response_model
 
-    try:
-        os.remove(file_path)
-    except PermissionError:
-        response_model.code = '000003'
-        response_model.msg = f'file not permission'
-        return response_model
-    except Exception as e:
-        response_model.code = '000004'
-        response_model.msg = f'file delete failed. {str(e)}'
-        return response_model
-
     print(f'find {file_path} in db.')
-    ids = []
-    for chunk in file.chunks:
-        ids.append(chunk.chroma_doc_id)
+    # 先删除向量和关键词索引，失败时文件记录保留，可以重新删除
+    ids = await aget_chroma_doc_ids_by_file_id(session=session, file_id=file.id)
     print(f'find sub doc ids len: {len(ids)}')
-    await load_file_thread.delete_embeddings(ids)
+    await load_file_thread.delete_embeddings(file.title_id, ids)
+    await asyncio.to_thread(load_file_thread.delete_lexical_index, file.title_id, file.id)
     print(f'delete {file_path} in db.')
-    session.delete(file)
-    session.commit()
+    # 一条语句删除段落记录，父文档由外键级联删除；引用计数和文件记录一起提交，
+    # 内容记录的行锁只在这几条语句之间持有
+    await adelete_doc_chunks_by_file_id(session=session, file_id=file.id)
+    # 按内容保存之前上传的文件没有引用计数记录
+    released = await arelease_blob(session=session, file_hash=file.file_hash)
+    # 文件记录由同一个异步 session 查询得到，直接删除
+    await session.delete(file)
+    await session.commit()
+
+    # 记录提交后再删除磁盘文件，删除失败只留下没有记录引用的文件
+    try:
+        if released:
+            if await adelete_unreferenced_blob(session=session, file_hash=file.file_hash):
+                await run_in_threadpool(global_blob_store.remove, file.file_hash)
+            await session.commit()
+        elif file_path == file.filename and os.path.exists(file_path):
+            os.remove(file_path)
+    except Exception as e:
+        await session.rollback()
+        print(f'remove {file_path} failed. {str(e)}')
     return response_model
+
+
+@router.post("/{title_id}/{file_id}/retry", response_model=FileStatusPublic)
+async def retry_file(session: AsyncSessionDep, title: AsyncCurrentTitle, file: AsyncCurrentFile):
+    """
+    重新处理入库失败的文件，已经完成的批次会被跳过
+    :param session:
+    :param title:
+    :param file:
+    :return: 重置后的文件状态
+    """
+    if file.status != FileStatus.FAILED.value:
+        raise HTTPException(status_code=409, detail=f"file status is {file.status}, only failed file can retry")
+    check_ingest_admission(title)
+    retry_file_record = await aretry_failed_file(session=session, file_id=file.id)
+    if retry_file_record is None:
+        # 其他请求已经重试
+        raise HTTPException(status_code=409, detail="file is already retrying")
+    enqueue_ingest(title, retry_file_record, force=True)
+    return FileStatusPublic.from_file(retry_file_record)
+
+
+@router.get("/{title_id}/status", response_model=List[FileStatusPublic])
+async def get_title_files_status(session: AsyncSessionDep, title: AsyncCurrentTitle):
+    """
+    获取当前title下所有文件的入库状态和进度
+    :param session:
+    :param title:
+    :return:
+    """
+    files = await aget_files_by_title_id(session=session, title_id=title.id)
+    return [FileStatusPublic.from_file(file) for file in files]
+
+
+@router.get("/{title_id}/{file_id}/status", response_model=FileStatusPublic)
+async def get_file_status(file: AsyncCurrentFile):
+    """
+    获取文件的入库状态和进度
+    :param file:
+    :return:
+    """
+    return FileStatusPublic.from_file(file)
+
+
+async def file_status_event_generator(request: Request, title_id: uuid.UUID):
+    """
+    推送title下文件的状态变化：本进程的入库事件实时推送，其他 worker 处理的文件定时从数据库刷新
+    :param request:
+    :param title_id:
+    :return:
+    """
+    event_queue = file_status_notifier.subscribe(title_id)
+    last_sent: Dict[uuid.UUID, FileStatusPublic] = {}
+    last_refresh_time = 0.0
+    last_send_time = time.monotonic()
+    try:
+        while not await request.is_disconnected():
+            if time.monotonic() - last_refresh_time >= settings.FILE_STATUS_REFRESH_SECONDS:
+                last_refresh_time = time.monotonic()
+                async with AsyncSession(async_engine) as session:
+                    files = await aget_files_by_title_id(session=session, title_id=title_id)
+                events = [FileStatusPublic.from_file(file) for file in files]
+            else:
+                try:
+                    events = [await asyncio.wait_for(event_queue.get(), timeout=1)]
+                except asyncio.TimeoutError:
+                    events = []
+
+            for event in events:
+                # 只推送有变化的状态
+                if last_sent.get(event.id) == event:
+                    continue
+                last_sent[event.id] = event
+                last_send_time = time.monotonic()
+                yield f"data: {event.model_dump_json()}\n\n"
+
+            if time.monotonic() - last_send_time >= settings.FILE_STATUS_HEARTBEAT_SECONDS:
+                last_send_time = time.monotonic()
+                yield ": heartbeat\n\n"
+    finally:
+        file_status_notifier.unsubscribe(title_id, event_queue)
+
+
+@router.get("/{title_id}/status/stream")
+async def stream_title_files_status(request: Request, title: AsyncCurrentTitle):
+    """
+    以 SSE 推送当前title下文件的入库状态和进度，客户端不需要轮询
+    :param request:
+    :param title:
+    :return: StreamingResponse
+    """
+    return StreamingResponse(file_status_event_generator(request, title.id), media_type="text/event-stream")
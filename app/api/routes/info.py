@@ -1,8 +1,19 @@
 import time
 
-from app.api.deps import SessionDep
-from fastapi import APIRouter
+from app.api.deps import SessionDep, get_current_superuser
+from fastapi import APIRouter, Depends
 # from app.db_option import get_all_files
+from app.retriever.answer_cache import global_answer_cache
+from app.retriever.context_builder import global_context_builder
+from app.retriever.llm_client_pool import global_llm_client_pool
+from app.retriever.llm_manager import global_query_llm_cache
+from app.retriever.load_file_thread import load_file_thread
+from app.retriever.query_answers import global_query_answers_cache
+from app.retriever.reranker import global_reranker
+from app.retriever.single_flight import global_single_flight
+from app.service.principal_cache import global_principal_cache
+from app.service.scheduler import chat_scheduler
+from app.utils.metrics import metrics
 from app.utils.user_base_model import InfoResponse, BaseResponse
 
 router = APIRouter(prefix="/info", tags=["info"])
@@ -45,3 +56,35 @@ def heartbeat(session: SessionDep, device_id: str):
         return BaseResponse(code="000000", msg="success")
     global_save_device_dict[device_id] = cur_time
     return BaseResponse(code="000000", msg="success")
+
+
+@router.get("/cache", response_model=InfoResponse, dependencies=[Depends(get_current_superuser)])
+def get_cache_stats():
+    """
+    获取查询对象缓存的统计信息：命中、未命中、淘汰次数。包含用户 id，只允许超级用户访问
+    :return: InfoResponse
+    """
+    info_response = InfoResponse(code="000000", msg="success")
+    info_response.extra_msg = {
+        "query_answers": global_query_answers_cache.stats(),
+        "query_llm": global_query_llm_cache.stats(),
+        "llm_client_pool": global_llm_client_pool.stats(),
+        "query_embedding": load_file_thread.embeddings.stats() if load_file_thread.embeddings else None,
+        "rerank": global_reranker.stats(),
+        "context": global_context_builder.stats(),
+        "answer": global_answer_cache.stats(),
+        "single_flight": global_single_flight.stats(),
+        "chat_scheduler": chat_scheduler.stats(),
+        "principal": global_principal_cache.stats(),
+        "ingest_queue": load_file_thread.file_path_queue.stats(),
+    }
+    return info_response
+
+
+@router.get("/metrics", response_model=InfoResponse, dependencies=[Depends(get_current_superuser)])
+def get_metrics():
+    """
+    获取进程内指标：流式回答首字节时间、取消次数等，只允许超级用户访问
+    :return: InfoResponse
+    """
+    return InfoResponse(code="000000", msg="success", extra_msg=metrics.stats())
@@ -5,8 +5,10 @@ from app.api.deps import SessionDep, CurrentUser, CurrentTitle
 from fastapi import APIRouter, HTTPException
 
 from app.db_model import TitleCreate, TitleUpdate, TitleInfoUpdate, LoadConfig
+from app.retriever.load_file_thread import load_file_thread
 from app.db_option import get_title_by_name, create_title, get_title_by_id, get_all_files_by_title_id, \
-    get_load_config_by_user_id
+    get_load_config_by_user_id, release_blobs, delete_unreferenced_blob
+from app.service.blob_store import global_blob_store
 
 router = APIRouter(prefix="/titles", tags=["titles"])
 
@@ -86,6 +88,20 @@ def delete_title(*, session: SessionDep, cur_title: CurrentTitle):
     :param session:
     :return:
     """
+    title_id = cur_title.id
+    # 减少 title 下文件内容的引用计数，和 title 的删除一起提交
+    released = release_blobs(session, [file.file_hash for file in cur_title.files])
     session.delete(cur_title)
     session.commit()
+    # 记录提交后再删除不再被引用的文件，删除失败只留下没有记录引用的文件
+    for file_hash in released:
+        try:
+            if delete_unreferenced_blob(session, file_hash):
+                global_blob_store.remove(file_hash)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f'remove blob {file_hash} failed. {str(e)}')
+    # 删除 title 对应的向量数据库
+    load_file_thread.delete_title_collection(title_id)
     return {"msg": "success"}
\ No newline at end of file
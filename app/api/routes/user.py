@@ -10,6 +10,7 @@ from app.db_option import get_user_by_email, create_user, get_titles_by_user, cr
     create_load_config, update_user_config
 from app.retriever.llm_manager import LLmManager, global_query_llm_cache
 from app.retriever.query_answers import QueryAnswers
+from app.service.principal_cache import global_principal_cache
 from app.utils.user_base_model import LLmConfig
 
 router = APIRouter(prefix="/user", tags=["user"])
@@ -43,8 +44,8 @@ def register_user(*, session: SessionDep, user_in: UserCreate):
 
     # 创建query llm对象
     query_llm = LLmManager(user_id=user.id)
-    query_llm.load_llm(session=session)
-    global_query_llm_cache[user.id] = query_llm
+    query_llm.load_llm()
+    global_query_llm_cache.put((user.id, user.cur_llm_config_id), query_llm)
     return user
 
 
@@ -67,6 +68,7 @@ def update_user_me(
     session.add(current_user)
     session.commit()
     session.refresh(current_user)
+    global_principal_cache.invalidate_user(current_user.id)
     return current_user
 
 
@@ -94,7 +96,9 @@ def delete_account(session: SessionDep, current_user: CurrentUser) -> Any:
         raise HTTPException(
             status_code=403, detail="Super users are not allowed to delete themselves"
         )
+    user_id = current_user.id
     session.delete(current_user)
     session.commit()
+    global_principal_cache.invalidate_user(user_id)
     return {"msg": "Successfully deleted"}
 
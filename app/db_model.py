@@ -1,9 +1,10 @@
+import os
 import uuid
 from datetime import datetime
 from enum import Enum
 from typing import Optional, List
 from pydantic import EmailStr
-from sqlalchemy import func
+from sqlalchemy import func, Column, LargeBinary, UniqueConstraint
 from sqlmodel import SQLModel, Field, Relationship
 from app.utils.user_base_model import EmbeddingsConfig, RetrieverConfig, MultiRetrieverConfig, HistoryConfig, \
     SummaryLLmConfig, LLmConfig
@@ -19,12 +20,14 @@ class TokenPayload(SQLModel):
 
 
 class FileStatus(Enum):
+    # 状态流转：LOADED -> SPLITTING -> HAS_SPLIT -> EMBEDDING -> COMPLETE，任一阶段出错 -> FAILED
     LOADING = "LOADING"
     LOADED = "LOADED"
     SPLITTING = "SPLITTING"
     HAS_SPLIT = "HAS_SPLIT"
     EMBEDDING = "EMBEDDING"
     COMPLETE = "COMPLETE"
+    FAILED = "FAILED"
 
 
 class UserBase(SQLModel):
@@ -163,7 +166,7 @@ class FileBase(SQLModel):
 
 
 class FileCreate(FileBase):
-    file_hash: str = Field(nullable=False, unique=True, index=True, max_length=64)
+    file_hash: str = Field(nullable=False, index=True, max_length=64)
     title_id: Optional[uuid.UUID] = Field(foreign_key="titles.id", index=True, ondelete="CASCADE")
     status: str = Field(nullable=False, default=FileStatus.LOADING.value, max_length=16)
     load_config_id: uuid.UUID = Field(foreign_key="load_configs.id", index=True)
@@ -171,17 +174,93 @@ class FileCreate(FileBase):
 
 class File(FileBase, table=True):
     __tablename__ = "files"
+    # 同一内容可以被多个 title 引用，同一 title 下不重复
+    __table_args__ = (UniqueConstraint("title_id", "file_hash", name="uq_files_title_id_file_hash"),)
 
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
-    file_hash: str = Field(nullable=False, unique=True, index=True, max_length=64)
+    file_hash: str = Field(nullable=False, index=True, max_length=64)
     create_at: datetime = Field(default=None, sa_column_kwargs={"server_default": func.now()})
     status: str = Field(nullable=False, default=FileStatus.LOADING.value, max_length=16)
     load_config_id: uuid.UUID = Field(foreign_key="load_configs.id", index=True)
     title_id: Optional[uuid.UUID] = Field(foreign_key="titles.id", index=True, ondelete="CASCADE")
     title: Optional[Title] = Relationship(back_populates="files")
+    # 入库进度
+    chunk_total: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
+    chunk_done: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
+    error_msg: Optional[str] = Field(default=None, max_length=1024)
+    process_start_at: Optional[datetime] = Field(default=None)
+    status_update_at: Optional[datetime] = Field(default=None)
+    # 生成段落和向量的参数（文件类型、切分参数、总结策略、嵌入模型），相同内容、相同参数的文件可以直接复制段落
+    ingest_key: Optional[str] = Field(default=None, index=True, max_length=256)
+    # 本地入库的处理租约：持有者定时续期，worker 异常退出后租约过期，其他 worker 可以接手
+    lease_owner: Optional[str] = Field(default=None, max_length=128)
+    lease_expire_at: Optional[datetime] = Field(default=None)
 
     # 关系字段：一对多关系，一个 Document 对应多个 chunks
-    chunks: List["DocumentChunk"] = Relationship(back_populates="file", cascade_delete=True)
+    # 删除文件时由数据库外键级联删除 chunks，不加载到内存逐条删除
+    chunks: List["DocumentChunk"] = Relationship(back_populates="file", cascade_delete=True, passive_deletes=True)
+
+
+class FileBlob(SQLModel, table=True):
+    """
+    按内容寻址保存的上传文件，文件路径由 file_hash 确定，ref_count 为引用该内容的文件记录数
+    """
+    __tablename__ = "file_blobs"
+
+    file_hash: str = Field(primary_key=True, max_length=64)
+    size: int = Field(default=0)
+    ref_count: int = Field(default=0)
+    create_at: datetime = Field(default=None, sa_column_kwargs={"server_default": func.now()})
+
+
+class FileStatusPublic(SQLModel):
+    id: uuid.UUID
+    title_id: Optional[uuid.UUID]
+    filename: str
+    status: str
+    chunk_total: int = 0
+    chunk_done: int = 0
+    error_msg: Optional[str] = None
+    # 入库速度，段落/秒
+    throughput: float = 0.0
+    status_update_at: Optional[datetime] = None
+
+    @classmethod
+    def from_file(cls, file: File) -> "FileStatusPublic":
+        throughput = 0.0
+        if file.process_start_at and file.status_update_at and file.chunk_done:
+            seconds = (file.status_update_at - file.process_start_at).total_seconds()
+            throughput = round(file.chunk_done / seconds, 2) if seconds > 0 else 0.0
+        return cls(id=file.id, title_id=file.title_id, filename=os.path.basename(file.filename),
+                   status=file.status, chunk_total=file.chunk_total or 0, chunk_done=file.chunk_done or 0,
+                   error_msg=file.error_msg, throughput=throughput, status_update_at=file.status_update_at)
+
+
+class UploadSessionFileCreate(SQLModel):
+    filename: str = Field(max_length=256)
+    size: int = Field(ge=0)
+
+
+class UploadSessionCreate(SQLModel):
+    files: List[UploadSessionFileCreate] = Field(min_length=1)
+
+
+class UploadSessionFilePublic(SQLModel):
+    index: int
+    filename: str
+    size: int
+    # 已经接收的字节数，续传时从该位置开始
+    received: int
+    # 已经提交过，再次提交会话时跳过
+    completed: bool = False
+    file_id: Optional[uuid.UUID] = None
+
+
+class UploadSessionPublic(SQLModel):
+    id: uuid.UUID
+    title_id: uuid.UUID
+    files: List[UploadSessionFilePublic]
+    expires_at: datetime
 
 
 class DocumentChunk(SQLModel, table=True):
@@ -194,3 +273,44 @@ class DocumentChunk(SQLModel, table=True):
 
     # 关系字段：多对一关系，一个 chunk 对应一个 Document
     file: Optional[File] = Relationship(back_populates="chunks")
+
+
+class ParentDocument(SQLModel, table=True):
+    """
+    多向量检索时保存的原始段落，doc_id 与总结段落向量的 doc_id 对应
+    """
+    __tablename__ = "parent_documents"
+
+    doc_id: str = Field(primary_key=True, max_length=64)
+    document_id: uuid.UUID = Field(foreign_key="files.id", index=True, ondelete="CASCADE")
+    # 序列化后的段落，较大的段落压缩保存
+    content: bytes = Field(sa_column=Column(LargeBinary, nullable=False))
+    compressed: bool = Field(default=False)
+
+
+class LexicalChunk(SQLModel, table=True):
+    """
+    关键词索引中的段落，LEXICAL_INDEX_BACKEND 为 postgres 时使用，删除文件时级联删除
+    """
+    __tablename__ = "lexical_chunks"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    chunk_id: str = Field(max_length=64, unique=True)
+    title_id: uuid.UUID = Field(index=True)
+    file_id: uuid.UUID = Field(foreign_key="files.id", index=True, ondelete="CASCADE")
+    # 段落的词数，BM25 长度归一化使用
+    length: int = Field(default=0)
+    content: bytes = Field(sa_column=Column(LargeBinary, nullable=False))
+    compressed: bool = Field(default=False)
+
+
+class LexicalPosting(SQLModel, table=True):
+    """
+    倒排表，按 (title, 词) 聚集查询
+    """
+    __tablename__ = "lexical_postings"
+
+    title_id: uuid.UUID = Field(primary_key=True)
+    term: str = Field(primary_key=True, max_length=128)
+    chunk: int = Field(primary_key=True, foreign_key="lexical_chunks.id", index=True, ondelete="CASCADE")
+    tf: int = Field(default=1)
@@ -1,12 +1,18 @@
 import os
 import hashlib
 import uuid
+from datetime import datetime, timedelta
 from typing import List, Optional
+from collections import Counter
+from sqlalchemy import delete, update, or_, and_
+from sqlalchemy.dialects.postgresql import insert
 from sqlmodel import select, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 from app.api.deps import SessionDep, engine
-from app.db_model import File, FileCreate, DocumentChunk, User, UserCreate, Title, TitleCreate, TitleUpdate, \
+from app.db_model import File, FileBlob, FileCreate, FileStatus, DocumentChunk, User, UserCreate, Title, TitleCreate, TitleUpdate, \
     QueryConfig, QueryConfigCreate, LoadConfigCreate, LoadConfig
 from app.security import get_password_hash
+from app.service.principal_cache import global_principal_cache
 from app.utils.user_base_model import LLmConfig
 
 
@@ -57,14 +63,200 @@ def get_all_files_by_title_id(session: SessionDep, title_id: uuid.UUID) -> List[
     return file_name_list
 
 
-def save_doc_chunk(doc_id_list: List[str], parent_doc_id: int) -> None:
+def save_doc_chunk(doc_id_list: List[str], parent_doc_id: uuid.UUID) -> None:
+    """
+    批量保存段落记录，一条多行 insert 语句，不创建 ORM 对象
+    :param doc_id_list:
+    :param parent_doc_id: 文件id
+    :return:
+    """
+    if not doc_id_list:
+        return
+    rows = [{"chroma_doc_id": doc_id, "document_id": parent_doc_id} for doc_id in doc_id_list]
+    with Session(engine) as session:
+        session.execute(DocumentChunk.__table__.insert(), rows)
+        session.commit()
+
+
+def get_chroma_doc_ids_by_file_id(file_id: uuid.UUID, chroma_doc_ids: Optional[List[str]] = None) -> List[str]:
+    """
+    获取文件已保存的段落id
+    :param file_id:
+    :param chroma_doc_ids: 只在这些id中查找，None 时返回文件的所有段落id
+    :return:
+    """
+    with Session(engine) as session:
+        statement = select(DocumentChunk.chroma_doc_id).where(DocumentChunk.document_id == file_id)
+        if chroma_doc_ids is not None:
+            statement = statement.where(DocumentChunk.chroma_doc_id.in_(chroma_doc_ids))
+        return list(session.exec(statement).all())
+
+
+def get_file_by_id(file_id: uuid.UUID) -> File | None:
+    with Session(engine) as session:
+        return session.get(File, file_id)
+
+
+def update_file_progress(file_id: uuid.UUID, status: Optional[str] = None, chunk_total: Optional[int] = None,
+                         chunk_done: Optional[int] = None, chunk_done_delta: int = 0,
+                         error_msg: Optional[str] = None, start: bool = False,
+                         ingest_key: Optional[str] = None) -> File | None:
+    """
+    更新文件入库状态和进度
+    :param file_id:
+    :param status: 新状态，None 表示不变
+    :param chunk_total: 段落总数
+    :param chunk_done: 已完成段落数
+    :param chunk_done_delta: 已完成段落数增量，多个批次并发完成时使用，由数据库累加
+    :param error_msg: 错误信息
+    :param start: 是否开始处理，开始时记录开始时间并清空错误信息
+    :param ingest_key: 生成段落和向量的参数
+    :return: 更新后的文件
+    """
+    now = datetime.now()
+    values = {"status_update_at": now}
+    if status is not None:
+        values["status"] = status
+    if chunk_total is not None:
+        values["chunk_total"] = chunk_total
+    if chunk_done is not None:
+        values["chunk_done"] = chunk_done
+    elif chunk_done_delta:
+        values["chunk_done"] = File.chunk_done + chunk_done_delta
+    if start:
+        values["process_start_at"] = now
+        values["error_msg"] = None
+    if error_msg is not None:
+        values["error_msg"] = error_msg[:1024]
+    if ingest_key is not None:
+        values["ingest_key"] = ingest_key
+    with Session(engine) as session:
+        session.exec(update(File).where(File.id == file_id).values(**values))
+        session.commit()
+        return session.get(File, file_id)
+
+
+# 未处理完成的文件状态，可以重新处理
+UNFINISHED_FILE_STATUS = [FileStatus.LOADED.value, FileStatus.SPLITTING.value,
+                          FileStatus.HAS_SPLIT.value, FileStatus.EMBEDDING.value]
+
+
+def get_resumable_files(lease_seconds: int) -> List[File]:
+    """
+    获取需要重新处理的未完成文件：处理租约已经过期，或者上传后超过租约有效期仍未开始处理（所在 worker 已退出）
+    :param lease_seconds: 租约有效期
+    :return:
+    """
+    now = datetime.now()
+    with Session(engine) as session:
+        statement = select(File).where(
+            File.status.in_(UNFINISHED_FILE_STATUS),
+            or_(File.lease_expire_at < now,
+                and_(File.lease_expire_at.is_(None), File.create_at < now - timedelta(seconds=lease_seconds)))
+        )
+        return list(session.exec(statement).all())
+
+
+def acquire_file_lease(file_id: uuid.UUID, owner: str, lease_seconds: int) -> bool:
+    """
+    获取文件的处理租约，文件未完成且没有其他有效租约时才能获取，同一文件同时只由一个 worker 处理
+    :param file_id:
+    :param owner: 租约持有者
+    :param lease_seconds: 租约有效期
+    :return: 是否获取成功
+    """
+    now = datetime.now()
+    with Session(engine) as session:
+        result = session.exec(
+            update(File)
+            .where(File.id == file_id, File.status.in_(UNFINISHED_FILE_STATUS),
+                   or_(File.lease_owner.is_(None), File.lease_expire_at < now))
+            .values(lease_owner=owner, lease_expire_at=now + timedelta(seconds=lease_seconds))
+        )
+        session.commit()
+        return result.rowcount == 1
+
+
+def renew_file_leases(owner: str, lease_seconds: int) -> int:
+    """
+    续期持有者的所有租约
+    :param owner:
+    :param lease_seconds:
+    :return: 续期的文件数
+    """
+    with Session(engine) as session:
+        result = session.exec(
+            update(File).where(File.lease_owner == owner)
+            .values(lease_expire_at=datetime.now() + timedelta(seconds=lease_seconds))
+        )
+        session.commit()
+        return result.rowcount
+
+
+def release_file_lease(file_id: uuid.UUID, owner: str) -> None:
     with Session(engine) as session:
-        for doc_id in doc_id_list:
-            chunk = DocumentChunk(chroma_doc_id=doc_id, document_id=parent_doc_id)
-            session.add(chunk)
+        session.exec(
+            update(File).where(File.id == file_id, File.lease_owner == owner)
+            .values(lease_owner=None, lease_expire_at=None)
+        )
         session.commit()
 
 
+def get_reusable_file(file_hash: str, ingest_key: str, exclude_file_id: uuid.UUID) -> File | None:
+    """
+    查找内容相同、生成段落和向量的参数相同且已经入库完成的文件，其段落和向量可以直接复制
+    :param file_hash:
+    :param ingest_key: 当前入库参数
+    :param exclude_file_id: 当前文件
+    :return:
+    """
+    with Session(engine) as session:
+        statement = select(File).where(
+            File.file_hash == file_hash,
+            File.ingest_key == ingest_key,
+            File.status == FileStatus.COMPLETE.value,
+            File.id != exclude_file_id,
+        )
+        return session.exec(statement).first()
+
+
+def release_blobs(session: Session, file_hashes: List[str]) -> List[str]:
+    """
+    删除文件记录前减少内容的引用计数。不提交，由调用方和文件记录一起提交；
+    计数为 0 的记录保留到提交后由 delete_unreferenced_blob 和文件一起删除
+    :param session:
+    :param file_hashes: 删除的文件的 hash，可以重复
+    :return: 不再被引用的 hash
+    """
+    released = []
+    for file_hash, count in Counter(file_hashes).items():
+        # 锁住记录，和并发上传的引用计数加 1 串行执行
+        blob = session.exec(select(FileBlob).where(FileBlob.file_hash == file_hash).with_for_update()).first()
+        if blob is None:
+            continue
+        blob.ref_count = max(blob.ref_count - count, 0)
+        session.add(blob)
+        if blob.ref_count == 0:
+            released.append(file_hash)
+    return released
+
+
+def delete_unreferenced_blob(session: Session, file_hash: str) -> bool:
+    """
+    锁住引用计数为 0 的内容记录并删除，不提交。调用方删除磁盘文件后提交，
+    期间并发上传相同内容的引用计数加 1 等待提交，不会在文件删除后引用到已删除的内容
+    :param session:
+    :param file_hash:
+    :return: 内容是否仍不被引用，为 True 时调用方删除对应的文件
+    """
+    statement = select(FileBlob).where(FileBlob.file_hash == file_hash, FileBlob.ref_count <= 0).with_for_update()
+    blob = session.exec(statement).first()
+    if blob is None:
+        return False
+    session.delete(blob)
+    return True
+
+
 def create_user(*, session: SessionDep, user_create: UserCreate) -> User:
     db_obj = User.model_validate(
         user_create, update={"hashed_password": get_password_hash(user_create.password)}
@@ -79,6 +271,8 @@ def update_user_config(*, session: SessionDep, user: User) -> User:
     session.add(user)
     session.commit()
     session.refresh(user)
+    # 认证缓存中的用户快照包含当前使用的模型配置，修改后淘汰
+    global_principal_cache.invalidate_user(user.id)
     return user
 
 
@@ -183,3 +377,160 @@ def get_all_load_config_by_user_id(*, session: SessionDep, user_id) -> List[Load
     statement = select(LoadConfig).where(LoadConfig.user_id == user_id)
     session_load_configs = session.exec(statement).all()
     return session_load_configs
+
+
+# 以下为异步版本，供 async 路由使用，不阻塞事件循环
+
+async def acreate_file(session: AsyncSession, file_create: FileCreate) -> File:
+    db_obj = File.model_validate(file_create)
+    session.add(db_obj)
+    await session.commit()
+    await session.refresh(db_obj)
+    return db_obj
+
+
+async def aget_file_by_hash(*, session: AsyncSession, file_hash: str, title_id: uuid.UUID) -> File | None:
+    statement = select(File).where(File.file_hash == file_hash, File.title_id == title_id)
+    return (await session.exec(statement)).first()
+
+
+async def aacquire_blob(*, session: AsyncSession, file_hash: str, size: int) -> None:
+    """
+    内容的引用计数加 1，不存在时创建。不提交，由调用方和文件记录一起提交
+    :param session:
+    :param file_hash:
+    :param size: 文件字节数
+    :return:
+    """
+    statement = insert(FileBlob).values(file_hash=file_hash, size=size, ref_count=1)
+    statement = statement.on_conflict_do_update(
+        index_elements=[FileBlob.file_hash],
+        set_={"ref_count": FileBlob.ref_count + 1},
+    )
+    await session.exec(statement)
+
+
+async def arelease_blob(*, session: AsyncSession, file_hash: str) -> bool:
+    """
+    内容的引用计数减 1。不提交，由调用方和文件记录一起提交；
+    计数为 0 的记录保留到提交后由 adelete_unreferenced_blob 和文件一起删除
+    :param session:
+    :param file_hash:
+    :return: 内容是否不再被引用
+    """
+    statement = select(FileBlob).where(FileBlob.file_hash == file_hash).with_for_update()
+    blob = (await session.exec(statement)).first()
+    if blob is None:
+        return False
+    blob.ref_count = max(blob.ref_count - 1, 0)
+    session.add(blob)
+    return blob.ref_count == 0
+
+
+async def adelete_unreferenced_blob(*, session: AsyncSession, file_hash: str) -> bool:
+    """
+    锁住引用计数为 0 的内容记录并删除，不提交。调用方删除磁盘文件后提交，
+    期间并发上传相同内容的引用计数加 1 等待提交，不会在文件删除后引用到已删除的内容
+    :param session:
+    :param file_hash:
+    :return: 内容是否仍不被引用，为 True 时调用方删除对应的文件
+    """
+    statement = select(FileBlob).where(FileBlob.file_hash == file_hash, FileBlob.ref_count <= 0).with_for_update()
+    blob = (await session.exec(statement)).first()
+    if blob is None:
+        return False
+    await session.delete(blob)
+    return True
+
+
+async def aget_chroma_doc_ids_by_file_id(*, session: AsyncSession, file_id: uuid.UUID) -> List[str]:
+    statement = select(DocumentChunk.chroma_doc_id).where(DocumentChunk.document_id == file_id)
+    return list((await session.exec(statement)).all())
+
+
+async def adelete_doc_chunks_by_file_id(*, session: AsyncSession, file_id: uuid.UUID) -> int:
+    """
+    一条 delete 语句删除文件的段落记录，不提交
+    :param session:
+    :param file_id:
+    :return: 删除的记录数
+    """
+    result = await session.exec(delete(DocumentChunk).where(DocumentChunk.document_id == file_id))
+    return result.rowcount
+
+
+async def aretry_failed_file(*, session: AsyncSession, file_id: uuid.UUID) -> File | None:
+    """
+    入库失败的文件重置为待处理，已完成的批次重新处理时跳过。并发重试时只有一个请求成功
+    :param session:
+    :param file_id:
+    :return: 重置后的文件，文件不是失败状态时返回 None
+    """
+    result = await session.exec(
+        update(File).where(File.id == file_id, File.status == FileStatus.FAILED.value)
+        .values(status=FileStatus.LOADED.value, error_msg=None, status_update_at=datetime.now(),
+                lease_owner=None, lease_expire_at=None)
+    )
+    await session.commit()
+    if result.rowcount != 1:
+        return None
+    return await session.get(File, file_id, populate_existing=True)
+
+
+async def aget_file_by_name(*, session: AsyncSession, filename: str, title_id: uuid.UUID) -> File | None:
+    statement = select(File).where(File.filename == filename, File.title_id == title_id)
+    return (await session.exec(statement)).first()
+
+
+async def aupload_query_config(*, session: AsyncSession, user_id: uuid.UUID, query_config: LLmConfig) -> QueryConfig:
+    db_obj = QueryConfig.model_validate(query_config, update={"user_id": user_id})
+    session.add(db_obj)
+    await session.commit()
+    await session.refresh(db_obj)
+    return db_obj
+
+
+async def aget_query_config_by_id(*, session: AsyncSession, user_id: uuid.UUID,
+                                  query_config_id: uuid.UUID) -> QueryConfig | None:
+    statement = select(QueryConfig).where(
+        QueryConfig.user_id == user_id,
+        QueryConfig.id == query_config_id
+    )
+    return (await session.exec(statement)).first()
+
+
+async def aget_all_query_config_by_user_id(*, session: AsyncSession, user_id: uuid.UUID) -> List[QueryConfig]:
+    statement = select(QueryConfig).where(QueryConfig.user_id == user_id)
+    return (await session.exec(statement)).all()
+
+
+async def acreate_load_config(*, session: AsyncSession, load_llm_config: LoadConfigCreate) -> LoadConfig:
+    db_obj = LoadConfig.model_validate(load_llm_config)
+    session.add(db_obj)
+    await session.commit()
+    await session.refresh(db_obj)
+    return db_obj
+
+
+async def aget_load_config_by_id(*, session: AsyncSession, user_id: uuid.UUID,
+                                 load_config_id: uuid.UUID) -> LoadConfig | None:
+    statement = select(LoadConfig).where(
+        LoadConfig.user_id == user_id,
+        LoadConfig.id == load_config_id
+    )
+    return (await session.exec(statement)).first()
+
+
+async def aget_all_load_config_by_user_id(*, session: AsyncSession, user_id: uuid.UUID) -> List[LoadConfig]:
+    statement = select(LoadConfig).where(LoadConfig.user_id == user_id)
+    return (await session.exec(statement)).all()
+
+
+async def aget_files_by_title_id(*, session: AsyncSession, title_id: uuid.UUID) -> List[File]:
+    statement = select(File).where(File.title_id == title_id)
+    return list((await session.exec(statement)).all())
+
+
+async def aget_title_ids_by_load_config_id(*, session: AsyncSession, load_config_id: uuid.UUID) -> List[uuid.UUID]:
+    statement = select(Title.id).where(Title.load_config_id == load_config_id)
+    return list((await session.exec(statement)).all())
@@ -3,6 +3,7 @@ from starlette.middleware.cors import CORSMiddleware
 
 from app.api.router_main import api_router
 from app.retriever.load_file_thread import load_file_thread
+from app.service.title_version import title_version_registry
 
 app = FastAPI(
     title="BoringChatbot",
@@ -20,4 +21,12 @@ app.include_router(api_router, prefix="/api/v1")
 async def startup_event():
     # llm_manager.load()
     load_file_thread.load()
+    # 订阅 title 版本变化，其他 worker 上的文件、配置变化后失效本地缓存
+    title_version_registry.start()
     # query_answers.load()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    title_version_registry.stop()
+    load_file_thread.stop()
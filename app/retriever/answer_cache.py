@@ -0,0 +1,181 @@
+import math
+import operator
+import threading
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from app.retriever.cached_embeddings import normalize_question
+from app.settings import settings
+from app.utils.lru_cache import LRUCache
+
+# 回放缓存答案时每个 SSE 事件的字符数
+REPLAY_CHUNK_CHARS = 16
+
+
+@dataclass
+class CachedAnswer:
+    question: str = field(metadata={"description": "归一化后的问题"})
+    answer: str = field(metadata={"description": "答案"})
+
+
+def normalize_vector(vector: List[float]) -> Optional[List[float]]:
+    norm = math.sqrt(sum(value * value for value in vector))
+    if norm == 0:
+        return None
+    return [value / norm for value in vector]
+
+
+def split_answer(answer: str, chunk_chars: int = REPLAY_CHUNK_CHARS) -> List[str]:
+    """
+    按固定长度切分答案，回放缓存答案时模拟流式输出
+    :param answer:
+    :param chunk_chars:
+    :return:
+    """
+    return [answer[i:i + chunk_chars] for i in range(0, len(answer), chunk_chars)] or [""]
+
+
+class AnswerCache:
+    """
+    问答缓存：key 为 (title_id, 加载配置id, 查询配置id, 归一化问题)。
+    可选语义命中：同一 (title_id, 加载配置id, 查询配置id) 下问题向量余弦相似度不低于阈值时返回已有答案。
+    title 下的文件变化时按 title 失效
+    """
+
+    def __init__(self, max_size: int = 4096, ttl: Optional[float] = None,
+                 similarity_threshold: Optional[float] = None, semantic_max_per_scope: int = 200):
+        """
+        :param max_size: 最大缓存答案数
+        :param ttl: 空闲过期时间（秒）
+        :param similarity_threshold: 语义命中阈值，None 表示只精确匹配
+        :param semantic_max_per_scope: 每个范围内参与语义匹配的最近问题数
+        """
+        self.similarity_threshold = similarity_threshold
+        self.semantic_max_per_scope = semantic_max_per_scope
+        self.answers = LRUCache(max_size=max_size, idle_ttl=ttl, on_evict=self._on_evict)
+        # (title_id, 加载配置id, 查询配置id) -> {归一化问题: 归一化问题向量}
+        self.vectors_by_scope: Dict[Tuple, OrderedDict[str, List[float]]] = {}
+        # title_id -> 失效次数，生成答案期间 title 失效时不写入缓存
+        self.generation_by_title: Dict[uuid.UUID, int] = {}
+        self.lock = threading.Lock()
+        self.semantic_hits = 0
+
+    @staticmethod
+    def get_scope(title_id: uuid.UUID, load_config_id: Optional[uuid.UUID],
+                  llm_config_id: Optional[uuid.UUID]) -> Tuple:
+        return uuid.UUID(str(title_id)), load_config_id, llm_config_id
+
+    def get_generation(self, title_id: uuid.UUID) -> int:
+        with self.lock:
+            return self.generation_by_title.get(uuid.UUID(str(title_id)), 0)
+
+    def _on_evict(self, key: Hashable, value: CachedAnswer):
+        with self.lock:
+            vectors = self.vectors_by_scope.get(key[:3], None)
+            if vectors is not None:
+                vectors.pop(key[3], None)
+                if not vectors:
+                    self.vectors_by_scope.pop(key[:3], None)
+
+    def _semantic_match(self, scope: Tuple, vector: List[float]) -> Optional[str]:
+        with self.lock:
+            vectors = list(self.vectors_by_scope.get(scope, {}).items())
+        best_question = None
+        best_similarity = self.similarity_threshold
+        for question, cached_vector in vectors:
+            similarity = sum(map(operator.mul, vector, cached_vector))
+            if similarity >= best_similarity:
+                best_question = question
+                best_similarity = similarity
+        return best_question
+
+    def get(self, scope: Tuple, question: str, vector: Optional[List[float]] = None) -> Optional[str]:
+        """
+        查询缓存答案
+        :param scope: get_scope 返回值
+        :param question: 问题
+        :param vector: 问题向量，为 None 或未设置阈值时只精确匹配
+        :return: 答案，未命中返回 None
+        """
+        question = normalize_question(question)
+        cached_answer = self.answers.get((*scope, question), None)
+        if cached_answer is not None:
+            return cached_answer.answer
+        if self.similarity_threshold is None or vector is None:
+            return None
+        vector = normalize_vector(vector)
+        matched_question = self._semantic_match(scope, vector) if vector is not None else None
+        if matched_question is None:
+            return None
+        cached_answer = self.answers.get((*scope, matched_question), None)
+        if cached_answer is None:
+            return None
+        with self.lock:
+            self.semantic_hits += 1
+        print(f'answer cache semantic hit: {question} -> {matched_question}')
+        return cached_answer.answer
+
+    def put(self, scope: Tuple, question: str, answer: str, vector: Optional[List[float]] = None,
+            generation: Optional[int] = None):
+        """
+        写入缓存答案
+        :param scope: get_scope 返回值
+        :param question: 问题
+        :param answer: 答案
+        :param vector: 问题向量，用于语义匹配
+        :param generation: 开始生成答案时 get_generation 的返回值，之后 title 失效过则不写入
+        :return:
+        """
+        if generation is not None and generation != self.get_generation(scope[0]):
+            return
+        question = normalize_question(question)
+        self.answers.put((*scope, question), CachedAnswer(question=question, answer=answer))
+        if self.similarity_threshold is None or vector is None:
+            return
+        vector = normalize_vector(vector)
+        if vector is None:
+            return
+        with self.lock:
+            vectors = self.vectors_by_scope.setdefault(scope, OrderedDict())
+            vectors[question] = vector
+            vectors.move_to_end(question)
+            while len(vectors) > self.semantic_max_per_scope:
+                vectors.popitem(last=False)
+
+    def invalidate_title(self, title_id: uuid.UUID) -> int:
+        """
+        title 下的文件变化后，删除该 title 的所有缓存答案
+        :param title_id:
+        :return: 删除的答案数
+        """
+        title_id = uuid.UUID(str(title_id))
+        with self.lock:
+            self.generation_by_title[title_id] = self.generation_by_title.get(title_id, 0) + 1
+        count = self.answers.remove_if(lambda key: key[0] == title_id)
+        with self.lock:
+            for scope in [scope for scope in self.vectors_by_scope.keys() if scope[0] == title_id]:
+                self.vectors_by_scope.pop(scope, None)
+        if count:
+            print(f'invalidate answer cache, title: {title_id}, answers: {count}')
+        return count
+
+    def invalidate_all(self):
+        with self.lock:
+            for title_id in self.generation_by_title.keys():
+                self.generation_by_title[title_id] += 1
+        self.answers.clear()
+        with self.lock:
+            self.vectors_by_scope.clear()
+
+    def stats(self) -> Dict[str, int]:
+        stats = self.answers.stats()
+        with self.lock:
+            stats["semantic_hits"] = self.semantic_hits
+        return stats
+
+
+global_answer_cache = AnswerCache(max_size=settings.ANSWER_CACHE_MAX_SIZE,
+                                  ttl=settings.ANSWER_CACHE_TTL_SECONDS,
+                                  similarity_threshold=settings.ANSWER_CACHE_SIMILARITY_THRESHOLD)
@@ -0,0 +1,269 @@
+import hashlib
+import queue
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from http import HTTPStatus
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Callable, Optional, Dict
+
+import dashscope
+import redis
+from langchain_community.embeddings import DashScopeEmbeddings
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables.config import run_in_executor
+from langchain_core.stores import ByteStore
+
+from app.settings import settings
+from app.utils.lru_cache import LRUCache
+
+
+def normalize_question(text: str) -> str:
+    """
+    问题归一化：全角转半角、合并空白、转小写，使写法略有差异的相同问题命中同一个缓存
+    :param text:
+    :return:
+    """
+    text = unicodedata.normalize("NFKC", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.lower()
+
+
+def vector_to_bytes(vector: List[float]) -> bytes:
+    return array("f", vector).tobytes()
+
+
+def bytes_to_vector(data: bytes) -> List[float]:
+    vector = array("f")
+    vector.frombytes(data)
+    return vector.tolist()
+
+
+class QueryEmbeddingBatcher:
+    """
+    查询向量微批处理：在很短的时间窗口内收集并发的查询，合并成一次批量请求
+    """
+
+    def __init__(self, embed_batch: Callable[[List[str]], List[List[float]]],
+                 max_wait_ms: int = 5, max_batch_size: int = 25, max_in_flight: int = 4):
+        """
+        :param embed_batch: 批量嵌入函数
+        :param max_wait_ms: 收集一批请求的最长等待时间（毫秒）
+        :param max_batch_size: 一批最多的请求数
+        :param max_in_flight: 同时进行中的批量请求数
+        """
+        self.embed_batch = embed_batch
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        # None 表示关闭
+        self.request_queue: queue.Queue[Optional[tuple[str, Future]]] = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.collect_thread = None
+        self.closed = False
+        self.lock = threading.Lock()
+        self.batch_count = 0
+        self.request_count = 0
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        with self.lock:
+            closed = self.closed
+            if not closed:
+                if self.collect_thread is None:
+                    self.collect_thread = threading.Thread(target=self.collect_loop, daemon=True)
+                    self.collect_thread.start()
+                self.request_queue.put((text, future))
+        if closed:
+            # 关闭后仍在使用旧模型的请求直接嵌入，不再合并
+            self.run_batch([(text, future)])
+        return future
+
+    def collect_loop(self):
+        closing = False
+        while not closing:
+            item = self.request_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.request_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+            self.executor.submit(self.run_batch, batch)
+        # 已经提交的批次执行完后线程池退出
+        self.executor.shutdown(wait=False)
+
+    def close(self):
+        """
+        停止收集线程和线程池，关闭前已经提交的请求仍会完成
+        :return:
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.collect_thread is None:
+                self.executor.shutdown(wait=False)
+            else:
+                self.request_queue.put(None)
+
+    def run_batch(self, batch: List[tuple[str, Future]]):
+        # 同一批中相同的问题只嵌入一次
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            vectors = self.embed_batch(texts)
+            vector_by_text = dict(zip(texts, vectors))
+            for text, future in batch:
+                future.set_result(vector_by_text[text])
+        except Exception as e:
+            print(f'Error: embed query batch failed, size: {len(texts)}, reason: {e}')
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        with self.lock:
+            self.batch_count += 1
+            self.request_count += len(batch)
+
+
+def dashscope_embed_queries(embeddings: DashScopeEmbeddings, texts: List[str]) -> List[List[float]]:
+    """
+    使用 dashscope SDK 批量生成 query 类型的向量，dashscope 的 query 向量和 document 向量不同，
+    langchain 的 embed_documents 只能生成 document 类型
+    :param embeddings: 提供模型名称和 api key
+    :param texts:
+    :return: 与 texts 顺序一致的向量
+    """
+    response = dashscope.TextEmbedding.call(model=embeddings.model, input=texts, text_type="query",
+                                            api_key=embeddings.dashscope_api_key)
+    if response.status_code != HTTPStatus.OK:
+        raise Exception(f'dashscope embed query failed, code: {response.code}, message: {response.message}')
+    items = sorted(response.output["embeddings"], key=lambda item: item["text_index"])
+    return [item["embedding"] for item in items]
+
+
+def get_text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    带缓存的嵌入模型：
+    查询向量：进程内 LRU 缓存 + 可选 Redis 共享缓存，未命中的查询经微批处理后批量请求嵌入模型。
+    文档向量：按段落内容寻址的持久化缓存，只有未命中的段落请求嵌入模型
+    """
+
+    def __init__(self, embeddings: Embeddings, namespace: str, document_store: Optional[ByteStore] = None,
+                 document_embeddings: Optional[Embeddings] = None):
+        """
+        :param embeddings: 原嵌入模型
+        :param namespace: 缓存命名空间，由嵌入模型名称和向量维度组成，不同模型的向量不能混用
+        :param document_store: 文档向量持久化存储，None 时不缓存文档向量
+        :param document_embeddings: 嵌入文档使用的模型，由入库流水线负责重试时传入不重试的客户端，None 时使用 embeddings
+        """
+        self.embeddings = embeddings
+        self.document_embeddings = document_embeddings or embeddings
+        self.namespace = namespace
+        self.document_store = document_store
+        self.document_hits = 0
+        self.document_misses = 0
+        self.query_cache = LRUCache(max_size=settings.QUERY_EMBEDDING_CACHE_MAX_SIZE,
+                                    idle_ttl=settings.QUERY_EMBEDDING_CACHE_TTL_SECONDS)
+        self.redis_client = redis.from_url(settings.QUERY_EMBEDDING_REDIS_URL) \
+            if settings.QUERY_EMBEDDING_REDIS_URL else None
+        self.batcher = QueryEmbeddingBatcher(self.embed_query_batch,
+                                             max_wait_ms=settings.QUERY_EMBEDDING_BATCH_WAIT_MS,
+                                             max_batch_size=settings.QUERY_EMBEDDING_BATCH_MAX_SIZE,
+                                             max_in_flight=settings.QUERY_EMBEDDING_BATCH_MAX_IN_FLIGHT)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.document_store is None:
+            return self.document_embeddings.embed_documents(texts)
+
+        keys = [f"{self.namespace}:{get_text_hash(text)}" for text in texts]
+        cached_values = self.document_store.mget(keys)
+        vectors: List[Optional[List[float]]] = [
+            bytes_to_vector(value) if value is not None else None for value in cached_values
+        ]
+        missing_index_list = [i for i, vector in enumerate(vectors) if vector is None]
+        self.document_hits += len(texts) - len(missing_index_list)
+        self.document_misses += len(missing_index_list)
+        if missing_index_list:
+            # 只请求未命中的段落，相同内容的段落只请求一次
+            missing_texts = list(dict.fromkeys(texts[i] for i in missing_index_list))
+            missing_vectors = self.document_embeddings.embed_documents(missing_texts)
+            vector_by_text = dict(zip(missing_texts, missing_vectors))
+            new_values = {}
+            for i in missing_index_list:
+                vectors[i] = vector_by_text[texts[i]]
+                new_values[keys[i]] = vector_to_bytes(vectors[i])
+            self.document_store.mset(list(new_values.items()))
+        return vectors
+
+    def embed_query_batch(self, texts: List[str]) -> List[List[float]]:
+        if isinstance(self.embeddings, DashScopeEmbeddings):
+            return dashscope_embed_queries(self.embeddings, texts)
+        return [self.embeddings.embed_query(text) for text in texts]
+
+    def _redis_key(self, text: str) -> str:
+        return f"query_embedding:{self.namespace}:{get_text_hash(text)}"
+
+    def _get_from_redis(self, text: str) -> Optional[List[float]]:
+        if self.redis_client is None:
+            return None
+        try:
+            data = self.redis_client.get(self._redis_key(text))
+            return bytes_to_vector(data) if data else None
+        except Exception as e:
+            print(f'Error: get query embedding from redis failed. {e}')
+            return None
+
+    def _set_to_redis(self, text: str, vector: List[float]):
+        if self.redis_client is None:
+            return
+        try:
+            self.redis_client.set(self._redis_key(text), vector_to_bytes(vector),
+                                  ex=settings.QUERY_EMBEDDING_CACHE_TTL_SECONDS)
+        except Exception as e:
+            print(f'Error: set query embedding to redis failed. {e}')
+
+    def embed_query(self, text: str) -> List[float]:
+        # 归一化的问题只用作缓存键，嵌入模型仍使用原始问题
+        key = normalize_question(text)
+        vector = self.query_cache.get(key, None)
+        if vector is not None:
+            return vector
+        vector = self._get_from_redis(key)
+        if vector is None:
+            vector = self.batcher.submit(text).result()
+            self._set_to_redis(key, vector)
+        self.query_cache.put(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await run_in_executor(None, self.embed_query, text)
+
+    def close(self):
+        """
+        替换嵌入模型时关闭微批处理的线程，缓存随对象释放
+        :return:
+        """
+        self.batcher.close()
+
+    def stats(self) -> Dict[str, int]:
+        stats = self.query_cache.stats()
+        stats["batches"] = self.batcher.batch_count
+        stats["batched_requests"] = self.batcher.request_count
+        stats["document_hits"] = self.document_hits
+        stats["document_misses"] = self.document_misses
+        return stats
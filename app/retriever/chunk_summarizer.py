@@ -0,0 +1,151 @@
+import hashlib
+import re
+from typing import List, Optional
+
+from langchain_core.documents import Document
+from langchain_core.language_models import BaseChatModel
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.stores import ByteStore
+
+from app.utils.utils_tools import estimate_tokens
+
+SINGLE_PROMPT_TEXT = """You are an assistant tasked with summarizing tables and text.
+Give a concise summary of the table or text. Table or text chunk: {element} """
+
+BATCH_PROMPT_TEXT = """You are an assistant tasked with summarizing tables and text.
+Give a concise summary of each of the following numbered table or text chunks.
+Return exactly one summary per chunk, each starting on a new line with the chunk marker, for example [[1]] summary.
+{element} """
+
+BATCH_SUMMARY_PATTERN = re.compile(r"\[\[(\d+)\]\]\s*(.*?)(?=\[\[\d+\]\]|\Z)", re.S)
+
+
+class ChunkSummarizer:
+    """
+    段落总结：过短的段落直接使用原文，命中缓存的段落不再请求，
+    其余段落按 token 预算把多个小段落合并到一次请求中，多个请求并发执行
+    """
+
+    def __init__(self, llm: BaseChatModel, model_key: str, cache_store: Optional[ByteStore] = None,
+                 max_concurrency: int = 5, max_batch_tokens: int = 3000, min_summary_chars: int = 200):
+        """
+        :param llm: 总结模型
+        :param model_key: 总结模型标识（模型名称和温度），作为缓存 key 的一部分
+        :param cache_store: 总结缓存，None 时不缓存
+        :param max_concurrency: 同时进行中的请求数
+        :param max_batch_tokens: 一次请求中合并的段落 token 上限
+        :param min_summary_chars: 短于该长度的段落不总结，直接使用原文
+        """
+        self.model_key = model_key
+        self.cache_store = cache_store
+        self.max_concurrency = max_concurrency
+        self.max_batch_tokens = max_batch_tokens
+        self.min_summary_chars = min_summary_chars
+        self.single_chain = {"element": lambda x: x} | ChatPromptTemplate.from_template(SINGLE_PROMPT_TEXT) | \
+            llm | StrOutputParser()
+        self.batch_chain = {"element": lambda x: x} | ChatPromptTemplate.from_template(BATCH_PROMPT_TEXT) | \
+            llm | StrOutputParser()
+
+    def get_cache_key(self, text: str) -> str:
+        return f"{self.model_key}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def pack_groups(self, texts: List[str]) -> List[List[str]]:
+        """
+        按 token 预算把段落分组，超过预算的段落单独一组
+        :param texts:
+        :return:
+        """
+        groups = []
+        group = []
+        group_tokens = 0
+        for text in texts:
+            tokens = estimate_tokens(text)
+            if group and group_tokens + tokens > self.max_batch_tokens:
+                groups.append(group)
+                group = []
+                group_tokens = 0
+            group.append(text)
+            group_tokens += tokens
+        if group:
+            groups.append(group)
+        return groups
+
+    def summarize_groups(self, groups: List[List[str]]) -> List[Optional[List[str]]]:
+        """
+        并发总结各组段落
+        :param groups:
+        :return: 每组的总结，解析失败的组为 None
+        """
+        inputs = []
+        for group in groups:
+            if len(group) == 1:
+                inputs.append(group[0])
+            else:
+                inputs.append("\n\n".join(f"[[{i + 1}]] {text}" for i, text in enumerate(group)))
+        single_index_list = [i for i, group in enumerate(groups) if len(group) == 1]
+        batch_index_list = [i for i, group in enumerate(groups) if len(group) > 1]
+        config = {"max_concurrency": self.max_concurrency}
+        outputs = [None] * len(groups)
+        if single_index_list:
+            results = self.single_chain.batch([inputs[i] for i in single_index_list], config, return_exceptions=True)
+            for i, result in zip(single_index_list, results):
+                outputs[i] = None if isinstance(result, Exception) else [result.strip()]
+        if batch_index_list:
+            results = self.batch_chain.batch([inputs[i] for i in batch_index_list], config, return_exceptions=True)
+            for i, result in zip(batch_index_list, results):
+                if isinstance(result, Exception):
+                    print(f'Error: summarize chunk group failed. {result}')
+                    continue
+                summary_by_index = {int(num): summary.strip() for num, summary in BATCH_SUMMARY_PATTERN.findall(result)}
+                summaries = [summary_by_index.get(j + 1, "") for j in range(len(groups[i]))]
+                # 模型没有按格式返回时，该组改为逐段总结
+                outputs[i] = summaries if all(summaries) else None
+        return outputs
+
+    def summarize(self, docs: List[Document]) -> List[str]:
+        """
+        输入分段后的源文件列表，输出每段话的总结列表
+        :param docs:
+        :return:
+        """
+        texts = [doc.page_content for doc in docs]
+        summary_by_text = {}
+        pending_texts = []
+        for text in dict.fromkeys(texts):
+            if len(text) < self.min_summary_chars:
+                summary_by_text[text] = text
+            else:
+                pending_texts.append(text)
+
+        if self.cache_store is not None and pending_texts:
+            cached_values = self.cache_store.mget([self.get_cache_key(text) for text in pending_texts])
+            for text, value in zip(pending_texts, cached_values):
+                if value is not None:
+                    summary_by_text[text] = value.decode("utf-8")
+            pending_texts = [text for text in pending_texts if text not in summary_by_text]
+        print(f'summarize chunks: {len(texts)}, need summarize: {len(pending_texts)}')
+
+        new_summaries = {}
+        groups = self.pack_groups(pending_texts)
+        outputs = self.summarize_groups(groups)
+        retry_texts = []
+        for group, summaries in zip(groups, outputs):
+            if summaries is None:
+                retry_texts.extend(group)
+            else:
+                new_summaries.update(zip(group, summaries))
+        if retry_texts:
+            retry_groups = [[text] for text in retry_texts]
+            for group, summaries in zip(retry_groups, self.summarize_groups(retry_groups)):
+                if summaries:
+                    new_summaries[group[0]] = summaries[0]
+                else:
+                    # 仍然失败时使用原文，保证段落可以被检索到，不写入缓存
+                    summary_by_text[group[0]] = group[0]
+
+        if self.cache_store is not None and new_summaries:
+            self.cache_store.mset([(self.get_cache_key(text), summary.encode("utf-8"))
+                                   for text, summary in new_summaries.items()])
+        summary_by_text.update(new_summaries)
+        return [summary_by_text[text] for text in texts]
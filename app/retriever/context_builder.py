@@ -0,0 +1,194 @@
+import threading
+from dataclasses import dataclass, field
+from typing import List, Optional, Set
+
+from langchain_core.documents import Document
+
+from app.retriever.lexical_index import tokenize
+from app.utils.utils_tools import estimate_tokens
+
+# 相邻段落之间重叠文本的最小长度，小于该长度不认为是重叠
+MIN_OVERLAP_CHARS = 20
+# 两个段落的词集合相似度超过该值时认为是重复段落
+NEAR_DUPLICATE_THRESHOLD = 0.9
+# 段落超出剩余预算时截断，剩余预算小于该 token 数时不再截断放入
+MIN_TRUNCATE_TOKENS = 50
+PASSAGE_SEPARATOR = "\n\n"
+
+
+@dataclass
+class Passage:
+    source: str = field(metadata={"description": "段落来源（文件）"})
+    start: int = field(metadata={"description": "起始段落序号"})
+    end: int = field(metadata={"description": "结束段落序号"})
+    text: str = field(metadata={"description": "合并后的文本"})
+    rank: int = field(metadata={"description": "包含段落在检索结果中的最高排名"})
+
+
+@dataclass
+class ContextResult:
+    text: str = field(metadata={"description": "上下文文本"})
+    original_tokens: int = field(metadata={"description": "检索段落直接拼接的 token 数"})
+    context_tokens: int = field(metadata={"description": "上下文 token 数"})
+    passages: int = field(default=0, metadata={"description": "上下文中的段落数"})
+    duplicates: int = field(default=0, metadata={"description": "去掉的重复段落数"})
+
+    @property
+    def saved_tokens(self) -> int:
+        return max(0, self.original_tokens - self.context_tokens)
+
+
+def get_overlap_length(previous: str, current: str, max_overlap: int) -> int:
+    """
+    previous 结尾和 current 开头的最长重叠长度
+    :param previous:
+    :param current:
+    :param max_overlap: 最大检查长度
+    :return:
+    """
+    max_overlap = min(max_overlap, len(previous), len(current))
+    for length in range(max_overlap, MIN_OVERLAP_CHARS - 1, -1):
+        if previous.endswith(current[:length]):
+            return length
+    return 0
+
+
+def get_source(document: Document) -> str:
+    return str(document.metadata.get("file_id", None) or document.metadata.get("source", ""))
+
+
+def get_chunk_index(document: Document) -> Optional[int]:
+    # 原始段落的 doc_id 为段落在文件中的序号
+    chunk_index = document.metadata.get("doc_id", None)
+    return chunk_index if isinstance(chunk_index, int) else None
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class ContextBuilder:
+    """
+    构建提示词上下文：合并同一文件中相邻、重叠的段落，去掉重复段落，按检索排名放入 token 预算
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.build_count = 0
+        self.original_tokens = 0
+        self.context_tokens = 0
+
+    @staticmethod
+    def merge_passages(documents: List[Document], max_overlap_chars: int) -> List[Passage]:
+        """
+        同一文件中序号相邻的段落合并为一段，去掉重叠部分
+        :param documents: 检索结果，按相关性排序
+        :param max_overlap_chars: 相邻段落的最大重叠长度，与切分时的 over_lap 一致
+        :return: 按最高排名排序的段落
+        """
+        passages = []
+        documents_by_source = {}
+        for rank, document in enumerate(documents):
+            documents_by_source.setdefault(get_source(document), []).append((rank, document))
+
+        for source, ranked_documents in documents_by_source.items():
+            indexed = [(get_chunk_index(document), rank, document) for rank, document in ranked_documents]
+            # 没有段落序号的段落不参与合并
+            passages.extend(
+                Passage(source=source, start=-1, end=-1, text=document.page_content, rank=rank)
+                for chunk_index, rank, document in indexed if chunk_index is None
+            )
+            indexed = sorted((item for item in indexed if item[0] is not None), key=lambda item: item[0])
+            current = None
+            for chunk_index, rank, document in indexed:
+                text = document.page_content
+                if current is not None and chunk_index <= current.end + 1:
+                    if chunk_index <= current.end and text in current.text:
+                        current.rank = min(current.rank, rank)
+                        continue
+                    overlap = get_overlap_length(current.text, text, max_overlap_chars)
+                    current.text = current.text + (text[overlap:] if overlap else "\n" + text)
+                    current.end = chunk_index
+                    current.rank = min(current.rank, rank)
+                    continue
+                if current is not None:
+                    passages.append(current)
+                current = Passage(source=source, start=chunk_index, end=chunk_index, text=text, rank=rank)
+            if current is not None:
+                passages.append(current)
+        passages.sort(key=lambda passage: passage.rank)
+        return passages
+
+    @staticmethod
+    def remove_duplicates(passages: List[Passage]) -> List[Passage]:
+        """
+        去掉与排名更高的段落内容重复、或被其包含的段落
+        :param passages: 按排名排序
+        :return:
+        """
+        kept = []
+        kept_terms = []
+        for passage in passages:
+            terms = set(tokenize(passage.text))
+            duplicate = any(
+                passage.text in kept_passage.text or jaccard(terms, kept_term_set) >= NEAR_DUPLICATE_THRESHOLD
+                for kept_passage, kept_term_set in zip(kept, kept_terms)
+            )
+            if not duplicate:
+                kept.append(passage)
+                kept_terms.append(terms)
+        return kept
+
+    def build(self, documents: List[Document], max_tokens: int, max_overlap_chars: int = 200) -> ContextResult:
+        """
+        构建上下文
+        :param documents: 检索结果，按相关性排序
+        :param max_tokens: 上下文最大 token 数
+        :param max_overlap_chars: 相邻段落的最大重叠长度
+        :return:
+        """
+        original_tokens = estimate_tokens(PASSAGE_SEPARATOR.join(document.page_content for document in documents))
+        passages = self.merge_passages(documents, max_overlap_chars)
+        unique_passages = self.remove_duplicates(passages)
+
+        texts = []
+        used_tokens = 0
+        for passage in unique_passages:
+            remaining = max_tokens - used_tokens
+            if remaining <= 0:
+                break
+            tokens = estimate_tokens(passage.text)
+            if tokens > remaining:
+                if remaining < MIN_TRUNCATE_TOKENS:
+                    break
+                # 按 token 比例截断
+                texts.append(passage.text[:int(len(passage.text) * remaining / tokens)])
+                used_tokens = max_tokens
+                break
+            texts.append(passage.text)
+            used_tokens += tokens
+
+        text = PASSAGE_SEPARATOR.join(texts)
+        result = ContextResult(text=text, original_tokens=original_tokens, context_tokens=estimate_tokens(text),
+                               passages=len(texts), duplicates=len(passages) - len(unique_passages))
+        with self.lock:
+            self.build_count += 1
+            self.original_tokens += result.original_tokens
+            self.context_tokens += result.context_tokens
+        print(f'build context, chunks: {len(documents)}, passages: {result.passages}, '
+              f'duplicates: {result.duplicates}, tokens: {result.context_tokens}, saved tokens: {result.saved_tokens}')
+        return result
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "builds": self.build_count,
+                "original_tokens": self.original_tokens,
+                "context_tokens": self.context_tokens,
+                "saved_tokens": max(0, self.original_tokens - self.context_tokens),
+            }
+
+
+global_context_builder = ContextBuilder()
@@ -0,0 +1,127 @@
+import json
+import uuid
+import zlib
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.stores import BaseStore
+from sqlalchemy import delete
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import Session, select
+
+from app.api.deps import engine
+from app.db_model import ParentDocument
+from app.settings import settings
+from app.utils.lru_cache import LRUCache
+
+# 每次查询、写入的最大条数
+DOC_STORE_BATCH_SIZE = 500
+
+
+def encode_document(document: Document, compress_threshold: int) -> Tuple[bytes, bool]:
+    """
+    序列化段落，超过阈值时压缩
+    :param document:
+    :param compress_threshold: 压缩阈值（字节）
+    :return: (内容, 是否压缩)
+    """
+    data = json.dumps({"page_content": document.page_content, "metadata": document.metadata},
+                      ensure_ascii=False).encode("utf-8")
+    if len(data) > compress_threshold:
+        compressed_data = zlib.compress(data, 6)
+        if len(compressed_data) < len(data):
+            return compressed_data, True
+    return data, False
+
+
+def decode_document(content: bytes, compressed: bool) -> Document:
+    data = zlib.decompress(content) if compressed else content
+    value = json.loads(data.decode("utf-8"))
+    return Document(page_content=value["page_content"], metadata=value["metadata"])
+
+
+class PostgresDocStore(BaseStore[str, Document]):
+    """
+    持久化的父文档存储，保存在 parent_documents 表中，多个 worker 共用，重启后不丢失。
+    前面有一层进程内 LRU 缓存
+    """
+
+    def __init__(self, compress_threshold: int = 1024, cache_max_size: int = 2048):
+        """
+        :param compress_threshold: 超过该字节数的段落压缩保存
+        :param cache_max_size: 进程内缓存的段落数，0 表示不缓存
+        """
+        self.compress_threshold = compress_threshold
+        self.cache = LRUCache(max_size=cache_max_size) if cache_max_size > 0 else None
+
+    def mget(self, keys: Sequence[str]) -> List[Optional[Document]]:
+        document_by_key = {}
+        missing_keys = []
+        for key in keys:
+            document = self.cache.get(key, None) if self.cache is not None else None
+            if document is None:
+                missing_keys.append(key)
+            else:
+                document_by_key[key] = document
+
+        with Session(engine) as session:
+            for i in range(0, len(missing_keys), DOC_STORE_BATCH_SIZE):
+                batch = missing_keys[i:i + DOC_STORE_BATCH_SIZE]
+                statement = select(ParentDocument).where(ParentDocument.doc_id.in_(batch))
+                for row in session.exec(statement).all():
+                    document = decode_document(row.content, row.compressed)
+                    document_by_key[row.doc_id] = document
+                    if self.cache is not None:
+                        self.cache.put(row.doc_id, document)
+        return [document_by_key.get(key, None) for key in keys]
+
+    def mset(self, key_value_pairs: Sequence[Tuple[str, Document]]) -> None:
+        """
+        保存段落，段落的 metadata 中需要有 file_id，删除文件时级联删除
+        :param key_value_pairs:
+        :return:
+        """
+        rows = []
+        for key, document in key_value_pairs:
+            content, compressed = encode_document(document, self.compress_threshold)
+            rows.append({
+                "doc_id": key,
+                "document_id": uuid.UUID(str(document.metadata["file_id"])),
+                "content": content,
+                "compressed": compressed,
+            })
+        with Session(engine) as session:
+            for i in range(0, len(rows), DOC_STORE_BATCH_SIZE):
+                statement = insert(ParentDocument).values(rows[i:i + DOC_STORE_BATCH_SIZE])
+                statement = statement.on_conflict_do_update(
+                    index_elements=[ParentDocument.doc_id],
+                    set_={"content": statement.excluded.content, "compressed": statement.excluded.compressed}
+                )
+                session.exec(statement)
+            session.commit()
+        if self.cache is not None:
+            for key, document in key_value_pairs:
+                self.cache.put(key, document)
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        with Session(engine) as session:
+            for i in range(0, len(keys), DOC_STORE_BATCH_SIZE):
+                batch = list(keys[i:i + DOC_STORE_BATCH_SIZE])
+                session.exec(delete(ParentDocument).where(ParentDocument.doc_id.in_(batch)))
+            session.commit()
+        if self.cache is not None:
+            for key in keys:
+                self.cache.pop(key)
+
+    def yield_keys(self, *, prefix: Optional[str] = None) -> Iterator[str]:
+        with Session(engine) as session:
+            statement = select(ParentDocument.doc_id)
+            if prefix is not None:
+                statement = statement.where(ParentDocument.doc_id.startswith(prefix))
+            for key in session.exec(statement):
+                yield key
+
+
+def create_parent_doc_store() -> PostgresDocStore:
+    return PostgresDocStore(compress_threshold=settings.PARENT_DOC_COMPRESS_THRESHOLD,
+                            cache_max_size=settings.PARENT_DOC_CACHE_MAX_SIZE)
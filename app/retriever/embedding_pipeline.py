@@ -0,0 +1,162 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import List, Callable, Optional
+
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    """
+    判断是否为限流错误，dashscope 限流时返回 429 / Throttling
+    :param e:
+    :return:
+    """
+    message = str(e)
+    return "429" in message or "Throttling" in message or "rate limit" in message.lower()
+
+
+class AdaptiveLimiter:
+    """
+    自适应并发限制：遇到限流时并发数减半并退避等待，连续成功后逐步恢复并发数
+    """
+
+    def __init__(self, max_concurrency: int, max_backoff_seconds: float = 30):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.max_backoff_seconds = max_backoff_seconds
+        self.backoff_seconds = 0.0
+        self.backoff_until = 0.0
+        self.in_flight = 0
+        self.success_count = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                wait_seconds = self.backoff_until - time.monotonic()
+                if wait_seconds > 0:
+                    self.cond.wait(wait_seconds)
+                    continue
+                if self.in_flight < self.limit:
+                    break
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, rate_limited: bool = False):
+        with self.cond:
+            self.in_flight -= 1
+            if rate_limited:
+                self.limit = max(1, self.limit // 2)
+                self.backoff_seconds = min(self.max_backoff_seconds, max(1.0, self.backoff_seconds * 2))
+                self.backoff_until = time.monotonic() + self.backoff_seconds
+                self.success_count = 0
+                print(f'embedding rate limited, concurrency: {self.limit}, backoff: {self.backoff_seconds}s')
+            else:
+                self.backoff_seconds = 0.0
+                self.success_count += 1
+                # 当前并发数下连续成功一轮后并发数加 1
+                if self.success_count >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self.success_count = 0
+            self.cond.notify_all()
+
+
+@dataclass
+class ChunkBatch:
+    batch_index: int = field(metadata={"description": "批次序号"})
+    ids: List[str] = field(metadata={"description": "段落在向量数据库中的id"})
+    documents: List[Document] = field(metadata={"description": "段落"})
+
+
+@dataclass
+class PipelineResult:
+    done_batches: int = field(default=0, metadata={"description": "完成的批次数"})
+    done_chunks: int = field(default=0, metadata={"description": "完成的段落数"})
+    errors: List[str] = field(default_factory=list, metadata={"description": "失败批次的错误信息"})
+
+
+class EmbeddingPipeline:
+    """
+    文档入库流水线：段落分批，多个批次并发嵌入（遇到限流自适应降低并发），每批嵌入完成后写入向量数据库，
+    并回调保存该批次的段落记录，失败的文件可以从已完成的批次之后继续
+    """
+
+    def __init__(self, batch_size: int = 25, max_concurrency: int = 4, max_retries: int = 3):
+        """
+        :param batch_size: 每批段落数
+        :param max_concurrency: 同时进行中的嵌入请求数
+        :param max_retries: 每批最大重试次数
+        """
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        # 所有文件共用并发限制，整体请求速率不超过嵌入模型的限流
+        self.limiter = AdaptiveLimiter(max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def make_batches(self, ids: List[str], documents: List[Document]) -> List[ChunkBatch]:
+        return [
+            ChunkBatch(batch_index=i // self.batch_size,
+                       ids=ids[i:i + self.batch_size],
+                       documents=documents[i:i + self.batch_size])
+            for i in range(0, len(documents), self.batch_size)
+        ]
+
+    def embed_batch(self, embeddings: Embeddings, batch: ChunkBatch) -> List[List[float]]:
+        texts = [doc.page_content for doc in batch.documents]
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            rate_limited = False
+            try:
+                return embeddings.embed_documents(texts)
+            except Exception as e:
+                rate_limited = is_rate_limit_error(e)
+                if attempt >= self.max_retries:
+                    raise
+                print(f'embed batch {batch.batch_index} failed, attempt: {attempt + 1}, reason: {e}')
+                if not rate_limited:
+                    time.sleep(min(2 ** attempt, 10))
+            finally:
+                self.limiter.release(rate_limited)
+
+    def process_batch(self, embeddings: Embeddings, vectorstore: Chroma, batch: ChunkBatch,
+                      on_batch_done: Optional[Callable[[ChunkBatch], None]]):
+        vectors = self.embed_batch(embeddings, batch)
+        # 指定 id 写入，重复执行时覆盖已有数据
+        vectorstore._collection.upsert(
+            ids=batch.ids,
+            embeddings=vectors,
+            documents=[doc.page_content for doc in batch.documents],
+            metadatas=[doc.metadata for doc in batch.documents],
+        )
+        if on_batch_done is not None:
+            on_batch_done(batch)
+
+    def run(self, embeddings: Embeddings, vectorstore: Chroma, batches: List[ChunkBatch],
+            on_batch_done: Optional[Callable[[ChunkBatch], None]] = None) -> PipelineResult:
+        """
+        并发处理所有批次，单个批次失败不影响其他批次
+        :param embeddings:
+        :param vectorstore:
+        :param batches:
+        :param on_batch_done: 每批写入向量数据库后的回调
+        :return:
+        """
+        result = PipelineResult()
+        futures = {
+            self.executor.submit(self.process_batch, embeddings, vectorstore, batch, on_batch_done): batch
+            for batch in batches
+        }
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                future.result()
+                result.done_batches += 1
+                result.done_chunks += len(batch.ids)
+            except Exception as e:
+                print(f'Error: batch {batch.batch_index} failed, reason: {e}')
+                result.errors.append(f'batch {batch.batch_index}: {e}')
+        return result
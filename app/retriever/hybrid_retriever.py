@@ -0,0 +1,59 @@
+import asyncio
+import uuid
+from typing import List, Sequence
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from app.retriever.lexical_index import LexicalIndexManager
+
+
+def reciprocal_rank_fusion(ranked_lists: Sequence[List[Document]], k: int = 60) -> List[Document]:
+    """
+    倒数排名融合：段落得分为其在各个结果列表中 1 / (k + 排名) 之和，按段落内容去重
+    :param ranked_lists: 各检索器的结果，按相关性从高到低排序
+    :param k: 平滑参数，越大排名靠后的段落权重越高
+    :return: 融合后按得分从高到低排序的段落
+    """
+    score_by_key = {}
+    document_by_key = {}
+    for documents in ranked_lists:
+        for rank, document in enumerate(documents):
+            key = document.page_content
+            score_by_key[key] = score_by_key.get(key, 0.0) + 1.0 / (k + rank + 1)
+            document_by_key.setdefault(key, document)
+    keys = sorted(score_by_key.keys(), key=lambda key: score_by_key[key], reverse=True)
+    return [document_by_key[key] for key in keys]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    混合检索：向量检索和 BM25 关键词检索各取 fetch_k 个候选，倒数排名融合后保留 top_k 个
+    """
+    vector_retriever: BaseRetriever
+    lexical_index_manager: LexicalIndexManager
+    title_id: uuid.UUID
+    top_k: int = 3
+    fetch_k: int = 10
+    rrf_k: int = 60
+
+    def lexical_search(self, query: str) -> List[Document]:
+        # 索引不存在时（title 下还没有入库的文件）只使用向量检索结果
+        lexical_index = self.lexical_index_manager.get_index(self.title_id, create=False)
+        if lexical_index is None:
+            return []
+        return [document for document, _ in lexical_index.search(query, self.fetch_k)]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        vector_documents = self.vector_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        lexical_documents = self.lexical_search(query)
+        return reciprocal_rank_fusion([vector_documents, lexical_documents], self.rrf_k)[:self.top_k]
+
+    async def _aget_relevant_documents(self, query: str, *,
+                                       run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        vector_documents, lexical_documents = await asyncio.gather(
+            self.vector_retriever.ainvoke(query, config={"callbacks": run_manager.get_child()}),
+            asyncio.to_thread(self.lexical_search, query),
+        )
+        return reciprocal_rank_fusion([vector_documents, lexical_documents], self.rrf_k)[:self.top_k]
@@ -0,0 +1,76 @@
+import os
+import sqlite3
+import threading
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.stores import ByteStore
+
+# sqlite 单条语句的参数个数有上限，批量操作时分批执行
+SQLITE_BATCH_SIZE = 500
+
+
+class SQLiteByteStore(ByteStore):
+    """
+    基于本地 sqlite 文件的持久化 key-value 存储，多线程、多进程可同时读写
+    """
+
+    def __init__(self, db_path: str, table: str = "kv_store"):
+        """
+        :param db_path: sqlite 文件路径
+        :param table: 表名
+        """
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db_path = db_path
+        self.table = table
+        # 每个线程使用自己的连接
+        self.local = threading.local()
+        connection = self._get_connection()
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+        connection.commit()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            # WAL 模式下读写互不阻塞
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def mget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        connection = self._get_connection()
+        value_by_key = {}
+        for i in range(0, len(keys), SQLITE_BATCH_SIZE):
+            batch = list(keys[i:i + SQLITE_BATCH_SIZE])
+            placeholders = ",".join("?" * len(batch))
+            rows = connection.execute(
+                f"SELECT key, value FROM {self.table} WHERE key IN ({placeholders})", batch
+            ).fetchall()
+            value_by_key.update(rows)
+        return [value_by_key.get(key, None) for key in keys]
+
+    def mset(self, key_value_pairs: Sequence[Tuple[str, bytes]]) -> None:
+        connection = self._get_connection()
+        with connection:
+            connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)", key_value_pairs
+            )
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        connection = self._get_connection()
+        with connection:
+            for i in range(0, len(keys), SQLITE_BATCH_SIZE):
+                batch = list(keys[i:i + SQLITE_BATCH_SIZE])
+                placeholders = ",".join("?" * len(batch))
+                connection.execute(f"DELETE FROM {self.table} WHERE key IN ({placeholders})", batch)
+
+    def yield_keys(self, *, prefix: Optional[str] = None) -> Iterator[str]:
+        connection = self._get_connection()
+        if prefix is None:
+            cursor = connection.execute(f"SELECT key FROM {self.table}")
+        else:
+            cursor = connection.execute(f"SELECT key FROM {self.table} WHERE substr(key, 1, ?) = ?",
+                                        (len(prefix), prefix))
+        for (key,) in cursor:
+            yield key
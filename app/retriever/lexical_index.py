@@ -0,0 +1,374 @@
+import math
+import os
+import re
+import sqlite3
+import threading
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import Session
+
+from app.api.deps import engine
+from app.db_model import LexicalChunk, LexicalPosting
+from app.retriever.doc_store import encode_document, decode_document
+
+# ascii 词：字母数字，允许中间带 - _ . / 连接（型号、错误码、版本号等）
+ASCII_TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+ASCII_SUB_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+CJK_RUN_PATTERN = re.compile("[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+# sqlite 单条语句的参数个数有上限，批量操作时分批执行
+SQLITE_BATCH_SIZE = 500
+# postgres 多行 insert 每批的行数
+POSTGRES_BATCH_SIZE = 1000
+# postgres 倒排表中词的最大长度，更长的词截断后保存和查询
+MAX_TERM_LENGTH = 128
+# BM25 参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 段落内容超过该字节数时压缩保存
+CONTENT_COMPRESS_THRESHOLD = 256
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    分词：ascii 词整体作为一个词，带连接符时同时拆成子词；中文按相邻两字切分（单字时保留单字）
+    :param text:
+    :return:
+    """
+    text = text.lower()
+    tokens = []
+    for match in ASCII_TOKEN_PATTERN.finditer(text):
+        token = match.group()
+        tokens.append(token)
+        sub_tokens = ASCII_SUB_TOKEN_PATTERN.findall(token)
+        if len(sub_tokens) > 1:
+            tokens.extend(sub_tokens)
+    for match in CJK_RUN_PATTERN.finditer(text):
+        run = match.group()
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def bm25_top_k(doc_count: int, avg_length: float, postings_by_term: Dict[str, List[Tuple[int, int]]],
+               length_by_chunk: Dict[int, int], k: int) -> List[Tuple[int, float]]:
+    """
+    BM25 打分
+    :param doc_count: 段落总数
+    :param avg_length: 段落平均词数
+    :param postings_by_term: 词 -> [(段落序号, 词频)]
+    :param length_by_chunk: 段落序号 -> 词数
+    :param k:
+    :return: [(段落序号, 得分)]，按得分从高到低排序的前 k 个
+    """
+    tf_by_chunk = {}
+    idf_by_term = {}
+    for term, postings in postings_by_term.items():
+        df = len(postings)
+        idf_by_term[term] = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+        for chunk, tf in postings:
+            tf_by_chunk.setdefault(chunk, []).append((term, tf))
+
+    scores = []
+    for chunk, term_tfs in tf_by_chunk.items():
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * length_by_chunk.get(chunk, avg_length) / avg_length)
+        score = sum(idf_by_term[term] * tf * (BM25_K1 + 1) / (tf + norm) for term, tf in term_tfs)
+        scores.append((chunk, score))
+    scores.sort(key=lambda item: item[1], reverse=True)
+    return scores[:k]
+
+
+class LexicalIndex:
+    """
+    单个 title 的本地倒排索引，保存在 sqlite 文件中，按 BM25 打分检索。
+    倒排表按 (词, 段落序号) 聚簇保存，段落内容压缩保存，按文件整体写入、删除
+    """
+
+    def __init__(self, db_path: str):
+        """
+        :param db_path: sqlite 文件路径
+        """
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db_path = db_path
+        # 每个线程使用自己的连接
+        self.local = threading.local()
+        connection = self._get_connection()
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "id INTEGER PRIMARY KEY, chunk_id TEXT NOT NULL UNIQUE, file_id TEXT NOT NULL, "
+                "length INTEGER NOT NULL, content BLOB NOT NULL, compressed INTEGER NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_chunks_file_id ON chunks (file_id)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS postings ("
+                "term TEXT NOT NULL, chunk INTEGER NOT NULL, tf INTEGER NOT NULL, "
+                "PRIMARY KEY (term, chunk)) WITHOUT ROWID"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_postings_chunk ON postings (chunk)")
+
+    def _get_connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            # WAL 模式下读写互不阻塞
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def _delete_file(self, connection: sqlite3.Connection, file_id: str):
+        connection.execute("DELETE FROM postings WHERE chunk IN (SELECT id FROM chunks WHERE file_id = ?)",
+                           (file_id,))
+        connection.execute("DELETE FROM chunks WHERE file_id = ?", (file_id,))
+
+    def index_file(self, file_id: uuid.UUID, chunk_ids: Sequence[str], documents: Sequence[Document]):
+        """
+        写入文件的所有段落，重复写入同一文件时先删除旧数据
+        :param file_id:
+        :param chunk_ids:
+        :param documents:
+        :return:
+        """
+        file_id = str(file_id)
+        connection = self._get_connection()
+        with connection:
+            self._delete_file(connection, file_id)
+            for chunk_id, document in zip(chunk_ids, documents):
+                term_counts = Counter(tokenize(document.page_content))
+                content, compressed = encode_document(document, CONTENT_COMPRESS_THRESHOLD)
+                cursor = connection.execute(
+                    "INSERT INTO chunks (chunk_id, file_id, length, content, compressed) VALUES (?, ?, ?, ?, ?)",
+                    (chunk_id, file_id, sum(term_counts.values()), content, compressed)
+                )
+                connection.executemany(
+                    "INSERT INTO postings (term, chunk, tf) VALUES (?, ?, ?)",
+                    [(term, cursor.lastrowid, tf) for term, tf in term_counts.items()]
+                )
+
+    def delete_file(self, file_id: uuid.UUID):
+        connection = self._get_connection()
+        with connection:
+            self._delete_file(connection, str(file_id))
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[Document, float]]:
+        """
+        BM25 检索
+        :param query:
+        :param k: 返回的段落数
+        :return: [(段落, 得分)]，按得分从高到低排序
+        """
+        query_terms = list(set(tokenize(query)))
+        if not query_terms or k <= 0:
+            return []
+        connection = self._get_connection()
+        doc_count, avg_length = connection.execute("SELECT COUNT(*), AVG(length) FROM chunks").fetchone()
+        if not doc_count:
+            return []
+        avg_length = avg_length or 1.0
+
+        # 词 -> [(段落序号, 词频)]
+        postings_by_term = {}
+        for i in range(0, len(query_terms), SQLITE_BATCH_SIZE):
+            batch = query_terms[i:i + SQLITE_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            for term, chunk, tf in connection.execute(
+                    f"SELECT term, chunk, tf FROM postings WHERE term IN ({placeholders})", batch):
+                postings_by_term.setdefault(term, []).append((chunk, tf))
+        if not postings_by_term:
+            return []
+
+        # 查询候选段落长度
+        chunks = list({chunk for postings in postings_by_term.values() for chunk, _ in postings})
+        length_by_chunk = {}
+        for i in range(0, len(chunks), SQLITE_BATCH_SIZE):
+            batch = chunks[i:i + SQLITE_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            length_by_chunk.update(connection.execute(
+                f"SELECT id, length FROM chunks WHERE id IN ({placeholders})", batch
+            ).fetchall())
+        top_scores = bm25_top_k(doc_count, avg_length, postings_by_term, length_by_chunk, k)
+
+        placeholders = ",".join("?" * len(top_scores))
+        rows = connection.execute(
+            f"SELECT id, chunk_id, content, compressed FROM chunks WHERE id IN ({placeholders})",
+            [chunk for chunk, _ in top_scores]
+        ).fetchall()
+        document_by_chunk = {}
+        for chunk, chunk_id, content, compressed in rows:
+            document = decode_document(content, bool(compressed))
+            document.id = chunk_id
+            document_by_chunk[chunk] = document
+        return [(document_by_chunk[chunk], score) for chunk, score in top_scores if chunk in document_by_chunk]
+
+    def close(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+class PostgresLexicalIndex:
+    """
+    单个 title 的倒排索引，保存在 postgres 的 lexical_chunks、lexical_postings 表中，
+    api 节点和 celery worker 共用。接口和 LexicalIndex 相同，删除文件时由外键级联删除
+    """
+
+    def __init__(self, title_id: uuid.UUID):
+        self.title_id = uuid.UUID(str(title_id))
+
+    def index_file(self, file_id: uuid.UUID, chunk_ids: Sequence[str], documents: Sequence[Document]):
+        """
+        写入文件的所有段落，重复写入同一文件时先删除旧数据
+        :param file_id:
+        :param chunk_ids:
+        :param documents:
+        :return:
+        """
+        file_id = uuid.UUID(str(file_id))
+        chunk_rows = []
+        term_counts_list = []
+        for chunk_id, document in zip(chunk_ids, documents):
+            term_counts = Counter(term[:MAX_TERM_LENGTH] for term in tokenize(document.page_content))
+            content, compressed = encode_document(document, CONTENT_COMPRESS_THRESHOLD)
+            chunk_rows.append({"chunk_id": chunk_id, "title_id": self.title_id, "file_id": file_id,
+                               "length": sum(term_counts.values()), "content": content, "compressed": compressed})
+            term_counts_list.append(term_counts)
+        with Session(engine) as session:
+            session.execute(delete(LexicalChunk).where(LexicalChunk.file_id == file_id))
+            id_by_chunk_id = {}
+            for i in range(0, len(chunk_rows), POSTGRES_BATCH_SIZE):
+                result = session.execute(
+                    insert(LexicalChunk).values(chunk_rows[i:i + POSTGRES_BATCH_SIZE])
+                    .returning(LexicalChunk.id, LexicalChunk.chunk_id))
+                id_by_chunk_id.update({chunk_id: chunk for chunk, chunk_id in result.all()})
+            posting_rows = [
+                {"title_id": self.title_id, "term": term, "chunk": id_by_chunk_id[row["chunk_id"]], "tf": tf}
+                for row, term_counts in zip(chunk_rows, term_counts_list)
+                for term, tf in term_counts.items()
+            ]
+            for i in range(0, len(posting_rows), POSTGRES_BATCH_SIZE):
+                session.execute(insert(LexicalPosting).values(posting_rows[i:i + POSTGRES_BATCH_SIZE]))
+            session.commit()
+
+    def delete_file(self, file_id: uuid.UUID):
+        with Session(engine) as session:
+            session.execute(delete(LexicalChunk).where(LexicalChunk.file_id == uuid.UUID(str(file_id))))
+            session.commit()
+
+    def delete_all(self):
+        with Session(engine) as session:
+            session.execute(delete(LexicalChunk).where(LexicalChunk.title_id == self.title_id))
+            session.commit()
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[Document, float]]:
+        """
+        BM25 检索
+        :param query:
+        :param k: 返回的段落数
+        :return: [(段落, 得分)]，按得分从高到低排序
+        """
+        query_terms = list({term[:MAX_TERM_LENGTH] for term in tokenize(query)})
+        if not query_terms or k <= 0:
+            return []
+        with Session(engine) as session:
+            doc_count, avg_length = session.execute(
+                select(func.count(LexicalChunk.id), func.avg(LexicalChunk.length))
+                .where(LexicalChunk.title_id == self.title_id)).one()
+            if not doc_count:
+                return []
+            avg_length = float(avg_length or 1.0)
+
+            # 一次查询得到倒排和候选段落长度
+            postings_by_term = {}
+            length_by_chunk = {}
+            rows = session.execute(
+                select(LexicalPosting.term, LexicalPosting.chunk, LexicalPosting.tf, LexicalChunk.length)
+                .join(LexicalChunk, LexicalChunk.id == LexicalPosting.chunk)
+                .where(LexicalPosting.title_id == self.title_id, LexicalPosting.term.in_(query_terms)))
+            for term, chunk, tf, length in rows:
+                postings_by_term.setdefault(term, []).append((chunk, tf))
+                length_by_chunk[chunk] = length
+            if not postings_by_term:
+                return []
+            top_scores = bm25_top_k(doc_count, avg_length, postings_by_term, length_by_chunk, k)
+
+            document_by_chunk = {}
+            rows = session.execute(
+                select(LexicalChunk.id, LexicalChunk.chunk_id, LexicalChunk.content, LexicalChunk.compressed)
+                .where(LexicalChunk.id.in_([chunk for chunk, _ in top_scores])))
+            for chunk, chunk_id, content, compressed in rows:
+                document = decode_document(content, bool(compressed))
+                document.id = chunk_id
+                document_by_chunk[chunk] = document
+        return [(document_by_chunk[chunk], score) for chunk, score in top_scores if chunk in document_by_chunk]
+
+    def close(self):
+        pass
+
+
+class LexicalIndexManager:
+    """
+    管理各 title 的倒排索引：sqlite 时每个 title 一个本地文件，postgres 时各节点共用数据库
+    """
+
+    def __init__(self, index_dir: str, backend: str = "sqlite"):
+        """
+        :param index_dir: sqlite 文件目录
+        :param backend: sqlite 或 postgres
+        """
+        if backend not in ("sqlite", "postgres"):
+            raise Exception(f'Error: lexical index backend {backend} is not supported.')
+        self.index_dir = index_dir
+        self.backend = backend
+        self.index_by_title = {}
+        self.lock = threading.Lock()
+
+    def get_index_path(self, title_id: uuid.UUID) -> str:
+        return os.path.join(self.index_dir, f'{uuid.UUID(str(title_id)).hex}.sqlite3')
+
+    def get_index(self, title_id: uuid.UUID, create: bool = True) -> Optional[LexicalIndex]:
+        """
+        获取 title 的倒排索引
+        :param title_id:
+        :param create: 索引文件不存在时是否创建
+        :return:
+        """
+        title_id = uuid.UUID(str(title_id))
+        if self.backend == "postgres":
+            # 没有数据时检索结果为空，不需要区分是否存在
+            return PostgresLexicalIndex(title_id)
+        with self.lock:
+            index = self.index_by_title.get(title_id, None)
+            if index is None:
+                index_path = self.get_index_path(title_id)
+                if not create and not os.path.exists(index_path):
+                    return None
+                index = LexicalIndex(index_path)
+                self.index_by_title[title_id] = index
+            return index
+
+    def delete_index(self, title_id: uuid.UUID):
+        """
+        删除 title 时删除索引文件
+        :param title_id:
+        :return:
+        """
+        title_id = uuid.UUID(str(title_id))
+        if self.backend == "postgres":
+            PostgresLexicalIndex(title_id).delete_all()
+            return
+        with self.lock:
+            index = self.index_by_title.pop(title_id, None)
+            if index is not None:
+                index.close()
+            index_path = self.get_index_path(title_id)
+            for path in (index_path, f'{index_path}-wal', f'{index_path}-shm'):
+                if os.path.exists(path):
+                    os.remove(path)
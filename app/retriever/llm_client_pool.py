@@ -0,0 +1,75 @@
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from langchain_openai import ChatOpenAI
+
+
+@dataclass(frozen=True)
+class LLmClientKey:
+    env: str = field(metadata={"description": "api key 环境变量"})
+    base_url: str = field(metadata={"description": "基础url"})
+    model: str = field(metadata={"description": "模型"})
+    temperature: float = field(metadata={"description": "温度"})
+
+
+class LLmClientPool:
+    """
+    进程内共享的大模型客户端池，相同配置的用户共用一个 ChatOpenAI 及其 http 连接池，
+    按引用计数管理，引用数为 0 时从池中移除
+    """
+
+    def __init__(self):
+        self.clients: Dict[LLmClientKey, ChatOpenAI] = {}
+        self.ref_counts: Dict[LLmClientKey, int] = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key: LLmClientKey) -> ChatOpenAI:
+        """
+        获取客户端，引用计数加 1，不存在时创建
+        :param key:
+        :return:
+        """
+        with self.lock:
+            client = self.clients.get(key, None)
+            if client is None:
+                client = ChatOpenAI(
+                    api_key=os.getenv(key.env),
+                    base_url=key.base_url,
+                    model=key.model,
+                    temperature=key.temperature
+                )
+                self.clients[key] = client
+                self.ref_counts[key] = 0
+                print(f'create llm client: {key}')
+            self.ref_counts[key] += 1
+            return client
+
+    def release(self, key: Optional[LLmClientKey]):
+        """
+        释放客户端，引用计数减 1，为 0 时从池中移除。
+        已经拿到客户端的对象仍可继续使用，不再被引用后由 gc 回收
+        :param key:
+        :return:
+        """
+        if key is None:
+            return
+        with self.lock:
+            if key not in self.ref_counts:
+                return
+            self.ref_counts[key] -= 1
+            if self.ref_counts[key] <= 0:
+                self.ref_counts.pop(key, None)
+                self.clients.pop(key, None)
+                print(f'remove unused llm client: {key}')
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "clients": len(self.clients),
+                "references": sum(self.ref_counts.values()),
+            }
+
+
+global_llm_client_pool = LLmClientPool()
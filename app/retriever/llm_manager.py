@@ -1,14 +1,14 @@
-import os
 import uuid
 from dataclasses import dataclass, field
-from typing import Dict
 
 from sqlmodel import Session
 
 from app.api.deps import SessionDep, engine
-from langchain_openai import ChatOpenAI
 
 from app.db_option import get_user_by_id, get_query_config_by_id
+from app.retriever.llm_client_pool import global_llm_client_pool, LLmClientKey
+from app.settings import settings
+from app.utils.lru_cache import LRUCache
 from app.utils.user_base_model import TaskConfig, BaseManager, LLmConfig, SummaryLLmConfig
 from app.utils.utils_tools import diff_models
 
@@ -25,6 +25,12 @@ global_llm_info_by_name = {
 }
 
 
+def get_llm_client_key(model_name: str, temperature: float) -> LLmClientKey:
+    llm_info = global_llm_info_by_name[model_name]
+    return LLmClientKey(env=llm_info.env, base_url=llm_info.base_url, model=llm_info.model,
+                        temperature=temperature)
+
+
 class LLmManager(BaseManager):
     def __init__(self, user_id: uuid.UUID = None):
         self.llm = None
@@ -33,6 +39,9 @@ class LLmManager(BaseManager):
         # todo: 增加一个专门用于总结文本的小模型，可以微调产生
         self.summary_llm = None
         self.summary_llm_name = ""
+        # 从共享客户端池获取的客户端 key，释放时使用
+        self.llm_client_key = None
+        self.summary_llm_client_key = None
         self.task_config: TaskConfig = TaskConfig()
         self.user_id = user_id
 
@@ -71,13 +80,11 @@ class LLmManager(BaseManager):
             model_name = llm_config.llm_name
             if global_llm_info_by_name.get(model_name, None) is None:
                 raise Exception(f"model_name: {model_name} not found")
-            # 大模型
-            self.llm = ChatOpenAI(
-                api_key=os.getenv(global_llm_info_by_name[model_name].env),
-                base_url=global_llm_info_by_name[model_name].base_url,
-                model=global_llm_info_by_name[model_name].model,
-                temperature=llm_config.temperature
-            )
+            # 大模型，相同配置的用户共用一个客户端
+            old_client_key = self.llm_client_key
+            self.llm_client_key = get_llm_client_key(model_name, llm_config.temperature)
+            self.llm = global_llm_client_pool.acquire(self.llm_client_key)
+            global_llm_client_pool.release(old_client_key)
             print('update llm')
         else:
             print('no need update llm')
@@ -88,18 +95,30 @@ class LLmManager(BaseManager):
             return
         summary_llm_name = llm_config.summary_llm_name
         # 没有则默认是用一个模型
+        old_client_key = self.summary_llm_client_key
         if global_llm_info_by_name.get(summary_llm_name, None) is None:
             print(f'warning: summary_llm_name: {summary_llm_name} not found, use sample llm')
+            self.summary_llm_client_key = None
             self.summary_llm = self.llm
         else:
-            self.summary_llm = ChatOpenAI(
-                api_key=os.getenv(global_llm_info_by_name[summary_llm_name].env),
-                base_url=global_llm_info_by_name[summary_llm_name].base_url,
-                model=global_llm_info_by_name[summary_llm_name].model,
-                temperature=llm_config.summary_temperature
-            )
+            self.summary_llm_client_key = get_llm_client_key(summary_llm_name, llm_config.summary_temperature)
+            self.summary_llm = global_llm_client_pool.acquire(self.summary_llm_client_key)
+        global_llm_client_pool.release(old_client_key)
+
+    def release(self):
+        """
+        释放从共享客户端池获取的客户端
+        :return:
+        """
+        global_llm_client_pool.release(self.llm_client_key)
+        global_llm_client_pool.release(self.summary_llm_client_key)
+        self.llm_client_key = None
+        self.summary_llm_client_key = None
 
 
 # llm_manager = LLmManager()
 
-global_query_llm_cache: Dict[uuid.UUID, LLmManager] = {}
+# key: (user_id, 查询配置id)
+global_query_llm_cache = LRUCache(max_size=settings.QUERY_LLM_CACHE_MAX_SIZE,
+                                  idle_ttl=settings.QUERY_LLM_CACHE_IDLE_SECONDS,
+                                  on_evict=lambda key, llm_manager: llm_manager.release())
@@ -1,31 +1,56 @@
 import threading
 import queue
 import os
+import socket
+import time
 import uuid
 from dataclasses import dataclass, field
-from typing import List
+from typing import List, Dict, Optional, Set, Tuple
 
+import chromadb
 from langchain.retrievers import MultiVectorRetriever
-from langchain_community.document_loaders import TextLoader
 from langchain_chroma import Chroma
 from langchain_community.embeddings import DashScopeEmbeddings
 from concurrent.futures import ThreadPoolExecutor
 from langchain_core.documents import Document
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.stores import InMemoryStore
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from unstructured.partition.pdf import partition_pdf
-from app.db_option import save_doc_chunk
+from app.db_model import File, FileStatus, FileStatusPublic
+from app.db_option import save_doc_chunk, get_chroma_doc_ids_by_file_id, update_file_progress, get_resumable_files, \
+    get_file_by_id, get_reusable_file, acquire_file_lease, renew_file_leases, release_file_lease
+from app.retriever.cached_embeddings import CachedEmbeddings
+from app.retriever.chunk_summarizer import ChunkSummarizer
+from app.retriever.doc_store import PostgresDocStore, create_parent_doc_store
+from app.retriever.embedding_pipeline import EmbeddingPipeline, ChunkBatch
+from app.retriever.kv_store import SQLiteByteStore
+from app.retriever.lexical_index import LexicalIndexManager
+from app.retriever.llm_client_pool import global_llm_client_pool
+from app.retriever.llm_manager import global_llm_info_by_name, get_llm_client_key
+from app.service.blob_store import global_blob_store, get_file_type
+from app.service.file_status_notifier import file_status_notifier
+from app.service.load_doc import LoadDocTask, run_load_doc_task
+from app.service.load_doc_manager import load_doc_manager
+from app.service.scheduler import FairTaskQueue
+from app.service.title_version import title_version_registry, EVENT_TITLE, EVENT_RESET
+from app.settings import settings
 from app.utils.user_base_model import TaskConfig, BaseManager, EmbeddingsConfig, RetrieverConfig, MultiRetrieverConfig
 from app.utils.utils_tools import diff_models
 
-PDF_PIC_DIR = 'pdf_pic'
-CHROMADB_COLLECTION = 'rag_documents_collection'
-CHROMADB_SUMMARY_COLLECTION = 'rag_summary_collection'
+# 每个 title 单独一个 collection，检索时只扫描当前 title 的文档
+CHROMADB_COLLECTION_PREFIX = 'rag_documents'
+CHROMADB_SUMMARY_COLLECTION_PREFIX = 'rag_summary'
+# 旧版本所有 title 共用的 collection，其中的文件由数据库迁移重置为待处理后重新入库，启动时删除
+LEGACY_CHROMADB_COLLECTIONS = ['rag_documents_collection', 'rag_summary_collection']
 CHROMADB_DIR = 'chroma_db'
+# 关键词倒排索引，每个 title 一个 sqlite 文件
+LEXICAL_INDEX_DIR = 'lexical_index'
+# 段落向量缓存，按 (嵌入模型, 向量维度, 段落内容 sha256) 寻址
+EMBEDDING_CACHE_PATH = os.path.join('embedding_cache', 'document_embeddings.sqlite3')
+# 段落总结缓存，按 (总结模型, 温度, 段落内容 sha256) 寻址
+SUMMARY_CACHE_PATH = os.path.join('embedding_cache', 'chunk_summaries.sqlite3')
+# 未配置总结模型时使用的模型
+DEFAULT_SUMMARY_LLM_NAME = "qwen-plus"
+# 复制相同内容文件的段落时，每次读取、写入向量数据库的段落数
+CLONE_BATCH_SIZE = 500
 os.makedirs(CHROMADB_DIR, exist_ok=True)
-os.makedirs(PDF_PIC_DIR, exist_ok=True)
 
 global_env_name_by_model_name = {
     "text-embedding-v2": "DASHSCOPE_API_KEY"
@@ -36,63 +61,176 @@ global_env_name_by_model_name = {
 class ParentDocumentInfo:
     file_path: str = field(metadata={"description": "文件路径"})
     file_id: int = field(metadata={"description": "文件ID"})
+    title_id: uuid.UUID = field(metadata={"description": "文件所属 title ID"})
+    user_id: Optional[uuid.UUID] = field(default=None, metadata={"description": "上传文件的用户 ID"})
+    file_type: str = field(default="", metadata={"description": "文件类型，由文件记录中的文件名确定"})
 
+    @classmethod
+    def from_file(cls, file: File, user_id: Optional[uuid.UUID] = None) -> "ParentDocumentInfo":
+        return cls(file_path=global_blob_store.resolve_path(file), file_id=file.id, title_id=file.title_id,
+                   user_id=user_id, file_type=get_file_type(file.filename))
 
-def get_summary_chunks(ori_doc_chunks: list[Document]) -> list[str]:
+    def get_tenant(self) -> uuid.UUID:
+        # 公平调度按用户划分，恢复的任务没有用户信息时按 title 划分
+        return self.user_id or self.title_id
+
+
+def check_ingest_backend():
     """
-    输入分段后的源文件列表，输出每段话的总结列表
-    :param ori_doc_chunks:
+    celery 入库时 worker 和 api 节点可能不在同一台机器，即使在同一台机器，api 进程已加载的本地向量索引
+    也看不到其他进程的写入，所以向量数据库和关键词索引必须使用共用的服务
     :return:
     """
-    # print(f'get_summary: {len(ori_doc_chunks)}')
-    # summary_model = llm_manager.summary_model
-    # prompt_text = """You are an assistant tasked with summarizing tables and text.
-    # Give a concise summary of the table or text. Table or text chunk: {element} """
-    # prompt = ChatPromptTemplate.from_template(prompt_text)
-    # summary_chain = {"element": lambda x: x} | prompt | summary_model | StrOutputParser()
-    # ori_text_chunks = [doc.page_content for doc in ori_doc_chunks]
-    # summary_chunks = summary_chain.batch(ori_text_chunks, {"max_concurrency": 5})
-    # if len(summary_chunks) > 0:
-    #     print(f'get summary chunks: {summary_chunks[0]}')
-    # return summary_chunks
+    if settings.INGEST_BACKEND != "celery":
+        return
+    if not settings.CHROMA_SERVER_HOST:
+        raise Exception('Error: INGEST_BACKEND=celery requires CHROMA_SERVER_HOST, '
+                        'local chroma directory is not shared between api and worker processes.')
+    if settings.LEXICAL_INDEX_BACKEND != "postgres":
+        raise Exception('Error: INGEST_BACKEND=celery requires LEXICAL_INDEX_BACKEND=postgres, '
+                        'local sqlite lexical index is not shared between api and worker processes.')
+
+
+def get_collection_name(prefix: str, title_id: uuid.UUID) -> str:
+    """
+    生成 title 对应的 collection 名称，chroma 要求名称长度 3~63，只能包含字母数字下划线和中划线
+    :param prefix: collection 前缀
+    :param title_id:
+    :return:
+    """
+    return f'{prefix}_{uuid.UUID(str(title_id)).hex}'
+
+
+def get_chunk_id(file_id: uuid.UUID, index: int) -> str:
+    """
+    段落在向量数据库中的id，由文件id和段落序号确定，重复处理同一文件时id不变
+    :param file_id:
+    :param index:
+    :return:
+    """
+    return str(uuid.uuid5(uuid.UUID(str(file_id)), str(index)))
 
 
 class LoadFileThread(BaseManager):
     def __init__(self):
-        # 保存文件信息队列
-        self.file_path_queue = queue.Queue()
+        # 保存文件信息队列，按用户加权公平出队
+        self.file_path_queue = FairTaskQueue(max_queued_per_key=settings.INGEST_MAX_QUEUED_PER_USER)
+        # 同时处理的文件数，有空闲线程时才从队列取任务，出队顺序才能体现公平调度
+        self.max_processing_files = 3
+        self.processing_slots = threading.Semaphore(self.max_processing_files)
         # 向量嵌入器
         self.embeddings = None
-        # txt文件切分器
-        self.text_spliter = None
-        # 向量数据库
-        self.vectorstore = None
-        # 检索器。只要数据库对象没变，Retriever 不需要重新生成；改k值时、更新数据库实例、embedding模型时，需要重新生成
-        self.retriever = None
+        # 段落向量持久化缓存，重复上传、多个 title 共用的段落不需要重新嵌入
+        self.embedding_cache_store = None
+        # 向量数据库，按 title 分区：title_id -> Chroma
+        self.vectorstore_by_title: Dict[uuid.UUID, Chroma] = {}
+        # 检索器，按 title 分区。只要数据库对象没变，Retriever 不需要重新生成；改k值时、更新数据库实例、embedding模型时，需要重新生成
+        self.retriever_by_title: Dict[uuid.UUID, object] = {}
+        self.retriever_config: Optional[RetrieverConfig] = None
+        self.multi_retriever_config: Optional[MultiRetrieverConfig] = None
+        self.title_lock = threading.Lock()
         self.split_way = "default"  # 切分文档方案
         self.stop_event = threading.Event()
-        self.executor = ThreadPoolExecutor(max_workers=3)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_processing_files)
         self.consume_thread = threading.Thread(
             target=self.task_consumer,
             args=(self.file_path_queue, self.executor, self.stop_event),
             daemon=True
         )
-        self.doc_ids = []
+        # 文件处理租约的持有者标识，每个进程不同
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        # 续期租约、定时接手其他 worker 未完成的文件
+        self.lease_thread = threading.Thread(target=self.lease_keeper, args=(self.stop_event,), daemon=True)
         self.task_config = TaskConfig()
-        # 多文件检索，父文件存储器
-        self.parent_store = None
+        # 多文件检索，父文件存储器，持久化保存，各 title 共用（doc_id 全局唯一）
+        self.parent_store: Optional[PostgresDocStore] = None
         # 父子文件关联字段名
         self.id_key = "doc_id"
+        # 关键词倒排索引，按 title 分区，和向量检索结果融合
+        self.lexical_index_manager = LexicalIndexManager(LEXICAL_INDEX_DIR, backend=settings.LEXICAL_INDEX_BACKEND)
+        # 向量数据库客户端，配置了 CHROMA_SERVER_HOST 时各节点共用同一个服务
+        self.chroma_client = None
+        # 段落总结器，使用总结段落代替原始段落时创建
+        self.chunk_summarizer = None
+        self.summary_llm_client_key = None
+        self.summary_cache_store = None
+        # 是否在解析进程池中解析文档，celery worker 本身是子进程，直接在当前进程解析
+        self.use_process_pool = True
+        # 分批并发嵌入、写入向量数据库
+        self.embedding_pipeline = EmbeddingPipeline(batch_size=settings.EMBED_BATCH_SIZE,
+                                                    max_concurrency=settings.EMBED_MAX_CONCURRENCY,
+                                                    max_retries=settings.EMBED_MAX_RETRIES)
 
     def load(self):
+        self.load_models()
+        load_doc_manager.start()
+        self.consume_thread.start()
+        self.drop_legacy_collections()
+        # celery 入库的任务在 worker 退出时由消息队列重新投递，只有本地入库需要重新处理
+        if settings.INGEST_BACKEND == "local":
+            if settings.RESUME_UNFINISHED_FILES:
+                self.resume_unfinished_files()
+            self.lease_thread.start()
+
+    def load_models(self):
+        """
+        加载嵌入模型和检索配置，不启动消费线程，celery worker 中单独使用
+        :return:
+        """
+        check_ingest_backend()
         # todo: 从数据库加载配置，暂时使用默认值代替
         self.task_config = TaskConfig()
         print(f'load task config: {self.task_config}')
         self.update_embeddings(self.task_config.embeddings_config)
         self.update_retriever(self.task_config.retriever_config, self.task_config.multi_retriever_config)
-        self.consume_thread.start()
+
+    def resume_unfinished_files(self):
+        """
+        重新处理未完成且没有有效租约的文件，已完成的批次会被跳过。
+        多个 worker 都可能放入队列，处理前获取租约，同一文件只处理一次
+        :return:
+        """
+        for file in get_resumable_files(settings.INGEST_LEASE_SECONDS):
+            print(f'resume unfinished file: {file.filename}, status: {file.status}')
+            document_info = ParentDocumentInfo.from_file(file)
+            self.file_path_queue.put(document_info, document_info.get_tenant(), force=True)
+
+    def lease_keeper(self, stop_event: threading.Event):
+        """
+        租约线程函数：定时续期本进程持有的租约，并接手租约过期的文件
+        :param stop_event:
+        :return:
+        """
+        interval = max(settings.INGEST_LEASE_SECONDS / 3, 1)
+        while not stop_event.wait(interval):
+            try:
+                renew_file_leases(self.worker_id, settings.INGEST_LEASE_SECONDS)
+                if settings.RESUME_UNFINISHED_FILES:
+                    self.resume_unfinished_files()
+            except Exception as e:
+                print(f'Error: renew file leases failed, reason: {e}')
+
+    def drop_legacy_collections(self):
+        """
+        删除旧版本的全局 collection，其中文件的段落记录已由数据库迁移删除，会重新入库到 title 对应的 collection
+        :return:
+        """
+        client = self.get_chroma_client()
+        for collection_name in LEGACY_CHROMADB_COLLECTIONS:
+            try:
+                client.delete_collection(collection_name)
+                print(f'drop legacy collection: {collection_name}')
+            except Exception:
+                # 不存在或已被其他进程删除
+                pass
 
     def update_task_config(self, new_task_config: TaskConfig):
+        if self.task_config.summary_llm_config != new_task_config.summary_llm_config:
+            # 总结模型变化，下次使用时重新创建总结器
+            with self.title_lock:
+                global_llm_client_pool.release(self.summary_llm_client_key)
+                self.summary_llm_client_key = None
+                self.chunk_summarizer = None
         diffs = diff_models(self.task_config.embeddings_config, new_task_config.embeddings_config)
         if diffs:
             print(f'update embeddings config: {diffs}')
@@ -127,188 +265,498 @@ class LoadFileThread(BaseManager):
 
         try:
             if embeddings_config.model_name in ["text-embedding-v2", "text-embedding-v1"]:
-                self.embeddings = DashScopeEmbeddings(
-                    model=embeddings_config.model_name,
-                    dashscope_api_key=os.getenv(env_name)
+                if self.embedding_cache_store is None:
+                    self.embedding_cache_store = SQLiteByteStore(EMBEDDING_CACHE_PATH, table="document_embeddings")
+                # 查询向量走缓存和微批处理，文档向量先查段落向量缓存
+                previous_embeddings = self.embeddings
+                self.embeddings = CachedEmbeddings(
+                    DashScopeEmbeddings(
+                        model=embeddings_config.model_name,
+                        dashscope_api_key=os.getenv(env_name)
+                    ),
+                    namespace=f'{embeddings_config.model_name}:{embeddings_config.vector_dimensions or "default"}',
+                    document_store=self.embedding_cache_store,
+                    # 文档批次由入库流水线按限流自适应重试，客户端只请求一次，避免两层重试叠加
+                    document_embeddings=DashScopeEmbeddings(
+                        model=embeddings_config.model_name,
+                        dashscope_api_key=os.getenv(env_name),
+                        max_retries=1
+                    )
                 )
+                # 旧对象的微批处理线程不再使用
+                if isinstance(previous_embeddings, CachedEmbeddings):
+                    previous_embeddings.close()
             else:
                 raise Exception(f'Error: {self.task_config.embeddings_config.model_name} is not supported.')
         except Exception as e:
             print(f'Error: load embeddings failed. {e}')
             raise Exception(f'Error: load embeddings failed. {e}')
+        # 嵌入模型变化后，各 title 的向量数据库需要重新生成
+        with self.title_lock:
+            self.vectorstore_by_title.clear()
+            self.retriever_by_title.clear()
 
     def update_retriever(self, retriever_config: RetrieverConfig, multi_retriever_config: MultiRetrieverConfig):
         try:
-            # txt文件切分器
-            if retriever_config.split_way == "Recursive":
-                self.text_spliter = RecursiveCharacterTextSplitter(
-                    chunk_size=retriever_config.split_len,
-                    chunk_overlap=retriever_config.over_lap,
-                    length_function=len,
-                )
-            else:
-                raise Exception(f'Error: {self.task_config.split_way} is not supported.')
+            # 文件切分在解析进程中执行，这里只检查切分方式
+            if retriever_config.split_way != "Recursive":
+                raise Exception(f'Error: {retriever_config.split_way} is not supported.')
 
-            # 检索器。只要数据库对象没变，Retriever 不需要重新生成；改k值时、更新数据库实例、embedding模型时，需要重新生成
-            if multi_retriever_config is None:
-                # 向量数据库
-                self.vectorstore = Chroma(
-                    collection_name=CHROMADB_COLLECTION,
-                    embedding_function=self.embeddings,
-                    persist_directory=CHROMADB_DIR
-                )
-                print(f'update retriever: {self.vectorstore}')
-                self.retriever = self.vectorstore.as_retriever(
-                    search_type="similarity",
-                    search_kwargs={"k": retriever_config.top_k}
-                )
-            else:
-                if multi_retriever_config.multi_retriever_strategy == "summarize":
-                    # 总结段落的向量数据库
-                    self.vectorstore = Chroma(
-                        collection_name=CHROMADB_SUMMARY_COLLECTION,
-                        embedding_function=self.embeddings,
-                        persist_directory=CHROMADB_DIR
-                    )
-                    # 保存父文件原始文件
-                    self.parent_store = InMemoryStore()
-                    self.retriever = MultiVectorRetriever(
-                        vectorstore=self.vectorstore,
-                        docstore=self.parent_store,
-                        id_key=self.id_key,
-                    )
-                else:
-                    raise Exception(
-                        f'Error: {multi_retriever_config.multi_retriever_strategy} is not supported.')
+            if multi_retriever_config is not None and multi_retriever_config.multi_retriever_strategy != "summarize":
+                raise Exception(
+                    f'Error: {multi_retriever_config.multi_retriever_strategy} is not supported.')
+            # 配置变化后，已经生成的各 title 检索器全部失效，下次使用时重新生成
+            with self.title_lock:
+                self.retriever_config = retriever_config
+                self.multi_retriever_config = multi_retriever_config
+                self.vectorstore_by_title.clear()
+                self.retriever_by_title.clear()
         except Exception as e:
             print(f'Error: load embeddings failed. {e}')
             raise Exception(f'Error: load embeddings failed. {e}')
 
-    def task_consumer(self, task_queue: queue.Queue, executor: ThreadPoolExecutor, stop_event: threading.Event):
+    def use_summarize_retriever(self) -> bool:
+        return self.multi_retriever_config is not None and \
+            self.multi_retriever_config.multi_retriever_strategy == "summarize"
+
+    def get_summary_llm(self) -> Tuple[str, float]:
+        """
+        总结段落使用的模型，未配置或配置的模型不存在时使用默认模型
+        :return: (模型名称, 温度)
+        """
+        summary_llm_config = self.task_config.summary_llm_config
+        if summary_llm_config is not None and summary_llm_config.summary_llm_name in global_llm_info_by_name:
+            return summary_llm_config.summary_llm_name, summary_llm_config.summary_temperature
+        return DEFAULT_SUMMARY_LLM_NAME, 0.0
+
+    def get_ingest_key(self, document_info: ParentDocumentInfo) -> str:
+        """
+        生成段落和向量的参数：文件类型、切分参数、是否使用总结段落及总结模型、嵌入模型。
+        参数相同的相同内容生成的段落和向量相同，可以直接复制
+        :param document_info:
+        :return:
+        """
+        config = self.retriever_config
+        if self.use_summarize_retriever():
+            model_name, temperature = self.get_summary_llm()
+            strategy = f'summarize:{model_name}:{temperature}'
+        else:
+            strategy = 'original'
+        namespace = self.embeddings.namespace if isinstance(self.embeddings, CachedEmbeddings) \
+            else type(self.embeddings).__name__
+        split = f'{config.split_way}:{config.split_len}:{config.over_lap}'
+        return f'{document_info.file_type}|{split}|{strategy}|{namespace}'
+
+    def get_chunk_summarizer(self) -> ChunkSummarizer:
         """
-        消费者线程函数：不断从队列取任务，提交给线程池
+        获取段落总结器，总结模型从共享客户端池获取
+        :return:
+        """
+        with self.title_lock:
+            if self.chunk_summarizer is not None:
+                return self.chunk_summarizer
+            model_name, temperature = self.get_summary_llm()
+            self.summary_llm_client_key = get_llm_client_key(model_name, temperature)
+            if self.summary_cache_store is None:
+                self.summary_cache_store = SQLiteByteStore(SUMMARY_CACHE_PATH, table="chunk_summaries")
+            self.chunk_summarizer = ChunkSummarizer(
+                llm=global_llm_client_pool.acquire(self.summary_llm_client_key),
+                model_key=f'{model_name}:{temperature}',
+                cache_store=self.summary_cache_store,
+                max_concurrency=settings.SUMMARY_MAX_CONCURRENCY,
+                max_batch_tokens=settings.SUMMARY_BATCH_MAX_TOKENS,
+                min_summary_chars=settings.SUMMARY_MIN_CHARS,
+            )
+            return self.chunk_summarizer
+
+    def get_vectorstore(self, title_id: uuid.UUID) -> Chroma:
+        """
+        获取 title 对应的向量数据库，不存在时创建
+        :param title_id:
+        :return:
+        """
+        with self.title_lock:
+            vectorstore = self.vectorstore_by_title.get(title_id, None)
+            if vectorstore is None:
+                # 使用总结段落代替原始段落时，保存总结段落的向量
+                prefix = CHROMADB_SUMMARY_COLLECTION_PREFIX if self.use_summarize_retriever() \
+                    else CHROMADB_COLLECTION_PREFIX
+                vectorstore = Chroma(
+                    collection_name=get_collection_name(prefix, title_id),
+                    embedding_function=self.embeddings,
+                    client=self.get_chroma_client_locked()
+                )
+                self.vectorstore_by_title[title_id] = vectorstore
+                print(f'create vectorstore for title: {title_id}')
+            return vectorstore
+
+    def get_chroma_client(self):
+        with self.title_lock:
+            return self.get_chroma_client_locked()
+
+    def get_chroma_client_locked(self):
+        """
+        获取向量数据库客户端，配置了 CHROMA_SERVER_HOST 时连接共用的服务，否则使用本地目录，调用方需持有 title_lock
+        :return:
+        """
+        if self.chroma_client is None:
+            if settings.CHROMA_SERVER_HOST:
+                self.chroma_client = chromadb.HttpClient(host=settings.CHROMA_SERVER_HOST,
+                                                         port=settings.CHROMA_SERVER_PORT)
+            else:
+                self.chroma_client = chromadb.PersistentClient(path=CHROMADB_DIR)
+        return self.chroma_client
+
+    def get_parent_store(self) -> PostgresDocStore:
+        with self.title_lock:
+            if self.parent_store is None:
+                self.parent_store = create_parent_doc_store()
+            return self.parent_store
+
+    def get_retriever(self, title_id: uuid.UUID, top_k: Optional[int] = None):
+        """
+        获取 title 对应的检索器，只检索该 title 下的文档
+        :param title_id:
+        :param top_k: 为 None 时使用当前检索配置中的 top_k
+        :return:
+        """
+        if self.retriever_config is None:
+            return None
+        top_k = top_k if top_k is not None else self.retriever_config.top_k
+        key = (title_id, top_k)
+        retriever = self.retriever_by_title.get(key, None)
+        if retriever is not None:
+            return retriever
+
+        vectorstore = self.get_vectorstore(title_id)
+        if self.use_summarize_retriever():
+            retriever = MultiVectorRetriever(
+                vectorstore=vectorstore,
+                docstore=self.get_parent_store(),
+                id_key=self.id_key,
+                search_kwargs={"k": top_k},
+            )
+        else:
+            retriever = vectorstore.as_retriever(
+                search_type="similarity",
+                search_kwargs={"k": top_k}
+            )
+        with self.title_lock:
+            self.retriever_by_title[key] = retriever
+        return retriever
+
+    def evict_title(self, title_id: Optional[uuid.UUID] = None):
+        """
+        淘汰 title 的向量数据库和检索器对象，下次使用时重新生成
+        :param title_id: None 时淘汰所有 title
+        :return:
+        """
+        with self.title_lock:
+            if title_id is None:
+                self.vectorstore_by_title.clear()
+                self.retriever_by_title.clear()
+                return
+            self.vectorstore_by_title.pop(title_id, None)
+            for key in [key for key in self.retriever_by_title.keys() if key[0] == title_id]:
+                self.retriever_by_title.pop(key, None)
+
+    def on_title_version_change(self, kind: str, target_id: Optional[uuid.UUID], version: int):
+        if kind == EVENT_TITLE:
+            self.evict_title(target_id)
+        elif kind == EVENT_RESET:
+            self.evict_title()
+
+    def delete_title_collection(self, title_id: uuid.UUID):
+        """
+        删除 title 时，删除对应的向量数据库
+        :param title_id:
+        :return:
+        """
+        vectorstore = self.get_vectorstore(title_id)
+        vectorstore.delete_collection()
+        self.lexical_index_manager.delete_index(title_id)
+        self.evict_title(title_id)
+        title_version_registry.bump(title_id)
+
+    def task_consumer(self, task_queue: FairTaskQueue, executor: ThreadPoolExecutor, stop_event: threading.Event):
+        """
+        消费者线程函数：有空闲线程时从队列取任务，提交给线程池
         :param task_queue:
         :param executor:
         :param stop_event:
         :return:
         """
         while not stop_event.is_set():
+            # 最多等待 1 秒，避免永久阻塞
+            if not self.processing_slots.acquire(timeout=1):
+                continue
             try:
-                # 最多等待 1 秒取一个任务，避免永久阻塞
                 document_info = task_queue.get(timeout=1)
-                if not isinstance(document_info, ParentDocumentInfo):
-                    print(f'check document info, error: {document_info}')
-                    continue
-                executor.submit(self.split_file, document_info)
-                task_queue.task_done()
             except queue.Empty:
+                self.processing_slots.release()
+                continue
+            if not isinstance(document_info, ParentDocumentInfo):
+                print(f'check document info, error: {document_info}')
+                self.processing_slots.release()
                 continue
+            executor.submit(self.run_file_task, document_info)
 
-    def split_file(self, document_info: ParentDocumentInfo):
-        print(f'start split file info: {document_info}')
-        if document_info.file_path.endswith("txt"):
-            print("1")
-            loader = TextLoader(document_info.file_path, encoding="utf-8")
-            print("2")
-            text = loader.load()
-            print("3")
-            split_docs = self.text_spliter.split_documents(text)
-            print("4")
-
-        elif document_info.file_path.endswith("pdf"):
-            print("1")
+    def run_file_task(self, document_info: ParentDocumentInfo):
+        start = time.monotonic()
+        try:
+            # 已完成、已失败或者正在由其他 worker 处理的文件跳过
+            if not acquire_file_lease(document_info.file_id, self.worker_id, settings.INGEST_LEASE_SECONDS):
+                print(f'skip file: {document_info.file_path}, finished or processing by other worker')
+                return
             try:
-                raw_pdf_elements = partition_pdf(
-                    strategy="fast",
-                    filename=document_info.file_path,
-                    # Unstructured first finds embedded image blocks
-                    extract_images_in_pdf=False,
-                    # Use layout model (YOLOX) to get bounding boxes (for tables) and find titles
-                    # Titles are any sub-section of the document
-                    infer_table_structure=True,
-                    # Post processing to aggregate text once we have the title
-                    chunking_strategy="by_title",
-                    # Chunking params to aggregate text blocks
-                    # Attempt to create a new chunk 3800 chars
-                    # Attempt to keep chunks > 2000 chars
-                    max_characters=4000,
-                    new_after_n_chars=3800,
-                    combine_text_under_n_chars=2000,
-                    image_output_dir_path=PDF_PIC_DIR,
-                )
-            except Exception as e:
-                print(f'load pdf failed, reason: {e}')
-                raise f'load pdf failed, reason: {e}'
-            print("2")
-            split_docs = []
-            counter = 0
-            for element in raw_pdf_elements:
-                doc = Document(
-                    page_content=element.text,
-                    metadata={
-                        "source": document_info.file_path,
-                        "doc_id": counter,
-                        "type": "pdf",
-                    }
-                )
-                counter += 1
-                split_docs.append(doc)
-            print("3")
-            # print(split_docs)
-            print("4")
+                self.split_file(document_info)
+            finally:
+                release_file_lease(document_info.file_id, self.worker_id)
+        finally:
+            self.file_path_queue.record_task_seconds(time.monotonic() - start)
+            self.processing_slots.release()
+
+    def load_split_docs(self, document_info: ParentDocumentInfo) -> List[Document]:
+        """
+        加载并切分文件，在解析进程池中执行
+        :param document_info:
+        :return: 切分后的段落
+        """
+        task = LoadDocTask(
+            file_path=document_info.file_path,
+            file_type=document_info.file_type,
+            split_len=self.retriever_config.split_len,
+            over_lap=self.retriever_config.over_lap,
+            split_way=self.retriever_config.split_way,
+        )
+        if self.use_process_pool:
+            chunk_payloads = load_doc_manager.load_document(task)
         else:
-            raise Exception(f'Error file type: {document_info.file_path}')
+            chunk_payloads = run_load_doc_task(task)
+        return [Document(page_content=payload.text, metadata=payload.metadata) for payload in chunk_payloads]
+
+    def update_file_status(self, document_info: ParentDocumentInfo, **kwargs):
+        """
+        记录文件入库状态和进度，并通知订阅者
+        :param document_info:
+        :param kwargs: 参考 update_file_progress
+        :return:
+        """
+        try:
+            file = update_file_progress(document_info.file_id, **kwargs)
+            if file is not None:
+                file_status_notifier.publish(FileStatusPublic.from_file(file))
+        except Exception as e:
+            print(f'Error: update file status failed, file: {document_info.file_path}, reason: {e}')
+
+    def split_file(self, document_info: ParentDocumentInfo):
+        try:
+            self.process_file(document_info)
+        except Exception as e:
+            print(f'Error: process file failed, file: {document_info.file_path}, reason: {e}')
+            self.update_file_status(document_info, status=FileStatus.FAILED.value, error_msg=str(e))
+
+    def prepare_chunks(self, document_info: ParentDocumentInfo) -> Tuple[List[str], List[Document]]:
+        """
+        解析切分文件，生成待嵌入的段落和段落id
+        :param document_info:
+        :return: (段落id列表, 段落列表)
+        """
+        # 记录生成段落的参数，入库完成后其他 title 的相同内容按参数判断能否复制
+        self.update_file_status(document_info, status=FileStatus.SPLITTING.value, start=True,
+                                ingest_key=self.get_ingest_key(document_info))
+        split_docs = self.load_split_docs(document_info)
+
+        # 写入分区字段，向量按 title 分区保存
+        partition_metadata = {
+            "title_id": str(document_info.title_id),
+            "file_id": str(document_info.file_id),
+        }
+        for doc in split_docs:
+            doc.metadata.update(partition_metadata)
+        chunk_ids = [get_chunk_id(document_info.file_id, i) for i in range(len(split_docs))]
+        # 关键词索引保存原始段落，整个文件一次写入，重复处理时覆盖
+        self.lexical_index_manager.get_index(document_info.title_id).index_file(
+            document_info.file_id, chunk_ids, split_docs)
 
         # 多文件检索且使用了总结段落代替原始文件时
-        use_multi_retriever = self.task_config.multi_retriever_config is not None and \
-            self.task_config.multi_retriever_config.multi_retriever_strategy == "summarize"
-
-        # 如果是多文件检索器
-        if use_multi_retriever:
-            doc_ids = [str(uuid.uuid4()) for _ in split_docs]
-            summaries_chunks = get_summary_chunks(split_docs)
-            # 将 doc_ids 和 原始文档 split_docs 保存到父文档存储器中
-            self.retriever.docstore.mset(list(zip(doc_ids, split_docs)))
-            # 将段落的总结list替换原始切分后的段落list， 并将doc_ids与总结向量一一对应
+        if self.use_summarize_retriever():
+            summaries_chunks = self.get_chunk_summarizer().summarize(split_docs)
+            # 将 chunk_ids 和 原始文档 split_docs 保存到父文档存储器中
+            self.get_parent_store().mset(list(zip(chunk_ids, split_docs)))
+            # 将段落的总结list替换原始切分后的段落list， 并将chunk_ids与总结向量一一对应
             # 形成 doc_id - summary item - ori_text item 对应关系， doc_id是主键
             split_docs = [
-                Document(page_content=s, metadata={self.id_key: doc_ids[i]})
+                Document(page_content=s, metadata={self.id_key: chunk_ids[i], **partition_metadata})
                 for i, s in enumerate(summaries_chunks)
             ]
+        return chunk_ids, split_docs
 
+    def get_pending_batches(self, document_info: ParentDocumentInfo, chunk_ids: List[str],
+                            split_docs: List[Document]) -> Tuple[List[ChunkBatch], Set[str]]:
+        """
+        分批，并跳过之前已经完成的批次，中断的文件可以继续处理
+        :param document_info:
+        :param chunk_ids:
+        :param split_docs:
+        :return: (待处理批次, 已完成的段落id)
+        """
+        done_ids = set(get_chroma_doc_ids_by_file_id(document_info.file_id))
+        self.update_file_status(document_info, status=FileStatus.HAS_SPLIT.value,
+                                chunk_total=len(split_docs), chunk_done=len(done_ids))
+        batches = [
+            batch for batch in self.embedding_pipeline.make_batches(chunk_ids, split_docs)
+            if not set(batch.ids).issubset(done_ids)
+        ]
+        print(f'file: {document_info.file_path}, chunks: {len(split_docs)}, '
+              f'batches: {len(batches)}, skip done chunks: {len(done_ids)}')
+        return batches, done_ids
+
+    def save_batch_chunks(self, document_info: ParentDocumentInfo, batch: ChunkBatch,
+                          done_ids: Optional[Set[str]] = None) -> int:
+        """
+        批次写入向量数据库后，保存段落记录并更新进度
+        :param document_info:
+        :param batch:
+        :param done_ids: 已保存的段落id，None 时从数据库查询
+        :return: 新保存的段落数
+        """
+        if done_ids is None:
+            done_ids = set(get_chroma_doc_ids_by_file_id(document_info.file_id, batch.ids))
+        new_ids = [chunk_id for chunk_id in batch.ids if chunk_id not in done_ids]
+        save_doc_chunk(new_ids, document_info.file_id)
+        self.update_file_status(document_info, chunk_done_delta=len(new_ids))
+        return len(new_ids)
+
+    def clone_chunks(self, source: File, document_info: ParentDocumentInfo) -> int:
+        """
+        复制源文件的段落向量、父文档和关键词索引到当前文件，段落id按当前文件重新生成
+        :param source: 内容和入库参数相同、已经入库完成的文件
+        :param document_info:
+        :return: 段落数
+        """
+        source_ids = [get_chunk_id(source.id, i) for i in range(source.chunk_total)]
+        index_by_id = {chunk_id: i for i, chunk_id in enumerate(source_ids)}
+        source_collection = self.get_vectorstore(source.title_id)._collection
+        target_collection = self.get_vectorstore(document_info.title_id)._collection
+        partition_metadata = {
+            "title_id": str(document_info.title_id),
+            "file_id": str(document_info.file_id),
+        }
+        use_summarize = self.use_summarize_retriever()
+        chunk_ids: List[Optional[str]] = [None] * len(source_ids)
+        original_docs: List[Optional[Document]] = [None] * len(source_ids)
+        for start in range(0, len(source_ids), CLONE_BATCH_SIZE):
+            result = source_collection.get(ids=source_ids[start:start + CLONE_BATCH_SIZE],
+                                           include=["embeddings", "documents", "metadatas"])
+            ids, embeddings, texts, metadatas = [], [], [], []
+            for chunk_id, embedding, text, metadata in zip(result["ids"], result["embeddings"],
+                                                           result["documents"], result["metadatas"]):
+                index = index_by_id[chunk_id]
+                new_id = get_chunk_id(document_info.file_id, index)
+                metadata = {**metadata, **partition_metadata}
+                if use_summarize:
+                    metadata[self.id_key] = new_id
+                else:
+                    original_docs[index] = Document(page_content=text, metadata=metadata)
+                chunk_ids[index] = new_id
+                ids.append(new_id)
+                embeddings.append(embedding)
+                texts.append(text)
+                metadatas.append(metadata)
+            if ids:
+                target_collection.upsert(ids=ids, embeddings=embeddings, documents=texts, metadatas=metadatas)
+        if any(chunk_id is None for chunk_id in chunk_ids):
+            raise Exception(f'source file {source.id} chunks are incomplete in vectorstore')
+
+        if use_summarize:
+            parent_docs = self.get_parent_store().mget(source_ids)
+            if any(doc is None for doc in parent_docs):
+                raise Exception(f'source file {source.id} parent documents are incomplete')
+            original_docs = [Document(page_content=doc.page_content, metadata={**doc.metadata, **partition_metadata})
+                             for doc in parent_docs]
+            self.get_parent_store().mset(list(zip(chunk_ids, original_docs)))
+        self.lexical_index_manager.get_index(document_info.title_id).index_file(
+            document_info.file_id, chunk_ids, original_docs)
+
+        done_ids = set(get_chroma_doc_ids_by_file_id(document_info.file_id))
+        save_doc_chunk([chunk_id for chunk_id in chunk_ids if chunk_id not in done_ids], document_info.file_id)
+        return len(chunk_ids)
+
+    def try_clone_file(self, document_info: ParentDocumentInfo) -> bool:
+        """
+        其他 title 已经用相同参数入库了相同内容的文件时，直接复制其段落和向量，不重新解析和嵌入
+        :param document_info:
+        :return: 是否复制成功，失败时按正常流程处理
+        """
+        file = get_file_by_id(document_info.file_id)
+        if file is None:
+            return False
+        ingest_key = self.get_ingest_key(document_info)
+        source = get_reusable_file(file.file_hash, ingest_key, file.id)
+        if source is None or not source.chunk_total:
+            return False
+        self.update_file_status(document_info, status=FileStatus.SPLITTING.value, start=True, ingest_key=ingest_key)
         try:
-            # if self.task_config.
-            print("5")
-            doc_ids = self.vectorstore.add_documents(documents=split_docs)
-            print(f"Successfully added {len(doc_ids)} documents from {document_info.file_path}")
-            save_doc_chunk(doc_ids, document_info.file_id)
-
-            # self.doc_ids = doc_ids
-            # self.test_check_embeddings_with_id()
-            print(f"save_doc_chunk end, doc_ids: {doc_ids}")
+            chunk_count = self.clone_chunks(source, document_info)
         except Exception as e:
-            print(f"Error adding documents from {document_info.file_path}: {e}")
-        print(f'end split file: {document_info.file_path}')
+            print(f'Error: clone file {source.id} to {document_info.file_id} failed, reason: {e}')
+            return False
+        self.update_file_status(document_info, status=FileStatus.COMPLETE.value,
+                                chunk_total=chunk_count, chunk_done=chunk_count)
+        title_version_registry.bump(document_info.title_id)
+        print(f'clone file {source.id} to {document_info.file_id}, chunks: {chunk_count}')
+        return True
+
+    def process_file(self, document_info: ParentDocumentInfo):
+        print(f'start split file info: {document_info}')
+        if self.try_clone_file(document_info):
+            return
+        chunk_ids, split_docs = self.prepare_chunks(document_info)
+        batches, done_ids = self.get_pending_batches(document_info, chunk_ids, split_docs)
 
-    async def delete_embeddings(self, ids: List[str], batch_size: int = 500):
+        self.update_file_status(document_info, status=FileStatus.EMBEDDING.value)
+        result = self.embedding_pipeline.run(
+            self.embeddings, self.get_vectorstore(document_info.title_id), batches,
+            lambda batch: self.save_batch_chunks(document_info, batch, done_ids)
+        )
+        if result.errors:
+            print(f"Error adding documents from {document_info.file_path}: {result.errors}")
+            self.update_file_status(document_info, status=FileStatus.FAILED.value,
+                                    error_msg=f'{len(result.errors)} batches failed: {result.errors[0]}')
+        else:
+            self.update_file_status(document_info, status=FileStatus.COMPLETE.value)
+        # title 下的段落变化，通知各 worker 重新生成检索链、失效缓存的答案
+        title_version_registry.bump(document_info.title_id)
+        print(f'end split file: {document_info.file_path}, added chunks: {result.done_chunks}')
+
+    async def delete_embeddings(self, title_id: uuid.UUID, ids: List[str], batch_size: int = 500):
+        vectorstore = self.get_vectorstore(title_id)
         for i in range(0, len(ids), batch_size):
             batch = ids[i:i + batch_size]
             if batch:
-                await self.vectorstore.adelete(ids=batch)
-
-    def test_check_embeddings_with_id(self):
-        collection = self.vectorstore._collection
-        res = collection.get(ids=self.doc_ids)
-        # print(res)
-        if res["ids"]:
-            print('embeddings exist')
-        else:
-            print('embeddings not exist')
+                await vectorstore.adelete(ids=batch)
+
+    def delete_lexical_index(self, title_id: uuid.UUID, file_id: uuid.UUID):
+        """
+        删除文件时，删除关键词索引中该文件的段落
+        :param title_id:
+        :param file_id:
+        :return:
+        """
+        lexical_index = self.lexical_index_manager.get_index(title_id, create=False)
+        if lexical_index is not None:
+            lexical_index.delete_file(file_id)
+        title_version_registry.bump(title_id)
 
     def stop(self):
         print('stop thread pool.')
         self.stop_event.set()
         self.consume_thread.join()
+        if self.lease_thread.is_alive():
+            self.lease_thread.join()
+        load_doc_manager.stop()
 
 
 load_file_thread = LoadFileThread()
+title_version_registry.add_listener(load_file_thread.on_title_version_change)
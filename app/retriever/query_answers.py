@@ -1,27 +1,26 @@
-import json
-import os
-import queue
 import uuid
-from dataclasses import field, dataclass
-from typing import Dict
+from typing import Optional, List, Tuple
 
-import redis
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough, RunnableLambda
-from langchain_openai import ChatOpenAI
-
+from sqlmodel import Session
+
+from app.api.deps import engine
+from app.db_option import get_load_config_by_id
+from app.retriever.answer_cache import global_answer_cache, split_answer
+from app.retriever.cached_embeddings import normalize_question
+from app.retriever.context_builder import global_context_builder
+from app.retriever.hybrid_retriever import HybridRetriever
+from app.retriever.reranker import RerankRetriever, global_reranker
+from app.retriever.single_flight import global_single_flight, Flight
 from app.retriever.llm_manager import global_query_llm_cache, LLmManager
 from app.retriever.load_file_thread import load_file_thread
-from app.utils.user_base_model import TaskConfig, BaseManager
-
-r = redis.from_url('redis://localhost:6379/0')
-
-
-@dataclass
-class StreamQuestion:
-    question: str = field(metadata={"description": "问题"})
-    answer_queue: queue.Queue = field(metadata={"description": "答案队列"})
+from app.service.title_version import title_version_registry, EVENT_TITLE, EVENT_LOAD_CONFIG, \
+    EVENT_QUERY_CONFIG, EVENT_RESET
+from app.settings import settings
+from app.utils.lru_cache import LRUCache
+from app.utils.user_base_model import TaskConfig, BaseManager, RetrieverConfig
 
 
 def debug_logs(retrieve):
@@ -30,8 +29,8 @@ def debug_logs(retrieve):
 
 
 class QueryAnswers(BaseManager):
-    def __init__(self, user_id: uuid.UUID = None, title_id: uuid.UUID = None):
-        self.stream_question_queue = queue.Queue()
+    def __init__(self, user_id: uuid.UUID = None, title_id: uuid.UUID = None,
+                 llm_config_id: Optional[uuid.UUID] = None, load_config_id: Optional[uuid.UUID] = None):
         # 大模型
         self.llm = None
         self.template = ""
@@ -42,63 +41,212 @@ class QueryAnswers(BaseManager):
         self.task_config = TaskConfig()
         self.user_id = user_id
         self.title_id = title_id
+        # 查询配置id 和 加载配置id，配置变化后对应新的缓存对象
+        self.llm_config_id = llm_config_id
+        self.load_config_id = load_config_id
         self.version = self._get_remote_retriever_version()
 
+    def create_llm_manager(self) -> LLmManager:
+        print(f'global_query_llm_cache.get({(self.user_id, self.llm_config_id)}) is None, create it')
+        llm_manager = LLmManager(self.user_id)
+        llm_manager.load_llm()
+        return llm_manager
+
     def load(self):
-        if self.user_id in global_query_llm_cache:
-            llm_manager = global_query_llm_cache[self.user_id]
-        else:
-            print(f'Error: global_query_llm_cache.get({self.user_id}) is None')
-            llm_manager = LLmManager(self.user_id)
-            llm_manager.load_llm()
+        llm_cache_key = (self.user_id, self.llm_config_id)
+        # 并发创建时只保留一个对象，其余对象由缓存释放
+        llm_manager = global_query_llm_cache.get_or_create(llm_cache_key, self.create_llm_manager)
         if llm_manager is None:
             print(f"global_query_llm_cache.get({self.user_id}) is None")
             return False
 
-        if load_file_thread.retriever is None or llm_manager.llm is None:
+        self.load_task_config()
+        retriever = self.get_retriever()
+        if retriever is None or llm_manager.llm is None:
             print("load_file_thread.retriever is None")
             raise Exception("load_file_thread.retriever is None")
-        # todo:加载数据库到 task_config
-
         self.llm = llm_manager.llm
         self.template = """ 根据一下内容回答问题，如果没有相关内容，则回答不知道：
                 {context}
                 问题：{question}
                 """
         self.retrieve = {
-            "context": load_file_thread.retriever | (lambda docs: "\n".join([doc.page_content for doc in docs])),
+            "context": retriever | RunnableLambda(self.build_context),
             "question": RunnablePassthrough()
         }
         self.prompt = ChatPromptTemplate.from_template(self.template)
         self.parse_output = StrOutputParser()
         self.native_rag_chain = self.retrieve | RunnableLambda(debug_logs) | self.prompt | self.llm | self.parse_output
 
+    def build_context(self, docs) -> str:
+        """
+        合并相邻段落、去重，按 token 预算构建上下文
+        :param docs:
+        :return:
+        """
+        retriever_config = self.task_config.retriever_config
+        return global_context_builder.build(docs, retriever_config.context_max_tokens, retriever_config.over_lap).text
+
+    def get_retriever(self):
+        """
+        只检索当前 title 下的文档：开启混合检索时融合向量检索和关键词检索结果，
+        开启重排时先取 top_k * m 个候选，重排后保留 top_k 个
+        :return:
+        """
+        top_k = self.task_config.retriever_config.top_k
+        candidate_k = top_k * settings.RERANK_CANDIDATE_MULTIPLIER if settings.RERANK_ENABLED else top_k
+        if settings.HYBRID_SEARCH_ENABLED:
+            fetch_k = max(candidate_k, settings.HYBRID_FETCH_K)
+            vector_retriever = load_file_thread.get_retriever(self.title_id, fetch_k)
+            if vector_retriever is None:
+                return None
+            retriever = HybridRetriever(
+                vector_retriever=vector_retriever,
+                lexical_index_manager=load_file_thread.lexical_index_manager,
+                title_id=self.title_id,
+                top_k=candidate_k,
+                fetch_k=fetch_k,
+                rrf_k=settings.HYBRID_RRF_K,
+            )
+        else:
+            retriever = load_file_thread.get_retriever(self.title_id, candidate_k)
+            if retriever is None:
+                return None
+        if settings.RERANK_ENABLED:
+            retriever = RerankRetriever(base_retriever=retriever, reranker=global_reranker, top_k=top_k)
+        return retriever
+
+    def load_task_config(self):
+        """
+        从数据库加载 title 使用的加载配置到 task_config
+        :return:
+        """
+        if self.load_config_id is None:
+            return
+        with Session(engine) as session:
+            load_config = get_load_config_by_id(session=session, user_id=self.user_id,
+                                                load_config_id=self.load_config_id)
+        if load_config is not None:
+            self.task_config.retriever_config = RetrieverConfig.model_validate(load_config.model_dump())
+
     def update_task_config(self, new_task_config: TaskConfig):
         pass
 
-    async def query(self, question: str) -> str:
-        result = await self.native_rag_chain.ainvoke(question)
-        return result
+    async def get_question_vector(self, question: str) -> Optional[List[float]]:
+        """
+        语义命中需要问题向量，查询向量有缓存，检索时不会重复请求嵌入模型
+        :param question:
+        :return:
+        """
+        if settings.ANSWER_CACHE_SIMILARITY_THRESHOLD is None or load_file_thread.embeddings is None:
+            return None
+        try:
+            return await load_file_thread.embeddings.aembed_query(question)
+        except Exception as e:
+            print(f'Error: embed question for answer cache failed. {e}')
+            return None
+
+    async def get_cached_answer(self, question: str) -> Tuple[Optional[str], Optional[List[float]]]:
+        """
+        查询问答缓存
+        :param question:
+        :return: (缓存答案, 问题向量)
+        """
+        if not settings.ANSWER_CACHE_ENABLED:
+            return None, None
+        scope = global_answer_cache.get_scope(self.title_id, self.load_config_id, self.llm_config_id)
+        answer = global_answer_cache.get(scope, question)
+        if answer is not None:
+            return answer, None
+        vector = await self.get_question_vector(question)
+        return global_answer_cache.get(scope, question, vector), vector
+
+    def put_cached_answer(self, question: str, answer: str, vector: Optional[List[float]], generation: int):
+        if not settings.ANSWER_CACHE_ENABLED:
+            return
+        scope = global_answer_cache.get_scope(self.title_id, self.load_config_id, self.llm_config_id)
+        global_answer_cache.put(scope, question, answer, vector, generation)
+
+    def start_flight(self, question: str, vector: Optional[List[float]], generation: int) -> Flight:
+        """
+        相同 title、配置和问题的并发请求共用一次生成，生成完成后写入问答缓存
+        :param question:
+        :param vector:
+        :param generation:
+        :return:
+        """
+        scope = global_answer_cache.get_scope(self.title_id, self.load_config_id, self.llm_config_id)
+        return global_single_flight.start(
+            (*scope, normalize_question(question)),
+            lambda: self.native_rag_chain.astream(question),
+            lambda answer: self.put_cached_answer(question, answer, vector, generation)
+        )
 
-    async def event_generator(self, question: str):
-        async for answer in self.native_rag_chain.astream(question):
-            yield f"data: {json.dumps({'data': answer}, ensure_ascii=False)}\n\n"
+    async def query(self, question: str) -> str:
+        generation = global_answer_cache.get_generation(self.title_id)
+        answer, vector = await self.get_cached_answer(question)
+        if answer is not None:
+            return answer
+        return await self.start_flight(question, vector, generation).result()
+
+    async def stream_tokens(self, question: str):
+        """
+        流式回答，返回 token 异步迭代器，由调用方转换为 SSE 事件
+        :param question:
+        :return:
+        """
+        generation = global_answer_cache.get_generation(self.title_id)
+        answer, vector = await self.get_cached_answer(question)
+        if answer is not None:
+            # 命中缓存时按流式输出回放答案
+            for chunk in split_answer(answer):
+                yield chunk
+            return
+        # 后加入的请求先收到已生成的内容，再实时收到新内容；生成完整后才写入缓存
+        async for token in self.start_flight(question, vector, generation).subscribe():
+            yield token
 
     def _get_remote_retriever_version(self) -> int:
-        key = f"{self.user_id}_{self.title_id}_remote_retriever_version"
-        # v = r.get(key)
-        # return int(v) if v else 0
-        return 0
-
-    def reload_if_needed(self):
+        # 本地版本号由订阅线程更新，不需要每次请求访问 redis
+        return title_version_registry.get_version(self.title_id)
+
+    def is_stale(self) -> bool:
+        """
+        title 下的文件或配置变化后需要重新生成检索链。由调用方创建新的对象替换缓存，
+        不修改当前对象，正在使用当前对象流式回答的请求不受影响
+        :return:
+        """
         remote = self._get_remote_retriever_version()
         if remote != self.version:
-            self.version = remote
-            # todo: retriever reload
-            print(f"reload_if_needed: {self.user_id}, {self.title_id}, {self.version}")
-            pass
+            print(f"query answers stale: {self.user_id}, {self.title_id}, {self.version} -> {remote}")
+            return True
+        return False
+
+
+def on_title_version_change(kind: str, target_id: Optional[uuid.UUID], version: int):
+    """
+    title 版本变化时失效缓存的答案；配置删除或修改时淘汰使用该配置的查询对象。
+    title 的检索链在下次请求时发现版本变化后重新生成
+    :param kind:
+    :param target_id:
+    :param version:
+    :return:
+    """
+    if kind == EVENT_TITLE:
+        global_answer_cache.invalidate_title(target_id)
+    elif kind == EVENT_LOAD_CONFIG:
+        global_query_answers_cache.remove_if(lambda key: key[3] == target_id)
+    elif kind == EVENT_QUERY_CONFIG:
+        global_query_answers_cache.remove_if(lambda key: key[2] == target_id)
+        global_query_llm_cache.remove_if(lambda key: key[1] == target_id)
+    elif kind == EVENT_RESET:
+        global_answer_cache.invalidate_all()
+        global_query_answers_cache.clear()
 
 
 # query_answers = QueryAnswers()
 
-global_query_answers_cache: Dict[uuid.UUID, QueryAnswers] = {}
+# key: (user_id, title_id, 查询配置id, 加载配置id)
+global_query_answers_cache = LRUCache(max_size=settings.QUERY_ANSWERS_CACHE_MAX_SIZE,
+                                      idle_ttl=settings.QUERY_ANSWERS_CACHE_IDLE_SECONDS)
+title_version_registry.add_listener(on_title_version_change)
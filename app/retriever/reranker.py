@@ -0,0 +1,138 @@
+import threading
+import time
+from collections import Counter
+from typing import List, Dict
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from app.retriever.cached_embeddings import normalize_question, get_text_hash
+from app.retriever.lexical_index import tokenize
+from app.settings import settings
+from app.utils.lru_cache import LRUCache
+
+# 词频饱和参数
+TF_SATURATION = 1.2
+# 问题整体出现在段落中的加分，问题短于该长度时不加分
+PHRASE_BONUS = 1.0
+PHRASE_MIN_CHARS = 4
+# 检索阶段排名的权重，得分相同时保持检索顺序
+RANK_PRIOR_WEIGHT = 0.1
+
+
+def get_term_weight(term: str) -> float:
+    # 型号、错误码等较长的 ascii 词区分度更高
+    if term.isascii():
+        return 1.0 + min(len(term), 8) / 8
+    return 1.0
+
+
+class LexicalReranker:
+    """
+    本地 CPU 重排：按问题词在段落中的覆盖率、词频和问题原文匹配重新打分，
+    得分只与 (问题, 段落) 有关，按 (问题 hash, 段落 id) 缓存
+    """
+
+    def __init__(self, cache_max_size: int = 100000):
+        """
+        :param cache_max_size: 得分缓存条数
+        """
+        self.score_cache = LRUCache(max_size=cache_max_size)
+        self.lock = threading.Lock()
+        self.call_count = 0
+        self.total_latency_ms = 0.0
+        self.max_latency_ms = 0.0
+        self.last_latency_ms = 0.0
+
+    @staticmethod
+    def get_chunk_key(document: Document) -> str:
+        return document.id or get_text_hash(document.page_content)
+
+    @staticmethod
+    def score(question: str, query_weights: Dict[str, float], document: Document) -> float:
+        """
+        计算段落得分
+        :param question: 归一化后的问题
+        :param query_weights: 问题词 -> 权重
+        :param document:
+        :return:
+        """
+        content = normalize_question(document.page_content)
+        term_counts = Counter(tokenize(content))
+        total_weight = sum(query_weights.values())
+        coverage = sum(weight for term, weight in query_weights.items() if term in term_counts) / total_weight
+        saturation = sum(
+            weight * term_counts[term] / (term_counts[term] + TF_SATURATION)
+            for term, weight in query_weights.items()
+        ) / total_weight
+        score = 0.7 * coverage + 0.3 * saturation
+        if len(question) >= PHRASE_MIN_CHARS and question in content:
+            score += PHRASE_BONUS
+        return score
+
+    def rerank(self, question: str, documents: List[Document], top_k: int) -> List[Document]:
+        """
+        重排候选段落，保留得分最高的 top_k 个
+        :param question:
+        :param documents: 候选段落，按检索阶段的相关性排序
+        :param top_k:
+        :return:
+        """
+        start = time.perf_counter()
+        question = normalize_question(question)
+        query_weights = {term: get_term_weight(term) for term in set(tokenize(question))}
+        if not query_weights or len(documents) <= 1:
+            return documents[:top_k]
+
+        question_hash = get_text_hash(question)
+        scored = []
+        for rank, document in enumerate(documents):
+            cache_key = (question_hash, self.get_chunk_key(document))
+            score = self.score_cache.get(cache_key, None)
+            if score is None:
+                score = self.score(question, query_weights, document)
+                self.score_cache.put(cache_key, score)
+            scored.append((score + RANK_PRIOR_WEIGHT / (rank + 1), document))
+        scored.sort(key=lambda item: item[0], reverse=True)
+
+        latency_ms = (time.perf_counter() - start) * 1000
+        with self.lock:
+            self.call_count += 1
+            self.total_latency_ms += latency_ms
+            self.max_latency_ms = max(self.max_latency_ms, latency_ms)
+            self.last_latency_ms = latency_ms
+        print(f'rerank candidates: {len(documents)}, keep: {top_k}, latency: {latency_ms:.2f}ms')
+        return [document for _, document in scored[:top_k]]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "calls": self.call_count,
+                "avg_latency_ms": round(self.total_latency_ms / self.call_count, 3) if self.call_count else 0.0,
+                "max_latency_ms": round(self.max_latency_ms, 3),
+                "last_latency_ms": round(self.last_latency_ms, 3),
+                "score_cache": self.score_cache.stats(),
+            }
+
+
+class RerankRetriever(BaseRetriever):
+    """
+    重排检索：从基础检索器取 top_k * m 个候选，重排后保留 top_k 个
+    """
+    base_retriever: BaseRetriever
+    reranker: LexicalReranker
+    top_k: int = 3
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        documents = self.base_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        return self.reranker.rerank(query, documents, self.top_k)
+
+    async def _aget_relevant_documents(self, query: str, *,
+                                       run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        documents = await self.base_retriever.ainvoke(query, config={"callbacks": run_manager.get_child()})
+        # 候选段落数量少，打分耗时远小于线程切换，直接在事件循环中执行
+        return self.reranker.rerank(query, documents, self.top_k)
+
+
+global_reranker = LexicalReranker(cache_max_size=settings.RERANK_SCORE_CACHE_MAX_SIZE)
@@ -0,0 +1,131 @@
+import asyncio
+import threading
+from typing import AsyncIterator, Callable, Dict, Hashable, List, Optional
+
+
+class Flight:
+    """
+    一次进行中的生成：保存已经生成的 token，订阅者先收到已生成的 token，再实时收到新的 token
+    """
+
+    def __init__(self, key: Hashable):
+        self.key = key
+        self.tokens: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Condition()
+        # 执行生成的后台任务
+        self.task: Optional[asyncio.Task] = None
+        # 当前订阅者数，全部订阅者离开时取消生成
+        self.subscribers = 0
+        self.cancelled = False
+
+    async def append(self, token: str):
+        async with self.changed:
+            self.tokens.append(token)
+            self.changed.notify_all()
+
+    async def finish(self, error: Optional[BaseException] = None):
+        async with self.changed:
+            self.done = True
+            self.error = error
+            self.changed.notify_all()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        """
+        订阅生成结果，生成失败时抛出原异常。所有订阅者都离开（客户端断开）时取消生成
+        :return:
+        """
+        index = 0
+        self.subscribers += 1
+        try:
+            while True:
+                async with self.changed:
+                    await self.changed.wait_for(lambda: len(self.tokens) > index or self.done)
+                    tokens = self.tokens[index:]
+                    done = self.done
+                index += len(tokens)
+                for token in tokens:
+                    yield token
+                if done and index >= len(self.tokens):
+                    if self.error is not None:
+                        raise self.error
+                    return
+        finally:
+            self.subscribers -= 1
+            if self.subscribers <= 0 and not self.done and self.task is not None:
+                self.cancelled = True
+                self.task.cancel()
+
+    async def result(self) -> str:
+        return "".join([token async for token in self.subscribe()])
+
+
+class SingleFlight:
+    """
+    合并相同的并发请求：同一 key 同时只执行一次生成，后到的请求订阅进行中的生成结果。
+    生成在后台任务中执行，发起请求的客户端断开不影响其他订阅者
+    """
+
+    def __init__(self):
+        self.flights: Dict[Hashable, Flight] = {}
+        self.lock = threading.Lock()
+        self.leader_count = 0
+        self.follower_count = 0
+
+    async def _run(self, flight: Flight, factory: Callable[[], AsyncIterator[str]],
+                   on_complete: Optional[Callable[[str], None]]):
+        try:
+            async for token in factory():
+                await flight.append(token)
+        except asyncio.CancelledError as e:
+            await flight.finish(e)
+            print(f'single flight {flight.key} cancelled, generated tokens: {len(flight.tokens)}')
+            raise
+        except Exception as e:
+            await flight.finish(e)
+            print(f'Error: single flight {flight.key} failed, reason: {e}')
+        else:
+            await flight.finish()
+            if on_complete is not None:
+                try:
+                    on_complete("".join(flight.tokens))
+                except Exception as e:
+                    print(f'Error: single flight {flight.key} on_complete failed, reason: {e}')
+        finally:
+            with self.lock:
+                if self.flights.get(flight.key, None) is flight:
+                    self.flights.pop(flight.key, None)
+
+    def start(self, key: Hashable, factory: Callable[[], AsyncIterator[str]],
+              on_complete: Optional[Callable[[str], None]] = None) -> Flight:
+        """
+        获取 key 对应的进行中的生成，不存在时在后台任务中开始生成
+        :param key:
+        :param factory: 返回 token 异步迭代器的函数，只有第一个请求会调用
+        :param on_complete: 生成成功后以完整结果调用
+        :return:
+        """
+        with self.lock:
+            flight = self.flights.get(key, None)
+            # 已取消的生成不再接受新的订阅者
+            if flight is not None and not flight.cancelled:
+                self.follower_count += 1
+                return flight
+            flight = Flight(key)
+            self.flights[key] = flight
+            self.leader_count += 1
+        # flight 完成前由 flights 持有，任务不会被回收
+        flight.task = asyncio.create_task(self._run(flight, factory, on_complete))
+        return flight
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "in_flight": len(self.flights),
+                "leaders": self.leader_count,
+                "followers": self.follower_count,
+            }
+
+
+global_single_flight = SingleFlight()
@@ -0,0 +1,151 @@
+import hashlib
+import os
+import time
+import uuid
+from typing import BinaryIO, Optional, Tuple
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from app.db_model import File
+from app.utils.metrics import metrics
+
+# 上传文件按内容寻址保存，相同内容只保存一份
+BLOB_DIR = os.path.join('upload_files', 'blobs')
+# 复制上传内容时的缓冲区大小范围，按文件大小选择
+MIN_COPY_BUFFER_SIZE = 64 * 1024
+MAX_COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def get_copy_buffer_size(file_size: Optional[int]) -> int:
+    """
+    按文件大小选择缓冲区，小文件一次读完，大文件减少读写和计算 hash 的调用次数
+    :param file_size: 未知时为 None
+    :return:
+    """
+    if not file_size:
+        return MAX_COPY_BUFFER_SIZE
+    return max(MIN_COPY_BUFFER_SIZE, min(file_size, MAX_COPY_BUFFER_SIZE))
+
+
+def get_file_type(filename: str) -> str:
+    """
+    文件类型，和上传时检查文件名使用相同的规则（文件名以 pdf/txt 结尾）。
+    blob 只按内容保存，相同内容可以以不同类型上传，解析文档时按文件记录中的文件名区分类型
+    :param filename: 文件记录中的文件名
+    :return: ".pdf" / ".txt"，其他文件返回扩展名
+    """
+    if filename.endswith("pdf"):
+        return '.pdf'
+    if filename.endswith("txt"):
+        return '.txt'
+    return os.path.splitext(filename)[1].lower()
+
+
+class BlobStore:
+    """
+    按内容 sha256 寻址的文件存储：上传时边写临时文件边计算 hash，完成后原子移动到 hash 对应的路径，
+    内容已存在时直接删除临时文件。引用计数保存在 file_blobs 表中
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def get_blob_path(self, file_hash: str) -> str:
+        """
+        内容对应的文件路径，一个 hash 只对应一个文件，和引用计数一一对应
+        :param file_hash:
+        :return:
+        """
+        return os.path.join(self.root, file_hash[:2], file_hash)
+
+    def copy_to_tmp(self, source: BinaryIO, tmp_path: str, buffer_size: int) -> Tuple[str, int]:
+        """
+        从上传的临时文件复制到 blob 临时文件，同时计算 hash，在线程池中执行
+        :param source: starlette 保存上传内容的 SpooledTemporaryFile
+        :param tmp_path:
+        :param buffer_size:
+        :return: (sha256, 字节数)
+        """
+        sha256 = hashlib.sha256()
+        size = 0
+        source.seek(0)
+        with open(tmp_path, "wb") as f:
+            while chunk := source.read(buffer_size):
+                # 大块数据计算 hash、写文件时都会释放 GIL，不影响事件循环线程
+                sha256.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        return sha256.hexdigest(), size
+
+    async def save_upload(self, file: UploadFile) -> Tuple[str, str, int]:
+        """
+        上传内容写入临时文件，同时计算 hash。读写和计算 hash 都在线程池中执行，不阻塞事件循环。
+        starlette 的上传临时文件是匿名文件，无法直接移动，只能复制一次
+        :param file:
+        :return: (临时文件路径, sha256, 字节数)
+        """
+        tmp_path = os.path.join(self.tmp_dir, uuid.uuid4().hex)
+        start = time.monotonic()
+        try:
+            file_hash, size = await run_in_threadpool(self.copy_to_tmp, file.file, tmp_path,
+                                                      get_copy_buffer_size(file.size))
+        except BaseException:
+            self.discard(tmp_path)
+            raise
+        seconds = time.monotonic() - start
+        metrics.counter("upload_count").inc()
+        metrics.counter("upload_bytes").inc(size)
+        metrics.summary("upload_write_ms").observe(seconds * 1000)
+        if seconds > 0:
+            metrics.summary("upload_mb_per_second").observe(size / (1024 * 1024) / seconds)
+        return tmp_path, file_hash, size
+
+    def commit(self, tmp_path: str, file_hash: str) -> str:
+        """
+        临时文件移动到内容对应的路径，内容已经存在时删除临时文件
+        :param tmp_path:
+        :param file_hash:
+        :return: 内容对应的文件路径
+        """
+        blob_path = self.get_blob_path(file_hash)
+        if os.path.exists(blob_path):
+            self.discard(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            # 同一文件系统内 rename 是原子的，并发上传相同内容时结果相同
+            os.replace(tmp_path, blob_path)
+        return blob_path
+
+    def discard(self, tmp_path: str):
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def remove(self, file_hash: str):
+        """
+        内容不再被引用时删除文件
+        :param file_hash:
+        :return:
+        """
+        try:
+            os.remove(self.get_blob_path(file_hash))
+        except FileNotFoundError:
+            pass
+
+    def resolve_path(self, file: File) -> str:
+        """
+        文件记录对应的磁盘路径，按内容保存之前上传的文件仍使用原路径
+        :param file:
+        :return:
+        """
+        blob_path = self.get_blob_path(file.file_hash)
+        if os.path.exists(blob_path):
+            return blob_path
+        return file.filename
+
+
+global_blob_store = BlobStore(BLOB_DIR)
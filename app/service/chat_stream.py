@@ -0,0 +1,99 @@
+import asyncio
+import json
+import time
+from typing import AsyncIterator
+
+from starlette.requests import Request
+
+from app.settings import settings
+from app.utils.metrics import metrics
+
+# 生成结束标记
+STREAM_DONE = object()
+
+
+def format_data_event(data: str) -> str:
+    return f"data: {json.dumps({'data': data}, ensure_ascii=False)}\n\n"
+
+
+async def sse_event_stream(request: Request, tokens: AsyncIterator[str], started_at: float) -> AsyncIterator[str]:
+    """
+    把 token 流转为 SSE 事件流：
+    合并短时间内的多个 token 为一个事件；空闲时发送心跳注释，避免代理断开连接；
+    客户端断开时取消上游生成，并记录首字节时间和取消次数
+    :param request:
+    :param tokens: token 异步迭代器
+    :param started_at: 收到请求的时间（time.monotonic）
+    :return:
+    """
+    token_queue = asyncio.Queue()
+
+    async def produce():
+        try:
+            async for token in tokens:
+                await token_queue.put(token)
+            await token_queue.put(STREAM_DONE)
+        except Exception as e:
+            await token_queue.put(e)
+
+    producer = asyncio.create_task(produce())
+    coalesce_seconds = settings.STREAM_COALESCE_MS / 1000
+    buffer = []
+    buffer_chars = 0
+    buffer_started_at = 0.0
+    first_frame = True
+    completed = False
+
+    def flush() -> str:
+        nonlocal buffer, buffer_chars, first_frame
+        if first_frame:
+            first_frame = False
+            metrics.summary("chat_stream_ttfb_ms").observe((time.monotonic() - started_at) * 1000)
+        event = format_data_event("".join(buffer))
+        metrics.counter("chat_stream_frames").inc()
+        buffer = []
+        buffer_chars = 0
+        return event
+
+    try:
+        while True:
+            if buffer:
+                timeout = max(0.0, buffer_started_at + coalesce_seconds - time.monotonic())
+            else:
+                timeout = settings.STREAM_HEARTBEAT_SECONDS
+            try:
+                item = await asyncio.wait_for(token_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                # 每次发送前检查客户端是否断开
+                if await request.is_disconnected():
+                    return
+                yield flush() if buffer else ": heartbeat\n\n"
+                continue
+
+            if item is STREAM_DONE:
+                if buffer:
+                    yield flush()
+                completed = True
+                return
+            if isinstance(item, Exception):
+                if buffer:
+                    yield flush()
+                raise item
+
+            metrics.counter("chat_stream_tokens").inc()
+            if not buffer:
+                buffer_started_at = time.monotonic()
+            buffer.append(item)
+            buffer_chars += len(item)
+            if buffer_chars >= settings.STREAM_COALESCE_MAX_CHARS:
+                if await request.is_disconnected():
+                    return
+                yield flush()
+    finally:
+        # 客户端断开或出错时取消上游生成
+        producer.cancel()
+        if completed:
+            metrics.counter("chat_stream_completed").inc()
+        else:
+            metrics.counter("chat_stream_cancelled").inc()
+            print(f'chat stream cancelled: {request.url.path}')
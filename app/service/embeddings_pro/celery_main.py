@@ -2,5 +2,10 @@ from celery import Celery
 
 celery_app = Celery('app.service.embeddings_pro.tasks',
                     broker='redis://localhost:6379/1',
-                    backend='redis://localhost:6379/2')
-celery_app.conf.task_routes = {'tasks.*': {'queue': 'vectorize'}}
+                    backend='redis://localhost:6379/2',
+                    include=['app.service.embeddings_pro.tasks'])
+celery_app.conf.task_routes = {'app.service.embeddings_pro.tasks.*': {'queue': 'vectorize'}}
+# 任务执行完成后才确认，worker 异常退出时任务重新投递；任务本身是幂等的
+celery_app.conf.task_acks_late = True
+celery_app.conf.task_reject_on_worker_lost = True
+celery_app.conf.worker_prefetch_multiplier = 1
@@ -1,14 +1,148 @@
-from typing import List
+import uuid
+from typing import List, Dict
 
 import redis
+from celery import chord
+from celery.signals import worker_process_init
+from langchain_core.documents import Document
 
+from app.db_model import FileStatus
+from app.db_option import get_file_by_id
+from app.retriever.embedding_pipeline import ChunkBatch, is_rate_limit_error
+from app.retriever.load_file_thread import load_file_thread, ParentDocumentInfo
 from app.service.embeddings_pro.celery_main import celery_app
+from app.service.title_version import title_version_registry
+from app.settings import settings
 
-redis = redis.from_url('redis://localhost:6379/0')
+redis_client = redis.from_url(settings.REDIS_URL)
 
 
-@celery_app.task(bind=True)
-def process_document(self, user_id: str, title_id: str, file_path_list: List[str]):
-    print(f'process_document: {user_id}, {title_id}, {file_path_list}')
-    for file_path in file_path_list:
-        print(f'process_document: {file_path}')
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    # worker 进程只加载模型，不启动本地消费线程；worker 本身是子进程，直接在当前进程解析文档
+    load_file_thread.use_process_pool = False
+    load_file_thread.load_models()
+
+
+def get_ingest_lock_key(file_id: str, file_hash: str) -> str:
+    return f'ingest_lock:{file_id}:{file_hash}'
+
+
+def get_document_info(file_id: str) -> ParentDocumentInfo | None:
+    file = get_file_by_id(uuid.UUID(file_id))
+    if file is None:
+        return None
+    return ParentDocumentInfo.from_file(file)
+
+
+def release_ingest_lock(file_id: str):
+    file = get_file_by_id(uuid.UUID(file_id))
+    if file is not None:
+        redis_client.delete(get_ingest_lock_key(file_id, file.file_hash))
+
+
+@celery_app.task(bind=True, autoretry_for=(Exception,), retry_backoff=True, max_retries=3)
+def process_document(self, file_id: str) -> Dict:
+    """
+    解析切分文件，并按批次分发嵌入任务，所有批次完成后汇总结果
+    :param self:
+    :param file_id:
+    :return:
+    """
+    file = get_file_by_id(uuid.UUID(file_id))
+    if file is None:
+        print(f'process_document: file {file_id} not exists')
+        return {"file_id": file_id, "status": "not_found"}
+    if file.status == FileStatus.COMPLETE.value:
+        return {"file_id": file_id, "status": file.status}
+
+    # 幂等：同一文件内容同时只处理一次，重试时任务id不变可以继续执行
+    lock_key = get_ingest_lock_key(file_id, file.file_hash)
+    if not redis_client.set(lock_key, self.request.id, nx=True, ex=settings.CELERY_INGEST_LOCK_SECONDS):
+        owner = redis_client.get(lock_key)
+        if owner is not None and owner.decode() != self.request.id:
+            print(f'process_document: file {file_id} is processing by task {owner.decode()}')
+            return {"file_id": file_id, "status": "processing"}
+
+    document_info = ParentDocumentInfo.from_file(file)
+    # 其他 title 已经入库的相同内容，直接复制段落和向量
+    if load_file_thread.try_clone_file(document_info):
+        redis_client.delete(lock_key)
+        return {"file_id": file_id, "status": FileStatus.COMPLETE.value}
+    try:
+        chunk_ids, split_docs = load_file_thread.prepare_chunks(document_info)
+        batches, _ = load_file_thread.get_pending_batches(document_info, chunk_ids, split_docs)
+    except Exception as e:
+        if self.request.retries >= self.max_retries:
+            load_file_thread.update_file_status(document_info, status=FileStatus.FAILED.value, error_msg=str(e))
+            redis_client.delete(lock_key)
+        raise
+
+    load_file_thread.update_file_status(document_info, status=FileStatus.EMBEDDING.value)
+    if not batches:
+        return finish_document([], file_id)
+
+    header = [
+        embed_chunk_batch.s(file_id, batch.batch_index, batch.ids,
+                            [doc.page_content for doc in batch.documents],
+                            [doc.metadata for doc in batch.documents])
+        for batch in batches
+    ]
+    chord(header)(finish_document.s(file_id).on_error(mark_document_failed.s(file_id)))
+    return {"file_id": file_id, "status": FileStatus.EMBEDDING.value, "batches": len(batches)}
+
+
+@celery_app.task(bind=True, max_retries=5)
+def embed_chunk_batch(self, file_id: str, batch_index: int, ids: List[str], texts: List[str],
+                      metadatas: List[Dict]) -> int:
+    """
+    嵌入一批段落并写入向量数据库，段落id固定，重复执行结果相同
+    :return: 新保存的段落数
+    """
+    document_info = get_document_info(file_id)
+    if document_info is None:
+        return 0
+    batch = ChunkBatch(batch_index=batch_index, ids=ids,
+                       documents=[Document(page_content=text, metadata=metadata)
+                                  for text, metadata in zip(texts, metadatas)])
+    try:
+        load_file_thread.embedding_pipeline.process_batch(
+            load_file_thread.embeddings, load_file_thread.get_vectorstore(document_info.title_id), batch, None
+        )
+    except Exception as e:
+        # 限流时等待更久再重试
+        countdown = 30 * (self.request.retries + 1) if is_rate_limit_error(e) else 2 ** self.request.retries
+        raise self.retry(exc=e, countdown=countdown)
+    return load_file_thread.save_batch_chunks(document_info, batch)
+
+
+@celery_app.task
+def finish_document(results: List[int], file_id: str) -> Dict:
+    """
+    所有批次完成后，更新文件状态
+    :param results: 各批次新保存的段落数
+    :param file_id:
+    :return:
+    """
+    document_info = get_document_info(file_id)
+    if document_info is not None:
+        load_file_thread.update_file_status(document_info, status=FileStatus.COMPLETE.value)
+        # 通知 api worker 重新生成该 title 的检索链
+        title_version_registry.bump(document_info.title_id)
+    release_ingest_lock(file_id)
+    print(f'finish_document: {file_id}, added chunks: {sum(results)}')
+    return {"file_id": file_id, "status": FileStatus.COMPLETE.value, "added_chunks": sum(results)}
+
+
+@celery_app.task
+def mark_document_failed(request, exc, traceback, file_id: str):
+    """
+    有批次最终失败时，记录失败状态，已完成的批次可以在重新处理时跳过
+    """
+    print(f'process document {file_id} failed, task: {request.id}, reason: {exc}')
+    document_info = get_document_info(file_id)
+    if document_info is not None:
+        load_file_thread.update_file_status(document_info, status=FileStatus.FAILED.value, error_msg=str(exc))
+        # 部分批次已经写入向量数据库
+        title_version_registry.bump(document_info.title_id)
+    release_ingest_lock(file_id)
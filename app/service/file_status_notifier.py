@@ -0,0 +1,64 @@
+import asyncio
+import threading
+import uuid
+from typing import Dict, Set, Tuple
+
+from app.db_model import FileStatusPublic
+
+# 每个订阅者最多缓存的事件数，客户端消费过慢时丢弃新的进度事件
+SUBSCRIBER_QUEUE_SIZE = 256
+
+
+def _put_event(event_queue: asyncio.Queue, event: FileStatusPublic):
+    try:
+        event_queue.put_nowait(event)
+    except asyncio.QueueFull:
+        pass
+
+
+class FileStatusNotifier:
+    """
+    进程内文件状态通知：入库线程发布状态变化，按 title 推送给 SSE 订阅者
+    """
+
+    def __init__(self):
+        # title_id -> {(事件循环, 事件队列)}
+        self.subscribers: Dict[uuid.UUID, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, title_id: uuid.UUID) -> asyncio.Queue:
+        """
+        订阅 title 下的文件状态，需要在事件循环中调用
+        :param title_id:
+        :return:
+        """
+        event_queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.setdefault(title_id, set()).add((asyncio.get_running_loop(), event_queue))
+        return event_queue
+
+    def unsubscribe(self, title_id: uuid.UUID, event_queue: asyncio.Queue):
+        with self.lock:
+            subscribers = self.subscribers.get(title_id, set())
+            for item in [item for item in subscribers if item[1] is event_queue]:
+                subscribers.discard(item)
+            if not subscribers:
+                self.subscribers.pop(title_id, None)
+
+    def publish(self, file_status: FileStatusPublic):
+        """
+        发布文件状态，可在任意线程中调用
+        :param file_status:
+        :return:
+        """
+        with self.lock:
+            subscribers = list(self.subscribers.get(file_status.title_id, set()))
+        for loop, event_queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(_put_event, event_queue, file_status)
+            except RuntimeError:
+                # 事件循环已关闭
+                self.unsubscribe(file_status.title_id, event_queue)
+
+
+file_status_notifier = FileStatusNotifier()
@@ -1,38 +1,115 @@
-import asyncio
-import multiprocessing
+import os
+from dataclasses import dataclass, field
+from typing import List, Dict, Optional
 
-from app.utils.user_base_model import TaskConfig
+from langchain_community.document_loaders import TextLoader
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from unstructured.partition.pdf import partition_pdf
+
+PDF_PIC_DIR = 'pdf_pic'
+os.makedirs(PDF_PIC_DIR, exist_ok=True)
+
+
+@dataclass
+class LoadDocTask:
+    file_path: str = field(metadata={"description": "文件路径"})
+    # blob 文件没有扩展名，文件类型由文件记录中的文件名确定，为空时按路径判断
+    file_type: str = field(default="", metadata={"description": "文件类型，.pdf / .txt"})
+    split_len: int = field(default=1000, metadata={"description": "文本分段长度"})
+    over_lap: int = field(default=200, metadata={"description": "文本重叠长度"})
+    split_way: str = field(default="Recursive", metadata={"description": "文本分段方式"})
+
+
+@dataclass
+class ChunkPayload:
+    text: str = field(metadata={"description": "段落内容"})
+    metadata: Dict = field(metadata={"description": "段落元数据"})
 
 
 class LoadDoc:
-    def __init__(self,
-                 process_id: int,
-                 task_queue: multiprocessing.Queue,
-                 event_queue: multiprocessing.Queue,
-                 event: multiprocessing.Event):
+    """
+    在子进程中加载并切分文档，解析 pdf 占用大量 CPU，放到子进程中不影响 api 进程处理请求。
+    只返回精简的段落数据，由主进程完成嵌入
+    """
+
+    def __init__(self, process_id: int):
         self.process_id = process_id
-        self.task_queue = task_queue
-        self.event_queue = event_queue
-        self.is_busy = event
-        self.running = True
-
-    async def task_loop(self):
-        while self.running:
-            task = await self.task_queue.get(timeout=0.1)
-            if isinstance(task, TaskConfig):
-                print(f"load_doc: task is TaskConfig: {task}")
-                await self.load_document(task)
-
-            await asyncio.sleep(0.01)
-
-    async def event_loop(self):
-        while self.running:
-            event = self.event_queue.get(timeout=0.1)
-            if event == "stop":
-                print(f"load_doc: event is stop")
-                self.running = False
-                self.is_busy.set()
-            await asyncio.sleep(0.01)
-
-    async def load_document(self, task_config: TaskConfig):
-        pass
+        # (split_way, split_len, over_lap) -> 切分器
+        self.text_spliter_by_config = {}
+
+    def get_text_spliter(self, task: LoadDocTask):
+        key = (task.split_way, task.split_len, task.over_lap)
+        text_spliter = self.text_spliter_by_config.get(key, None)
+        if text_spliter is None:
+            if task.split_way == "Recursive":
+                text_spliter = RecursiveCharacterTextSplitter(
+                    chunk_size=task.split_len,
+                    chunk_overlap=task.over_lap,
+                    length_function=len,
+                )
+            else:
+                raise Exception(f'Error: {task.split_way} is not supported.')
+            self.text_spliter_by_config[key] = text_spliter
+        return text_spliter
+
+    def load_document(self, task: LoadDocTask) -> List[ChunkPayload]:
+        print(f'process {self.process_id} load document: {task.file_path}')
+        file_type = task.file_type or os.path.splitext(task.file_path)[1].lower()
+        if file_type == ".txt":
+            loader = TextLoader(task.file_path, encoding="utf-8")
+            split_docs = self.get_text_spliter(task).split_documents(loader.load())
+            return [
+                ChunkPayload(text=doc.page_content, metadata={**doc.metadata, "doc_id": i, "type": "txt"})
+                for i, doc in enumerate(split_docs)
+            ]
+
+        if file_type == ".pdf":
+            try:
+                raw_pdf_elements = partition_pdf(
+                    strategy="fast",
+                    filename=task.file_path,
+                    # Unstructured first finds embedded image blocks
+                    extract_images_in_pdf=False,
+                    # Use layout model (YOLOX) to get bounding boxes (for tables) and find titles
+                    # Titles are any sub-section of the document
+                    infer_table_structure=True,
+                    # Post processing to aggregate text once we have the title
+                    chunking_strategy="by_title",
+                    # Chunking params to aggregate text blocks
+                    # Attempt to create a new chunk 3800 chars
+                    # Attempt to keep chunks > 2000 chars
+                    max_characters=4000,
+                    new_after_n_chars=3800,
+                    combine_text_under_n_chars=2000,
+                    image_output_dir_path=PDF_PIC_DIR,
+                )
+            except Exception as e:
+                print(f'load pdf failed, reason: {e}')
+                raise Exception(f'load pdf failed, reason: {e}')
+            return [
+                ChunkPayload(text=element.text,
+                             metadata={"source": task.file_path, "doc_id": i, "type": "pdf"})
+                for i, element in enumerate(raw_pdf_elements)
+            ]
+
+        raise Exception(f'Error file type: {task.file_path}')
+
+
+# 子进程中的 LoadDoc 对象，由 init_load_doc_process 创建
+process_load_doc: Optional[LoadDoc] = None
+
+
+def init_load_doc_process():
+    global process_load_doc
+    process_load_doc = LoadDoc(os.getpid())
+
+
+def run_load_doc_task(task: LoadDocTask) -> List[ChunkPayload]:
+    """
+    子进程中执行的任务入口，需要是模块级函数才能被 pickle
+    :param task:
+    :return:
+    """
+    if process_load_doc is None:
+        init_load_doc_process()
+    return process_load_doc.load_document(task)
@@ -1,72 +1,99 @@
 import multiprocessing
 import os
 import threading
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Tuple
 
-from app.service.load_doc import LoadDoc
-from app.utils.user_base_model import TaskConfig
-
-process_dict = {}
+from app.service.load_doc import LoadDocTask, ChunkPayload, init_load_doc_process, run_load_doc_task
+from app.settings import settings
 
 cpu_count = os.cpu_count()
 
 
-def manager():
-    global process_dict
-    process_num = min(4, cpu_count)
-    print(f'start {process_num} process')
-    for i in range(process_num):
-        p = multiprocessing.Process(target=LoadDoc, args=(task_queue, event_queue))
-        p.start()
-        process_dict[i] = p
-
-
 class LoadDocManager:
+    """
+    文档解析进程池，解析和切分在子进程中执行，可以利用多核且不和 api 争抢 GIL
+    """
+
     def __init__(self):
-        self.process_num = min(4, cpu_count)
-        self.process_dict = {}
-        # self.task_queue = multiprocessing.Queue()
-        # self.event_queue = multiprocessing.Queue()
+        self.process_num = settings.LOAD_DOC_PROCESS_NUM or min(4, cpu_count)
+        self.executor = None
         self.lock = threading.Lock()
         self.running = False
 
     def start(self):
+        with self.lock:
+            self.start_locked()
+
+    def start_locked(self):
+        """
+        启动进程池，调用方持有 self.lock
+        :return:
+        """
         if self.running:
             print("already running")
             return
         print(f'start {self.process_num} process')
-        for i in range(self.process_num):
-            event = multiprocessing.Event()
-            event.clear()
-            task_queue = multiprocessing.Queue()
-            event_queue = multiprocessing.Queue()
-            p = multiprocessing.Process(target=LoadDoc, args=(i, task_queue, event_queue, event))
-            p.start()
-            self.process_dict[i] = {"process": p, "event": event, "task_queue:": task_queue, "event_queue": event_queue}
-            print(f'process {i} start')
+        # spawn 方式启动子进程，不继承 api 进程中的线程和连接
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.process_num,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_load_doc_process,
+        )
         self.running = True
 
-    def consume_task(self, task_config: TaskConfig):
-        if not self.running:
-            return False, "not running"
-        find_pro = False
+    def submit(self, task: LoadDocTask) -> Tuple[ProcessPoolExecutor, Future]:
+        """
+        在锁内读取进程池并提交任务，不会读到其他线程重建进程池时的中间状态
+        :param task:
+        :return: (提交到的进程池, Future)
+        """
         with self.lock:
-            for i, process_info in self.process_dict:
-                if not process_info["event"].is_set():
-                    process_info["event"].set()
-                    process_info["process"].task_queue.put(task_config)
-                    find_pro = True
-                    break
-        if not find_pro:
-            return False, "no process available"
-        return True, "success"
+            if not self.running:
+                self.start_locked()
+            executor = self.executor
+            return executor, executor.submit(run_load_doc_task, task)
 
-    def stop(self):
+    def load_document(self, task: LoadDocTask) -> List[ChunkPayload]:
+        """
+        在进程池中解析切分文档。任一子进程异常退出时，进程池中所有进行中的任务都会失败，
+        重建进程池后重试一次；再次失败说明是当前文件导致子进程退出，不再重试
+        :param task:
+        :return: 段落列表
+        """
+        for attempt in range(2):
+            executor, future = self.submit(task)
+            try:
+                return future.result()
+            except BrokenProcessPool as e:
+                print(f'Error: load doc process pool broken, restart. attempt: {attempt + 1}, {e}')
+                self.restart(executor)
+        raise Exception(f'load document failed, process exited: {task.file_path}')
+
+    def restart(self, broken_executor: ProcessPoolExecutor):
+        """
+        重建进程池。多个任务同时发现进程池异常时只重建一次，不关闭其他线程已经重建的进程池
+        :param broken_executor: 任务提交到的进程池
+        :return:
+        """
+        with self.lock:
+            if self.executor is not broken_executor:
+                return
+            self.stop_locked(wait=False)
+            self.start_locked()
+
+    def stop(self, wait: bool = True):
+        with self.lock:
+            self.stop_locked(wait)
+
+    def stop_locked(self, wait: bool = True):
+        if not self.running:
+            return
         self.running = False
-        for i, process_info in self.process_dict:
-            process_info["event"].set()
-            process_info["process"].event_queue.put("stop")
-            process_info["process"].join()
-            print(f'process {i} stop')
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+        self.executor = None
+        print('load doc process pool stop')
 
 
-load_doc_manager = LoadDocManager()
\ No newline at end of file
+load_doc_manager = LoadDocManager()
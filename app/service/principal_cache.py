@@ -0,0 +1,110 @@
+import hashlib
+import threading
+import time
+import uuid
+from typing import Any, Dict, Optional, Set
+
+from sqlalchemy.orm import make_transient_to_detached
+
+from app.db_model import User
+from app.service.title_version import title_version_registry, EVENT_USER, EVENT_RESET
+from app.utils.lru_cache import LRUCache
+from app.settings import settings
+
+
+def get_token_key(token: str) -> str:
+    # 不在内存中保存原始 token
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class PrincipalCache:
+    """
+    已验证的 (token, 用户) 缓存：命中时不需要解码 token、查询用户，缓存时间很短，且不超过 token 的过期时间。
+    用户修改、删除时通过 title 版本号的 pub/sub 通知所有 worker 淘汰
+    """
+
+    def __init__(self, ttl_seconds: float, max_size: int = 4096):
+        """
+        :param ttl_seconds: 缓存时间
+        :param max_size: 最多缓存的 token 数
+        """
+        self.ttl_seconds = ttl_seconds
+        # token hash -> (过期时间, 用户快照)
+        self.cache = LRUCache(max_size=max_size, on_evict=self.on_evict)
+        # 用户 -> token hash，淘汰用户时使用
+        self.keys_by_user: Dict[uuid.UUID, Set[str]] = {}
+        self.lock = threading.Lock()
+
+    def on_evict(self, key: str, item: Any):
+        self.remove_user_key(item[1].id, key)
+
+    def remove_user_key(self, user_id: uuid.UUID, key: str):
+        with self.lock:
+            keys = self.keys_by_user.get(user_id, None)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    self.keys_by_user.pop(user_id, None)
+
+    def get(self, token: str) -> Optional[User]:
+        """
+        获取 token 对应的用户快照，快照不属于任何 session，使用前需要 merge 到当前 session
+        :param token:
+        :return:
+        """
+        if self.ttl_seconds <= 0:
+            return None
+        key = get_token_key(token)
+        item = self.cache.get(key, None)
+        if item is None:
+            return None
+        expires_at, user = item
+        if time.time() >= expires_at:
+            self.cache.pop(key, None)
+            self.remove_user_key(user.id, key)
+            return None
+        return user
+
+    def put(self, token: str, user: User, token_expires_at: Optional[float] = None):
+        """
+        缓存用户快照
+        :param token:
+        :param user: 刚从数据库读取的用户
+        :param token_expires_at: token 的过期时间戳
+        :return:
+        """
+        if self.ttl_seconds <= 0:
+            return
+        expires_at = time.time() + self.ttl_seconds
+        if token_expires_at is not None:
+            expires_at = min(expires_at, token_expires_at)
+        # 复制一份脱离 session 的快照，各请求 merge 得到自己的对象，互不影响
+        snapshot = User(**{name: getattr(user, name) for name in User.model_fields.keys()})
+        make_transient_to_detached(snapshot)
+        key = get_token_key(token)
+        with self.lock:
+            self.keys_by_user.setdefault(snapshot.id, set()).add(key)
+        self.cache.put(key, (expires_at, snapshot))
+
+    def invalidate_user(self, user_id: uuid.UUID):
+        """
+        用户修改、删除后调用，通知所有 worker 淘汰该用户的缓存
+        :param user_id:
+        :return:
+        """
+        title_version_registry.publish_config_change(EVENT_USER, user_id)
+
+    def on_title_version_change(self, kind: str, target_id: Optional[uuid.UUID], version: int):
+        if kind == EVENT_USER:
+            with self.lock:
+                keys = self.keys_by_user.pop(target_id, set())
+            self.cache.remove_if(lambda key: key in keys)
+        elif kind == EVENT_RESET:
+            self.cache.clear()
+
+    def stats(self):
+        return self.cache.stats()
+
+
+global_principal_cache = PrincipalCache(ttl_seconds=settings.AUTH_PRINCIPAL_TTL_SECONDS)
+title_version_registry.add_listener(global_principal_cache.on_title_version_change)
@@ -0,0 +1,242 @@
+import heapq
+import itertools
+import math
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from app.settings import settings
+from app.utils.lru_cache import LRUCache
+
+
+class RateLimitExceeded(Exception):
+    """
+    超出限制，retry_after 为建议的重试等待时间（秒）
+    """
+
+    def __init__(self, message: str, retry_after: float, queue_position: Optional[int] = None):
+        super().__init__(message)
+        self.message = message
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.queue_position = queue_position
+
+    def to_http_exception(self) -> HTTPException:
+        detail = {"msg": self.message, "retry_after": self.retry_after}
+        if self.queue_position is not None:
+            detail["queue_position"] = self.queue_position
+        return HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(self.retry_after)})
+
+
+class TokenBucket:
+    """
+    令牌桶：每秒补充 rate 个令牌，最多 capacity 个
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_seconds(self, cost: float = 1.0) -> float:
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+
+class ChatScheduler:
+    """
+    问答准入控制：按用户、按 title 的令牌桶限制请求速率，按用户限制同时进行中的请求数
+    """
+
+    def __init__(self, user_rate: float, user_burst: float, title_rate: float, title_burst: float,
+                 user_max_concurrency: int, max_tracked: int = 10000):
+        """
+        :param user_rate: 每个用户每秒请求数
+        :param user_burst: 每个用户允许的突发请求数
+        :param title_rate: 每个 title 每秒请求数
+        :param title_burst: 每个 title 允许的突发请求数
+        :param user_max_concurrency: 每个用户同时进行中的请求数
+        :param max_tracked: 最多记录的令牌桶数，长时间不活跃的用户、title 被淘汰
+        """
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.title_rate = title_rate
+        self.title_burst = title_burst
+        self.user_max_concurrency = user_max_concurrency
+        self.buckets = LRUCache(max_size=max_tracked)
+        self.in_flight: Dict[Hashable, int] = {}
+        self.lock = threading.Lock()
+        self.rejected_count = 0
+
+    def _get_bucket(self, key: Tuple, rate: float, capacity: float) -> TokenBucket:
+        return self.buckets.get_or_create(key, lambda: TokenBucket(rate, capacity))
+
+    def acquire(self, user_id: Hashable, title_id: Hashable):
+        """
+        请求开始前调用，超出限制时抛出 RateLimitExceeded，成功后必须调用 release
+        :param user_id:
+        :param title_id:
+        :return:
+        """
+        user_bucket = self._get_bucket(("user", user_id), self.user_rate, self.user_burst)
+        title_bucket = self._get_bucket(("title", title_id), self.title_rate, self.title_burst)
+        with self.lock:
+            if self.in_flight.get(user_id, 0) >= self.user_max_concurrency:
+                self.rejected_count += 1
+                raise RateLimitExceeded(f"too many concurrent requests, limit: {self.user_max_concurrency}",
+                                        retry_after=1)
+            now = time.monotonic()
+            user_bucket.refill(now)
+            title_bucket.refill(now)
+            # 两个令牌桶都有令牌时才扣除，避免一个桶被拒绝的请求消耗另一个桶
+            wait_seconds = max(user_bucket.wait_seconds(), title_bucket.wait_seconds())
+            if wait_seconds > 0:
+                self.rejected_count += 1
+                raise RateLimitExceeded("too many requests", retry_after=wait_seconds)
+            user_bucket.tokens -= 1
+            title_bucket.tokens -= 1
+            self.in_flight[user_id] = self.in_flight.get(user_id, 0) + 1
+
+    def release(self, user_id: Hashable):
+        with self.lock:
+            count = self.in_flight.get(user_id, 0) - 1
+            if count > 0:
+                self.in_flight[user_id] = count
+            else:
+                self.in_flight.pop(user_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "in_flight": sum(self.in_flight.values()),
+                "active_users": len(self.in_flight),
+                "rejected": self.rejected_count,
+            }
+
+
+@dataclass(order=True)
+class FairTask:
+    finish_tag: float
+    sequence: int
+    key: Hashable = field(compare=False)
+    item: Any = field(compare=False)
+
+
+class FairTaskQueue:
+    """
+    加权公平队列：每个租户（用户）的任务按虚拟完成时间排序出队，
+    任务多的租户不会阻塞其他租户，权重越大分到的处理份额越多。接口与 queue.Queue 的 put/get/qsize 类似
+    """
+
+    def __init__(self, max_queued_per_key: int = 20, weights: Optional[Dict[Hashable, float]] = None):
+        """
+        :param max_queued_per_key: 每个租户最多排队的任务数
+        :param weights: 租户权重，默认 1
+        """
+        self.max_queued_per_key = max_queued_per_key
+        self.weights = weights or {}
+        self.heap: List[FairTask] = []
+        self.sequence = itertools.count()
+        # 当前虚拟时间：最近出队任务的完成时间
+        self.virtual_time = 0.0
+        # 租户 -> 最后一个入队任务的虚拟完成时间
+        self.last_finish_by_key: Dict[Hashable, float] = {}
+        self.queued_by_key: Dict[Hashable, int] = {}
+        self.cond = threading.Condition()
+        # 任务平均处理时间（秒），用于估计重试等待时间
+        self.avg_task_seconds = 30.0
+
+    def _check(self, key: Hashable):
+        if self.queued_by_key.get(key, 0) >= self.max_queued_per_key:
+            raise RateLimitExceeded(f"too many queued tasks, limit: {self.max_queued_per_key}",
+                                    retry_after=self.avg_task_seconds, queue_position=self._position(key))
+
+    def check(self, key: Hashable):
+        """
+        入队前检查租户排队任务数，超过限制时抛出 RateLimitExceeded
+        :param key:
+        :return:
+        """
+        with self.cond:
+            self._check(key)
+
+    def put(self, item: Any, key: Hashable, cost: float = 1.0, force: bool = False):
+        """
+        任务入队，租户排队任务数超过限制时抛出 RateLimitExceeded
+        :param item:
+        :param key: 租户
+        :param cost: 任务代价
+        :param force: 不检查排队任务数（服务重启后恢复未完成的任务）
+        :return:
+        """
+        with self.cond:
+            if not force:
+                self._check(key)
+            start_tag = max(self.virtual_time, self.last_finish_by_key.get(key, 0.0))
+            finish_tag = start_tag + cost / self.weights.get(key, 1.0)
+            self.last_finish_by_key[key] = finish_tag
+            self.queued_by_key[key] = self.queued_by_key.get(key, 0) + 1
+            heapq.heappush(self.heap, FairTask(finish_tag, next(self.sequence), key, item))
+            self.cond.notify()
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        """
+        取出虚拟完成时间最小的任务，超时抛出 queue.Empty
+        :param timeout:
+        :return:
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.heap, timeout):
+                raise queue.Empty
+            task = heapq.heappop(self.heap)
+            self.virtual_time = task.finish_tag
+            count = self.queued_by_key.get(task.key, 0) - 1
+            if count > 0:
+                self.queued_by_key[task.key] = count
+            else:
+                # 租户没有排队任务时，其最后完成时间等于当前虚拟时间，不需要保留
+                self.queued_by_key.pop(task.key, None)
+                self.last_finish_by_key.pop(task.key, None)
+            return task.item
+
+    def _position(self, key: Hashable) -> int:
+        # 租户下一个任务之前需要处理的任务数
+        tasks = [task for task in self.heap if task.key == key]
+        if not tasks:
+            return len(self.heap)
+        head = min(tasks)
+        return sum(1 for task in self.heap if task < head)
+
+    def position(self, key: Hashable) -> int:
+        with self.cond:
+            return self._position(key)
+
+    def record_task_seconds(self, seconds: float):
+        with self.cond:
+            self.avg_task_seconds = 0.8 * self.avg_task_seconds + 0.2 * seconds
+
+    def qsize(self) -> int:
+        with self.cond:
+            return len(self.heap)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.cond:
+            return {
+                "queued": len(self.heap),
+                "queued_by_key": {str(key): count for key, count in self.queued_by_key.items()},
+                "avg_task_seconds": round(self.avg_task_seconds, 3),
+            }
+
+
+chat_scheduler = ChatScheduler(user_rate=settings.CHAT_USER_RATE, user_burst=settings.CHAT_USER_BURST,
+                               title_rate=settings.CHAT_TITLE_RATE, title_burst=settings.CHAT_TITLE_BURST,
+                               user_max_concurrency=settings.CHAT_USER_MAX_CONCURRENCY)
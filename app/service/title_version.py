@@ -0,0 +1,164 @@
+import json
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+import redis
+
+from app.settings import settings
+
+TITLE_VERSION_CHANNEL = 'title_version'
+# 配置变化事件类型
+EVENT_TITLE = 'title'
+EVENT_LOAD_CONFIG = 'load_config'
+EVENT_QUERY_CONFIG = 'query_config'
+# 用户信息修改或删除
+EVENT_USER = 'user'
+# 订阅断开期间可能漏掉事件，重新订阅后通知监听者清空所有缓存，id 为 None
+EVENT_RESET = 'reset'
+# 订阅断开后的重连间隔（秒）
+RESUBSCRIBE_SECONDS = 3
+
+
+def get_title_version_key(title_id: uuid.UUID) -> str:
+    return f'title_version:{title_id}'
+
+
+class TitleVersionRegistry:
+    """
+    title 版本号：title 下的文件或使用的配置变化时版本号加 1，并通过 redis pub/sub 通知所有 worker。
+    各 worker 在订阅线程中更新本地版本号并回调监听者，请求时只比较本地版本号，不访问 redis
+    """
+
+    def __init__(self, redis_url: str):
+        self.redis_client = redis.from_url(redis_url)
+        # title_id -> 本地已知的最新版本号
+        self.versions: Dict[uuid.UUID, int] = {}
+        # 回调参数：(事件类型, id, 版本号)
+        self.listeners: List[Callable[[str, Optional[uuid.UUID], int], None]] = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.subscribe_thread: Optional[threading.Thread] = None
+
+    def add_listener(self, listener: Callable[[str, Optional[uuid.UUID], int], None]):
+        with self.lock:
+            self.listeners.append(listener)
+
+    def _notify(self, kind: str, target_id: Optional[uuid.UUID], version: int):
+        with self.lock:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            try:
+                listener(kind, target_id, version)
+            except Exception as e:
+                print(f'Error: title version listener failed, {kind}: {target_id}, reason: {e}')
+
+    def _apply(self, kind: str, target_id: uuid.UUID, version: int):
+        if kind == EVENT_TITLE:
+            with self.lock:
+                # 自己发布的事件也会收到，版本号没有变大时忽略
+                if version <= self.versions.get(target_id, -1):
+                    return
+                self.versions[target_id] = version
+        self._notify(kind, target_id, version)
+
+    def get_version(self, title_id: uuid.UUID) -> int:
+        """
+        获取 title 版本号，本地没有时从 redis 读取一次，之后由订阅线程更新
+        :param title_id:
+        :return:
+        """
+        title_id = uuid.UUID(str(title_id))
+        with self.lock:
+            version = self.versions.get(title_id, None)
+        if version is not None:
+            return version
+        try:
+            value = self.redis_client.get(get_title_version_key(title_id))
+            version = int(value) if value else 0
+        except Exception as e:
+            print(f'Error: get title version from redis failed. {e}')
+            return 0
+        with self.lock:
+            return self.versions.setdefault(title_id, version)
+
+    def bump(self, title_id: uuid.UUID) -> int:
+        """
+        title 下的文件或配置变化后调用，版本号加 1 并通知所有 worker
+        :param title_id:
+        :return: 新版本号
+        """
+        title_id = uuid.UUID(str(title_id))
+        try:
+            version = int(self.redis_client.incr(get_title_version_key(title_id)))
+            self.redis_client.publish(TITLE_VERSION_CHANNEL, json.dumps(
+                {"kind": EVENT_TITLE, "id": str(title_id), "version": version}))
+        except Exception as e:
+            # redis 不可用时至少保证当前 worker 失效
+            print(f'Error: bump title version failed, title: {title_id}, reason: {e}')
+            with self.lock:
+                version = self.versions.get(title_id, 0) + 1
+        self._apply(EVENT_TITLE, title_id, version)
+        return version
+
+    def publish_config_change(self, kind: str, config_id: uuid.UUID):
+        """
+        查询配置、加载配置、用户删除或修改后调用，各 worker 淘汰使用该配置的对象
+        :param kind: EVENT_LOAD_CONFIG、EVENT_QUERY_CONFIG 或 EVENT_USER
+        :param config_id:
+        :return:
+        """
+        config_id = uuid.UUID(str(config_id))
+        try:
+            self.redis_client.publish(TITLE_VERSION_CHANNEL, json.dumps(
+                {"kind": kind, "id": str(config_id), "version": 0}))
+        except Exception as e:
+            print(f'Error: publish config change failed, {kind}: {config_id}, reason: {e}')
+        self._apply(kind, config_id, 0)
+
+    def _listen(self):
+        missed_events = False
+        while not self.stop_event.is_set():
+            pubsub = None
+            try:
+                pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(TITLE_VERSION_CHANNEL)
+                if missed_events:
+                    missed_events = False
+                    self._notify(EVENT_RESET, None, 0)
+                while not self.stop_event.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    event = json.loads(message["data"])
+                    self._apply(event["kind"], uuid.UUID(event["id"]), int(event["version"]))
+            except Exception as e:
+                print(f'Error: title version subscribe failed, reason: {e}')
+                # 断开期间可能漏掉事件，清空本地版本号，下次使用时重新从 redis 读取
+                with self.lock:
+                    self.versions.clear()
+                missed_events = True
+                time.sleep(RESUBSCRIBE_SECONDS)
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+
+    def start(self):
+        """
+        启动订阅线程，api worker 启动时调用，只发布事件的进程（celery worker）不需要启动
+        :return:
+        """
+        if self.subscribe_thread is not None:
+            return
+        self.subscribe_thread = threading.Thread(target=self._listen, daemon=True)
+        self.subscribe_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.subscribe_thread is not None:
+            self.subscribe_thread.join()
+            self.subscribe_thread = None
+
+
+title_version_registry = TitleVersionRegistry(settings.REDIS_URL)
@@ -0,0 +1,396 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from app.db_model import UploadSessionFilePublic, UploadSessionPublic
+from app.service.blob_store import MAX_COPY_BUFFER_SIZE
+from app.settings import settings
+from app.utils.lru_cache import LRUCache
+from app.utils.metrics import metrics
+
+# 未完成的上传按会话保存，和 blob 在同一文件系统，完成后直接移动
+UPLOAD_SESSION_DIR = os.path.join('upload_files', 'sessions')
+SESSION_META_NAME = 'session.json'
+SESSION_LOCK_NAME = 'session.lock'
+
+
+class UploadSessionError(Exception):
+    """
+    上传会话请求错误，received 为文件已经接收的字节数，客户端从该位置续传
+    """
+
+    def __init__(self, message: str, status_code: int = 400, received: Optional[int] = None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.received = received
+
+
+@dataclass
+class UploadSessionFile:
+    index: int
+    filename: str
+    size: int
+    # 提交会话时已经处理过（保存为 blob 或确认不能入库），数据已经不在会话目录中
+    completed: bool = False
+    code: Optional[str] = None
+    msg: Optional[str] = None
+    file_id: Optional[str] = None
+
+
+@dataclass
+class UploadSession:
+    session_id: uuid.UUID
+    title_id: uuid.UUID
+    user_id: uuid.UUID
+    files: List[UploadSessionFile] = field(default_factory=list)
+    # 最后一次收到数据的时间，超过保留时间未续传的会话被清理
+    updated_at: float = 0.0
+
+
+@dataclass
+class PartHash:
+    """
+    文件已接收部分的 hash 状态，续传时继续计算，不需要重新读取已接收的数据
+    """
+    offset: int
+    sha256: "hashlib._Hash"
+
+
+class UploadSessionManager:
+    """
+    断点续传上传：创建会话时声明文件列表，按字节范围顺序上传每个文件，全部完成后提交入库。
+    会话信息和未完成的数据保存在磁盘上，多个 worker 共用；hash 状态保存在进程内，
+    续传请求落到其他 worker 或服务重启后，从磁盘重新计算已接收部分的 hash。
+    同一文件的上传和提交用文件锁（flock）串行，对所有 worker 生效
+    """
+
+    def __init__(self, root: str, ttl_seconds: int, max_files: int):
+        """
+        :param root: 会话目录
+        :param ttl_seconds: 未完成的会话保留时间
+        :param max_files: 一个会话最多的文件数
+        """
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        self.max_files = max_files
+        self.part_hashes = LRUCache(max_size=1024)
+        os.makedirs(root, exist_ok=True)
+
+    def get_session_dir(self, session_id: uuid.UUID) -> str:
+        return os.path.join(self.root, uuid.UUID(str(session_id)).hex)
+
+    def get_part_path(self, session_id: uuid.UUID, index: int) -> str:
+        return os.path.join(self.get_session_dir(session_id), f'{index}.part')
+
+    def get_lock_path(self, session_id: uuid.UUID, index: int) -> str:
+        return os.path.join(self.get_session_dir(session_id), f'{index}.lock')
+
+    def lock_fd(self, lock_path: str, blocking: bool = True) -> int:
+        """
+        加文件锁，关闭返回的文件描述符时释放，进程退出时由系统释放
+        :param lock_path:
+        :param blocking: 为 False 时锁被占用直接抛出 BlockingIOError
+        :return: 文件描述符
+        """
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_RDWR)
+        except FileNotFoundError:
+            raise UploadSessionError('upload session not found', status_code=404)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    @contextmanager
+    def flock(self, lock_path: str) -> Iterator[None]:
+        fd = self.lock_fd(lock_path)
+        try:
+            yield
+        finally:
+            os.close(fd)
+
+    def update_session(self, session: UploadSession, update: Callable[[UploadSession], None]):
+        """
+        在会话锁内重新读取会话信息，修改后保存，其他 worker 对会话的修改不会被覆盖。
+        修改后的会话信息同步到 session
+        :param session:
+        :param update: 修改会话信息
+        :return:
+        """
+        with self.flock(os.path.join(self.get_session_dir(session.session_id), SESSION_LOCK_NAME)):
+            current = self.read_session(session.session_id) or session
+            update(current)
+            self.save_session(current)
+        session.files = current.files
+        session.updated_at = current.updated_at
+
+    def save_session(self, session: UploadSession):
+        session_dir = self.get_session_dir(session.session_id)
+        meta_path = os.path.join(session_dir, SESSION_META_NAME)
+        data = {
+            "session_id": str(session.session_id),
+            "title_id": str(session.title_id),
+            "user_id": str(session.user_id),
+            "files": [asdict(f) for f in session.files],
+            "updated_at": session.updated_at,
+        }
+        # 先写临时文件再替换，读取时不会读到写了一半的内容
+        tmp_path = f'{meta_path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, meta_path)
+
+    def create(self, title_id: uuid.UUID, user_id: uuid.UUID, files: List[Tuple[str, int]]) -> UploadSession:
+        """
+        创建上传会话，并清理过期的会话
+        :param title_id:
+        :param user_id:
+        :param files: [(文件名, 字节数)]
+        :return:
+        """
+        if len(files) > self.max_files:
+            raise UploadSessionError(f'too many files in one session, limit: {self.max_files}')
+        self.purge_expired()
+        session = UploadSession(session_id=uuid.uuid4(), title_id=title_id, user_id=user_id,
+                                files=[UploadSessionFile(index=i, filename=filename, size=size)
+                                       for i, (filename, size) in enumerate(files)],
+                                updated_at=time.time())
+        os.makedirs(self.get_session_dir(session.session_id), exist_ok=True)
+        self.save_session(session)
+        metrics.counter("upload_session_created").inc()
+        return session
+
+    def load(self, session_id: uuid.UUID) -> Optional[UploadSession]:
+        """
+        读取会话，不存在或已过期时返回 None
+        :param session_id:
+        :return:
+        """
+        session = self.read_session(session_id)
+        if session is not None and time.time() - session.updated_at > self.ttl_seconds:
+            self.delete(session_id)
+            return None
+        return session
+
+    def read_session(self, session_id: uuid.UUID) -> Optional[UploadSession]:
+        meta_path = os.path.join(self.get_session_dir(session_id), SESSION_META_NAME)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        session = UploadSession(session_id=uuid.UUID(data["session_id"]), title_id=uuid.UUID(data["title_id"]),
+                                user_id=uuid.UUID(data["user_id"]),
+                                files=[UploadSessionFile(**f) for f in data["files"]],
+                                updated_at=data["updated_at"])
+        return session
+
+    def get_received(self, session_id: uuid.UUID, index: int) -> int:
+        try:
+            return os.path.getsize(self.get_part_path(session_id, index))
+        except FileNotFoundError:
+            return 0
+
+    def get_file(self, session: UploadSession, index: int) -> UploadSessionFile:
+        if index < 0 or index >= len(session.files):
+            raise UploadSessionError(f'file index {index} not in session', status_code=404)
+        return session.files[index]
+
+    def to_public(self, session: UploadSession) -> UploadSessionPublic:
+        return UploadSessionPublic(
+            id=session.session_id,
+            title_id=session.title_id,
+            files=[UploadSessionFilePublic(index=f.index, filename=f.filename, size=f.size,
+                                           received=f.size if f.completed else
+                                           self.get_received(session.session_id, f.index),
+                                           completed=f.completed, file_id=f.file_id)
+                   for f in session.files],
+            expires_at=datetime.fromtimestamp(session.updated_at + self.ttl_seconds),
+        )
+
+    def hash_part(self, part_path: str, offset: int) -> PartHash:
+        sha256 = hashlib.sha256()
+        with open(part_path, "rb") as f:
+            while chunk := f.read(MAX_COPY_BUFFER_SIZE):
+                sha256.update(chunk)
+        return PartHash(offset=offset, sha256=sha256)
+
+    async def get_part_hash(self, session_id: uuid.UUID, index: int, received: int) -> PartHash:
+        """
+        获取已接收部分的 hash 状态，进程内没有时从磁盘重新计算
+        :param session_id:
+        :param index:
+        :param received:
+        :return:
+        """
+        key = (session_id, index)
+        part_hash = self.part_hashes.get(key, None)
+        if part_hash is None or part_hash.offset != received:
+            if received == 0:
+                part_hash = PartHash(offset=0, sha256=hashlib.sha256())
+            else:
+                metrics.counter("upload_session_rehash").inc()
+                part_hash = await run_in_threadpool(self.hash_part, self.get_part_path(session_id, index), received)
+            self.part_hashes.put(key, part_hash)
+        return part_hash
+
+    def append_part(self, part_path: str, part_hash: PartHash, data: bytes):
+        with open(part_path, "ab") as f:
+            f.write(data)
+        part_hash.sha256.update(data)
+        part_hash.offset += len(data)
+
+    async def write_range(self, session: UploadSession, index: int, start: int,
+                          stream: AsyncIterator[bytes]) -> int:
+        """
+        写入文件从 start 开始的数据，start 必须等于已接收的字节数
+        :param session:
+        :param index: 文件序号
+        :param start: 起始字节位置
+        :param stream: 请求体
+        :return: 写入后已接收的字节数
+        """
+        self.get_file(session, index)
+        async with self.lock_file(session, index) as upload_file:
+            if upload_file.completed:
+                raise UploadSessionError(f'file {upload_file.filename} already completed',
+                                         status_code=409, received=upload_file.size)
+            part_path = self.get_part_path(session.session_id, index)
+            received = await run_in_threadpool(self.get_received, session.session_id, index)
+            if start != received:
+                raise UploadSessionError(f'range start {start} does not match received bytes {received}',
+                                         status_code=409, received=received)
+            part_hash = await self.get_part_hash(session.session_id, index, received)
+            buffer = []
+            buffered = 0
+            write_start = time.monotonic()
+            try:
+                async for chunk in stream:
+                    if part_hash.offset + buffered + len(chunk) > upload_file.size:
+                        raise UploadSessionError(f'data exceeds declared size {upload_file.size}',
+                                                 received=part_hash.offset)
+                    buffer.append(chunk)
+                    buffered += len(chunk)
+                    # 攒够一个缓冲区再在线程池中写盘、计算 hash
+                    if buffered >= MAX_COPY_BUFFER_SIZE:
+                        await run_in_threadpool(self.append_part, part_path, part_hash, b"".join(buffer))
+                        buffer = []
+                        buffered = 0
+            finally:
+                # 客户端中途断开时保存已收到的数据，下次从这里续传
+                if buffer:
+                    await run_in_threadpool(self.append_part, part_path, part_hash, b"".join(buffer))
+                await run_in_threadpool(self.update_session, session, self.touch)
+            written = part_hash.offset - received
+            metrics.counter("upload_bytes").inc(written)
+            metrics.summary("upload_range_ms").observe((time.monotonic() - write_start) * 1000)
+            return part_hash.offset
+
+    @staticmethod
+    def touch(session: UploadSession):
+        session.updated_at = time.time()
+
+    @asynccontextmanager
+    async def lock_file(self, session: UploadSession, index: int) -> AsyncIterator[UploadSessionFile]:
+        """
+        锁住会话中的一个文件，上传和提交同一文件的请求（包括其他 worker 的）串行执行，
+        锁被占用时直接返回 409，不占用线程等待。加锁后重新读取文件状态
+        :param session:
+        :param index:
+        :return: 加锁后的文件状态
+        """
+        self.get_file(session, index)
+        try:
+            fd = await run_in_threadpool(self.lock_fd, self.get_lock_path(session.session_id, index), False)
+        except BlockingIOError:
+            received = await run_in_threadpool(self.get_received, session.session_id, index)
+            raise UploadSessionError(f'file {index} is being uploaded by another request',
+                                     status_code=409, received=received)
+        try:
+            current = await run_in_threadpool(self.read_session, session.session_id)
+            if current is None:
+                raise UploadSessionError('upload session not found', status_code=404)
+            session.files = current.files
+            yield self.get_file(session, index)
+        finally:
+            os.close(fd)
+
+    async def complete_file(self, session: UploadSession, index: int) -> Tuple[str, str, int]:
+        """
+        文件全部接收后，返回数据路径和 hash，由调用方移动到 blob。调用方在 lock_file 内调用，
+        移动数据和 mark_completed 之前其他请求不能再上传或提交该文件
+        :param session:
+        :param index:
+        :return: (数据路径, sha256, 字节数)
+        """
+        upload_file = self.get_file(session, index)
+        received = await run_in_threadpool(self.get_received, session.session_id, index)
+        if received != upload_file.size:
+            raise UploadSessionError(f'file {upload_file.filename} is incomplete, '
+                                     f'received {received} of {upload_file.size} bytes', received=received)
+        part_path = self.get_part_path(session.session_id, index)
+        if upload_file.size == 0:
+            # 空文件没有写入过数据
+            await run_in_threadpool(self.append_part, part_path,
+                                    await self.get_part_hash(session.session_id, index, 0), b"")
+        part_hash = await self.get_part_hash(session.session_id, index, received)
+        self.part_hashes.pop((session.session_id, index), None)
+        return part_path, part_hash.sha256.hexdigest(), received
+
+    def mark_completed(self, session: UploadSession, index: int, code: str, msg: str,
+                       file_id: Optional[uuid.UUID] = None):
+        """
+        记录文件的提交结果，部分文件未完成时再次提交会话跳过已经处理的文件
+        :param session:
+        :param index:
+        :param code: 提交结果
+        :param msg:
+        :param file_id: 创建的文件记录
+        :return:
+        """
+        def update(current: UploadSession):
+            upload_file = self.get_file(current, index)
+            upload_file.completed = True
+            upload_file.code = code
+            upload_file.msg = msg
+            upload_file.file_id = str(file_id) if file_id is not None else None
+            current.updated_at = time.time()
+
+        self.update_session(session, update)
+
+    def delete(self, session_id: uuid.UUID):
+        shutil.rmtree(self.get_session_dir(session_id), ignore_errors=True)
+        self.part_hashes.remove_if(lambda key: key[0] == session_id)
+
+    def purge_expired(self):
+        """
+        清理超过保留时间没有续传的会话
+        :return:
+        """
+        for name in os.listdir(self.root):
+            try:
+                session_id = uuid.UUID(name)
+            except ValueError:
+                continue
+            # load 发现会话过期时删除；没有会话信息的目录（创建失败）超过保留时间后删除
+            if self.load(session_id) is None:
+                session_dir = self.get_session_dir(session_id)
+                if os.path.isdir(session_dir) and time.time() - os.path.getmtime(session_dir) > self.ttl_seconds:
+                    self.delete(session_id)
+
+
+global_upload_session_manager = UploadSessionManager(UPLOAD_SESSION_DIR, ttl_seconds=settings.UPLOAD_SESSION_TTL_SECONDS,
+                                                     max_files=settings.UPLOAD_SESSION_MAX_FILES)
@@ -1,4 +1,5 @@
 import secrets
+from typing import Optional
 
 from pydantic_settings import BaseSettings
 
@@ -7,6 +8,86 @@ class Settings(BaseSettings):
     # 有效期 1 天
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 * 24 * 1
     SECRET_KEY: str = secrets.token_urlsafe(32)
+    # 已验证的 token 和用户的缓存时间（秒），0 表示不缓存
+    AUTH_PRINCIPAL_TTL_SECONDS: int = 30
+    # 数据库连接池，同步和异步引擎各自使用一套连接池
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_RECYCLE: int = 30 * 60
+    DB_POOL_TIMEOUT: int = 30
+    # redis 地址，title 版本号及其变化通知
+    REDIS_URL: str = 'redis://localhost:6379/0'
+    # 查询对象缓存，按 (user_id, title_id, 配置版本) 缓存，LRU + 空闲过期淘汰
+    QUERY_ANSWERS_CACHE_MAX_SIZE: int = 256
+    QUERY_ANSWERS_CACHE_IDLE_SECONDS: int = 30 * 60
+    # 大模型管理对象缓存，按 (user_id, 查询配置id) 缓存
+    QUERY_LLM_CACHE_MAX_SIZE: int = 1024
+    QUERY_LLM_CACHE_IDLE_SECONDS: int = 30 * 60
+    # 查询向量缓存，配置 redis 地址后各 worker 共享缓存
+    QUERY_EMBEDDING_CACHE_MAX_SIZE: int = 10000
+    QUERY_EMBEDDING_CACHE_TTL_SECONDS: int = 24 * 60 * 60
+    QUERY_EMBEDDING_REDIS_URL: Optional[str] = None
+    # 查询向量微批处理：收集并发查询的等待时间（毫秒）、每批最大数量、同时进行中的批量请求数
+    QUERY_EMBEDDING_BATCH_WAIT_MS: int = 5
+    QUERY_EMBEDDING_BATCH_MAX_SIZE: int = 25
+    QUERY_EMBEDDING_BATCH_MAX_IN_FLIGHT: int = 4
+    # 文档入库：每批段落数、同时进行中的嵌入请求数、每批最大重试次数
+    EMBED_BATCH_SIZE: int = 25
+    EMBED_MAX_CONCURRENCY: int = 4
+    EMBED_MAX_RETRIES: int = 3
+    # 多向量检索的父文档存储：超过该字节数的段落压缩保存，进程内缓存的段落数
+    PARENT_DOC_COMPRESS_THRESHOLD: int = 1024
+    PARENT_DOC_CACHE_MAX_SIZE: int = 2048
+    # 混合检索：向量检索和关键词检索各取的候选数，倒数排名融合平滑参数
+    HYBRID_SEARCH_ENABLED: bool = True
+    HYBRID_FETCH_K: int = 10
+    HYBRID_RRF_K: int = 60
+    # 重排：候选段落数为 top_k 的倍数，得分缓存条数
+    RERANK_ENABLED: bool = True
+    RERANK_CANDIDATE_MULTIPLIER: int = 4
+    RERANK_SCORE_CACHE_MAX_SIZE: int = 100000
+    # 问答缓存：最大答案数，空闲过期时间，语义命中的问题向量余弦相似度阈值（None 表示只精确匹配）
+    ANSWER_CACHE_ENABLED: bool = True
+    ANSWER_CACHE_MAX_SIZE: int = 4096
+    ANSWER_CACHE_TTL_SECONDS: int = 3600
+    ANSWER_CACHE_SIMILARITY_THRESHOLD: Optional[float] = None
+    # 流式回答：合并 token 的最长等待时间（毫秒）和最大字符数，空闲时心跳间隔（秒）
+    STREAM_COALESCE_MS: int = 50
+    STREAM_COALESCE_MAX_CHARS: int = 64
+    STREAM_HEARTBEAT_SECONDS: int = 15
+    # 问答准入：每个用户、每个 title 每秒请求数和突发请求数，每个用户同时进行中的请求数
+    CHAT_USER_RATE: float = 0.5
+    CHAT_USER_BURST: float = 5
+    CHAT_TITLE_RATE: float = 5
+    CHAT_TITLE_BURST: float = 20
+    CHAT_USER_MAX_CONCURRENCY: int = 3
+    # 文档入库：每个用户最多排队的文件数
+    INGEST_MAX_QUEUED_PER_USER: int = 10
+    # 断点续传上传：未完成的上传保留时间（秒），一次上传会话最多的文件数
+    UPLOAD_SESSION_TTL_SECONDS: int = 24 * 3600
+    UPLOAD_SESSION_MAX_FILES: int = 100
+    # 段落总结：同时进行中的请求数，一次请求合并的段落 token 上限，短于该长度的段落不总结
+    SUMMARY_MAX_CONCURRENCY: int = 5
+    SUMMARY_BATCH_MAX_TOKENS: int = 3000
+    SUMMARY_MIN_CHARS: int = 200
+    # 文档入库方式：local 在 api 进程内处理，celery 投递到 vectorize 队列由独立的 worker 处理
+    INGEST_BACKEND: str = "local"
+    # 向量数据库服务地址，api 节点和 celery worker 共用；为空时使用本地持久化目录（只能使用 local 入库）
+    CHROMA_SERVER_HOST: Optional[str] = None
+    CHROMA_SERVER_PORT: int = 8000
+    # 关键词索引保存位置：sqlite 为本地文件（只能使用 local 入库），postgres 为各节点共用的数据库
+    LEXICAL_INDEX_BACKEND: str = "sqlite"
+    # celery 入库时同一文件的处理锁过期时间
+    CELERY_INGEST_LOCK_SECONDS: int = 60 * 60
+    # 文档解析进程数，为空时使用 min(4, cpu 核数)
+    LOAD_DOC_PROCESS_NUM: Optional[int] = None
+    # 本地入库时，启动时及之后定时重新处理未完成的文件，同一文件由处理租约保证只有一个 worker 处理
+    RESUME_UNFINISHED_FILES: bool = True
+    # 本地入库的文件处理租约有效期（秒），持有者每 1/3 有效期续期一次，worker 退出后过期由其他 worker 接手
+    INGEST_LEASE_SECONDS: int = 10 * 60
+    # 文件状态 SSE：心跳间隔，以及从数据库刷新状态的间隔（其他 worker 处理的文件只能通过数据库获取）
+    FILE_STATUS_HEARTBEAT_SECONDS: int = 15
+    FILE_STATUS_REFRESH_SECONDS: int = 5
 
 
 settings = Settings()
@@ -0,0 +1,62 @@
+import uuid
+
+from app.retriever.answer_cache import AnswerCache, split_answer
+
+
+def make_scope(cache: AnswerCache, title_id: uuid.UUID = None):
+    return cache.get_scope(title_id or uuid.uuid4(), uuid.uuid4(), uuid.uuid4())
+
+
+def test_exact_hit_with_normalized_question():
+    cache = AnswerCache(max_size=10)
+    scope = make_scope(cache)
+    cache.put(scope, "What is  RAG？", "answer")
+    assert cache.get(scope, "what is rag?") == "answer"
+    assert cache.get(make_scope(cache), "what is rag?") is None
+
+
+def test_answer_generated_before_invalidation_is_not_cached():
+    cache = AnswerCache(max_size=10)
+    title_id = uuid.uuid4()
+    scope = make_scope(cache, title_id)
+    generation = cache.get_generation(title_id)
+
+    # 生成答案期间 title 下的文件变化
+    cache.invalidate_title(title_id)
+    cache.put(scope, "question", "stale answer", generation=generation)
+    assert cache.get(scope, "question") is None
+
+    cache.put(scope, "question", "fresh answer", generation=cache.get_generation(title_id))
+    assert cache.get(scope, "question") == "fresh answer"
+
+
+def test_invalidate_title_only_removes_that_title():
+    cache = AnswerCache(max_size=10)
+    title_id = uuid.uuid4()
+    scope = make_scope(cache, title_id)
+    other_scope = make_scope(cache)
+    cache.put(scope, "q1", "a1")
+    cache.put(scope, "q2", "a2")
+    cache.put(other_scope, "q1", "other")
+
+    assert cache.invalidate_title(title_id) == 2
+    assert cache.get(scope, "q1") is None
+    assert cache.get(other_scope, "q1") == "other"
+
+
+def test_semantic_hit_above_threshold():
+    cache = AnswerCache(max_size=10, similarity_threshold=0.95)
+    scope = make_scope(cache)
+    cache.put(scope, "how to reset password", "answer", vector=[1.0, 0.0])
+
+    assert cache.get(scope, "reset my password", vector=[0.99, 0.05]) == "answer"
+    assert cache.get(scope, "delete account", vector=[0.0, 1.0]) is None
+    assert cache.stats()["semantic_hits"] == 1
+
+    cache.invalidate_title(scope[0])
+    assert cache.get(scope, "reset my password", vector=[0.99, 0.05]) is None
+
+
+def test_split_answer():
+    assert split_answer("abcdef", chunk_chars=4) == ["abcd", "ef"]
+    assert split_answer("") == [""]
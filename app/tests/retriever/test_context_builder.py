@@ -0,0 +1,67 @@
+from langchain_core.documents import Document
+
+from app.retriever.context_builder import ContextBuilder, get_overlap_length
+
+OVERLAP = "shared overlap sentence between chunks"
+
+
+def make_document(text: str, file_id: str, doc_id: int = None) -> Document:
+    metadata = {"file_id": file_id}
+    if doc_id is not None:
+        metadata["doc_id"] = doc_id
+    return Document(page_content=text, metadata=metadata)
+
+
+def make_text(prefix: str, words: int) -> str:
+    return " ".join(f"{prefix}{i}" for i in range(words))
+
+
+def test_overlap_length_requires_minimum():
+    assert get_overlap_length("first part " + OVERLAP, OVERLAP + " second part", 200) == len(OVERLAP)
+    assert get_overlap_length("ends with abc", "abc starts", 200) == 0
+
+
+def test_merges_adjacent_chunks_and_removes_overlap():
+    first = "first chunk text, " + OVERLAP
+    second = OVERLAP + ", second chunk text"
+    documents = [
+        make_document(second, "f1", 1),
+        make_document("other file passage", "f2", 4),
+        make_document(first, "f1", 0),
+    ]
+    passages = ContextBuilder.merge_passages(documents, max_overlap_chars=200)
+
+    assert [(passage.source, passage.start, passage.end, passage.rank) for passage in passages] == [
+        ("f1", 0, 1, 0), ("f2", 4, 4, 1)]
+    assert passages[0].text == "first chunk text, " + OVERLAP + ", second chunk text"
+
+
+def test_non_adjacent_chunks_stay_separate():
+    documents = [make_document("chunk zero", "f1", 0), make_document("chunk five", "f1", 5),
+                 make_document("no index", "f1")]
+    passages = ContextBuilder.merge_passages(documents, max_overlap_chars=200)
+    assert [(passage.start, passage.end) for passage in passages] == [(0, 0), (5, 5), (-1, -1)]
+
+
+def test_removes_duplicates_across_files():
+    text = make_text("word", 30)
+    documents = [make_document(text, "f1", 0), make_document(text, "f2", 0),
+                 make_document(make_text("other", 10), "f3", 0)]
+    result = ContextBuilder().build(documents, max_tokens=1000)
+
+    assert result.passages == 2
+    assert result.duplicates == 1
+    assert result.saved_tokens > 0
+    assert result.text.count(text) == 1
+
+
+def test_stops_at_token_budget():
+    texts = [make_text(prefix, 60) for prefix in ("alpha", "beta", "gamma")]
+    documents = [make_document(text, f"f{i}", 0) for i, text in enumerate(texts)]
+    context_builder = ContextBuilder()
+    result = context_builder.build(documents, max_tokens=120)
+
+    # 第一段放入后剩余预算不足以截断放入第二段
+    assert result.passages == 1
+    assert result.text == texts[0]
+    assert context_builder.stats()["builds"] == 1
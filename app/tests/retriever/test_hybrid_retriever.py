@@ -0,0 +1,26 @@
+from langchain_core.documents import Document
+
+from app.retriever.hybrid_retriever import reciprocal_rank_fusion
+
+
+def make_documents(*texts: str):
+    return [Document(page_content=text) for text in texts]
+
+
+def test_rrf_combines_ranks_from_all_lists():
+    vector_documents = make_documents("a", "b", "c")
+    lexical_documents = make_documents("c", "a", "d")
+    fused = reciprocal_rank_fusion([vector_documents, lexical_documents], k=60)
+    assert [document.page_content for document in fused] == ["a", "c", "b", "d"]
+
+
+def test_rrf_deduplicates_by_content_and_keeps_first_document():
+    vector_documents = [Document(page_content="a", metadata={"source": "vector"})]
+    lexical_documents = [Document(page_content="a", metadata={"source": "lexical"})]
+    fused = reciprocal_rank_fusion([vector_documents, lexical_documents])
+    assert len(fused) == 1
+    assert fused[0].metadata["source"] == "vector"
+
+
+def test_rrf_empty_lists():
+    assert reciprocal_rank_fusion([[], []]) == []
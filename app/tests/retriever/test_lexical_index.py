@@ -0,0 +1,57 @@
+import uuid
+
+from langchain_core.documents import Document
+
+from app.retriever.lexical_index import LexicalIndex, bm25_top_k, tokenize
+
+
+def test_tokenize_ascii_codes_and_cjk_bigrams():
+    tokens = tokenize("Error E-1024 发生错误")
+    assert "error" in tokens
+    # 带连接符的词整体保留，同时拆成子词
+    assert {"e-1024", "e", "1024"} <= set(tokens)
+    assert {"发生", "生错", "错误"} <= set(tokens)
+    assert tokenize("中") == ["中"]
+
+
+def test_bm25_prefers_rare_terms_and_higher_tf():
+    postings_by_term = {
+        "common": [(1, 1), (2, 1), (3, 1)],
+        "rare": [(2, 2)],
+    }
+    length_by_chunk = {1: 10, 2: 10, 3: 10}
+    scores = bm25_top_k(doc_count=3, avg_length=10, postings_by_term=postings_by_term,
+                        length_by_chunk=length_by_chunk, k=2)
+    assert len(scores) == 2
+    assert scores[0][0] == 2
+    assert scores[0][1] > scores[1][1]
+
+
+def test_bm25_penalizes_long_chunks():
+    scores = bm25_top_k(doc_count=2, avg_length=20, postings_by_term={"term": [(1, 1), (2, 1)]},
+                        length_by_chunk={1: 5, 2: 35}, k=10)
+    assert [chunk for chunk, _ in scores] == [1, 2]
+
+
+def test_index_search_and_delete(tmp_path):
+    index = LexicalIndex(str(tmp_path / "title.db"))
+    file_1, file_2 = uuid.uuid4(), uuid.uuid4()
+    index.index_file(file_1, ["c1", "c2"], [
+        Document(page_content="error code e-1024 in payment module", metadata={"doc_id": 0}),
+        Document(page_content="unrelated text about cats", metadata={"doc_id": 1}),
+    ])
+    index.index_file(file_2, ["c3"], [Document(page_content="e-1024 e-1024 retry", metadata={"doc_id": 0})])
+    try:
+        results = index.search("E-1024", k=10)
+        assert [document.id for document, _ in results] == ["c3", "c1"]
+        assert results[1][0].metadata == {"doc_id": 0}
+
+        # 重复写入同一文件时替换旧数据
+        index.index_file(file_1, ["c4"], [Document(page_content="payment gateway timeout")])
+        assert [document.id for document, _ in index.search("payment", k=10)] == ["c4"]
+
+        index.delete_file(file_2)
+        assert index.search("e-1024", k=10) == []
+        assert index.search("", k=10) == []
+    finally:
+        index.close()
@@ -0,0 +1,48 @@
+import uuid
+
+import chromadb
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from app.retriever.load_file_thread import LoadFileThread, get_collection_name, CHROMADB_COLLECTION_PREFIX
+from app.utils.user_base_model import RetrieverConfig
+
+
+def make_thread() -> LoadFileThread:
+    thread = LoadFileThread()
+    thread.embeddings = DeterministicFakeEmbedding(size=16)
+    thread.retriever_config = RetrieverConfig(top_k=5)
+    thread.chroma_client = chromadb.EphemeralClient()
+    return thread
+
+
+def test_collection_name_per_title():
+    title_a, title_b = uuid.uuid4(), uuid.uuid4()
+    assert get_collection_name(CHROMADB_COLLECTION_PREFIX, title_a) != \
+        get_collection_name(CHROMADB_COLLECTION_PREFIX, title_b)
+    assert get_collection_name(CHROMADB_COLLECTION_PREFIX, title_a) == \
+        get_collection_name(CHROMADB_COLLECTION_PREFIX, str(title_a))
+
+
+def test_retrieval_isolated_per_title():
+    thread = make_thread()
+    title_a, title_b = uuid.uuid4(), uuid.uuid4()
+    thread.get_vectorstore(title_a).add_documents([Document(page_content="apple", metadata={"title": "a"})])
+    thread.get_vectorstore(title_b).add_documents([Document(page_content="banana", metadata={"title": "b"})])
+
+    documents_a = thread.get_retriever(title_a).invoke("apple")
+    documents_b = thread.get_retriever(title_b).invoke("apple")
+    assert [document.page_content for document in documents_a] == ["apple"]
+    assert [document.page_content for document in documents_b] == ["banana"]
+
+
+def test_delete_title_collection_keeps_other_titles():
+    thread = make_thread()
+    title_a, title_b = uuid.uuid4(), uuid.uuid4()
+    thread.get_vectorstore(title_a).add_documents([Document(page_content="apple")])
+    thread.get_vectorstore(title_b).add_documents([Document(page_content="banana")])
+
+    thread.get_vectorstore(title_a).delete_collection()
+    thread.evict_title(title_a)
+    assert thread.get_retriever(title_a).invoke("apple") == []
+    assert [document.page_content for document in thread.get_retriever(title_b).invoke("apple")] == ["banana"]
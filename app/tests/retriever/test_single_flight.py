@@ -0,0 +1,86 @@
+import asyncio
+
+from app.retriever.single_flight import SingleFlight
+
+
+def make_factory(tokens, started: asyncio.Event, release: asyncio.Event, calls: list):
+    async def generate():
+        calls.append(1)
+        for i, token in enumerate(tokens):
+            yield token
+            if i == 0:
+                # 第一个 token 之后等待，测试中途加入、取消的情况
+                started.set()
+                await release.wait()
+    return generate
+
+
+def test_followers_share_one_generation_and_replay_tokens():
+    async def run():
+        single_flight = SingleFlight()
+        started, release, calls, completed = asyncio.Event(), asyncio.Event(), [], []
+        factory = make_factory(["a", "b", "c"], started, release, calls)
+
+        leader = single_flight.start("q", factory, completed.append)
+        leader_result = asyncio.create_task(leader.result())
+        await started.wait()
+        follower = single_flight.start("q", factory, completed.append)
+        follower_result = asyncio.create_task(follower.result())
+        await asyncio.sleep(0)
+        release.set()
+
+        assert follower is leader
+        assert await leader_result == "abc"
+        assert await follower_result == "abc"
+        await leader.task
+        assert calls == [1]
+        assert completed == ["abc"]
+        assert single_flight.stats() == {"in_flight": 0, "leaders": 1, "followers": 1}
+
+    asyncio.run(run())
+
+
+def test_generation_continues_while_a_subscriber_remains():
+    async def run():
+        single_flight = SingleFlight()
+        started, release, calls = asyncio.Event(), asyncio.Event(), []
+        flight = single_flight.start("q", make_factory(["a", "b"], started, release, calls))
+        leaving = asyncio.create_task(flight.result())
+        staying = asyncio.create_task(flight.result())
+        await started.wait()
+        await asyncio.sleep(0)
+
+        leaving.cancel()
+        await asyncio.sleep(0)
+        release.set()
+
+        assert await staying == "ab"
+        assert not flight.cancelled
+
+    asyncio.run(run())
+
+
+def test_generation_cancelled_when_all_subscribers_leave():
+    async def run():
+        single_flight = SingleFlight()
+        started, release, calls, completed = asyncio.Event(), asyncio.Event(), [], []
+        factory = make_factory(["a", "b"], started, release, calls)
+        flight = single_flight.start("q", factory, completed.append)
+        subscriber = asyncio.create_task(flight.result())
+        await started.wait()
+        await asyncio.sleep(0)
+
+        subscriber.cancel()
+        await asyncio.gather(subscriber, flight.task, return_exceptions=True)
+
+        assert flight.cancelled
+        assert flight.task.cancelled()
+        assert completed == []
+        # 已取消的生成不再被复用
+        release.set()
+        next_flight = single_flight.start("q", factory, completed.append)
+        assert next_flight is not flight
+        assert await next_flight.result() == "ab"
+        assert len(calls) == 2
+
+    asyncio.run(run())
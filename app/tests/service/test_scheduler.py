@@ -0,0 +1,126 @@
+import queue
+
+import pytest
+
+from app.service import scheduler
+from app.service.scheduler import ChatScheduler, FairTaskQueue, RateLimitExceeded, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(scheduler.time, "monotonic", fake_clock)
+    return fake_clock
+
+
+def make_scheduler(**kwargs) -> ChatScheduler:
+    options = dict(user_rate=1, user_burst=2, title_rate=10, title_burst=10, user_max_concurrency=10)
+    options.update(kwargs)
+    return ChatScheduler(**options)
+
+
+def test_token_bucket_refills_up_to_capacity(clock):
+    bucket = TokenBucket(rate=2, capacity=4)
+    bucket.tokens = 0
+    assert bucket.wait_seconds() == 0.5
+    clock.now += 1
+    bucket.refill(clock.now)
+    assert bucket.tokens == 2
+    clock.now += 10
+    bucket.refill(clock.now)
+    assert bucket.tokens == 4
+    assert bucket.wait_seconds() == 0
+
+
+def test_user_burst_then_retry_after(clock):
+    chat_scheduler = make_scheduler()
+    for _ in range(2):
+        chat_scheduler.acquire("u1", "t1")
+        chat_scheduler.release("u1")
+
+    with pytest.raises(RateLimitExceeded) as e:
+        chat_scheduler.acquire("u1", "t1")
+    assert e.value.retry_after == 1
+    http_exception = e.value.to_http_exception()
+    assert http_exception.status_code == 429
+    assert http_exception.headers["Retry-After"] == "1"
+    # 其他用户不受影响
+    chat_scheduler.acquire("u2", "t1")
+
+    clock.now += 1
+    chat_scheduler.acquire("u1", "t1")
+    assert chat_scheduler.stats()["rejected"] == 1
+
+
+def test_title_rejection_does_not_consume_user_tokens(clock):
+    chat_scheduler = make_scheduler(title_rate=1, title_burst=1)
+    chat_scheduler.acquire("u1", "t1")
+    with pytest.raises(RateLimitExceeded):
+        chat_scheduler.acquire("u1", "t1")
+    # 用户令牌桶还剩 1 个令牌，换一个 title 可以继续请求
+    chat_scheduler.acquire("u1", "t2")
+
+
+def test_user_concurrency_limit(clock):
+    chat_scheduler = make_scheduler(user_burst=10, user_max_concurrency=2)
+    chat_scheduler.acquire("u1", "t1")
+    chat_scheduler.acquire("u1", "t1")
+    with pytest.raises(RateLimitExceeded):
+        chat_scheduler.acquire("u1", "t1")
+    assert chat_scheduler.stats()["in_flight"] == 2
+
+    chat_scheduler.release("u1")
+    chat_scheduler.acquire("u1", "t1")
+    chat_scheduler.release("u1")
+    chat_scheduler.release("u1")
+    assert chat_scheduler.stats() == {"in_flight": 0, "active_users": 0, "rejected": 1}
+
+
+def drain(fair_queue: FairTaskQueue) -> list:
+    return [fair_queue.get(timeout=0) for _ in range(fair_queue.qsize())]
+
+
+def test_fair_queue_interleaves_tenants():
+    fair_queue = FairTaskQueue(max_queued_per_key=10)
+    for item in ["a1", "a2", "a3"]:
+        fair_queue.put(item, "a")
+    fair_queue.put("b1", "b")
+
+    assert fair_queue.position("b") == 1
+    assert drain(fair_queue) == ["a1", "b1", "a2", "a3"]
+
+
+def test_fair_queue_weights():
+    fair_queue = FairTaskQueue(max_queued_per_key=10, weights={"a": 2})
+    for item in ["a1", "a2", "a3", "a4"]:
+        fair_queue.put(item, "a")
+    for item in ["b1", "b2"]:
+        fair_queue.put(item, "b")
+
+    assert drain(fair_queue) == ["a1", "a2", "b1", "a3", "a4", "b2"]
+
+
+def test_fair_queue_limit_and_force():
+    fair_queue = FairTaskQueue(max_queued_per_key=2)
+    fair_queue.put("a1", "a")
+    fair_queue.put("b1", "b")
+    fair_queue.put("a2", "a")
+    with pytest.raises(RateLimitExceeded) as e:
+        fair_queue.put("a3", "a")
+    assert e.value.queue_position == 0
+    with pytest.raises(RateLimitExceeded):
+        fair_queue.check("a")
+
+    fair_queue.put("a3", "a", force=True)
+    assert fair_queue.stats()["queued_by_key"] == {"a": 3, "b": 1}
+    assert drain(fair_queue) == ["a1", "b1", "a2", "a3"]
+    with pytest.raises(queue.Empty):
+        fair_queue.get(timeout=0)
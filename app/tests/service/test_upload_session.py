@@ -0,0 +1,112 @@
+import asyncio
+import hashlib
+import uuid
+
+import pytest
+
+from app.service.upload_session import UploadSessionError, UploadSessionManager
+
+CONTENT = b"0123456789abcdefghij"
+TITLE_ID = uuid.uuid4()
+USER_ID = uuid.uuid4()
+
+
+async def chunks(*parts: bytes, error: BaseException = None):
+    for part in parts:
+        yield part
+    if error is not None:
+        raise error
+
+
+def make_manager(tmp_path) -> UploadSessionManager:
+    return UploadSessionManager(str(tmp_path / "sessions"), ttl_seconds=3600, max_files=4)
+
+
+def test_resume_from_received_offset(tmp_path):
+    async def run():
+        manager = make_manager(tmp_path)
+        session = manager.create(TITLE_ID, USER_ID, [("a.txt", len(CONTENT))])
+        assert await manager.write_range(session, 0, 0, chunks(CONTENT[:4], CONTENT[4:8])) == 8
+
+        # 起始位置和已接收的字节数不一致时返回已接收的字节数
+        with pytest.raises(UploadSessionError) as e:
+            await manager.write_range(session, 0, 4, chunks(CONTENT[4:]))
+        assert e.value.status_code == 409
+        assert e.value.received == 8
+
+        assert await manager.write_range(session, 0, 8, chunks(CONTENT[8:])) == len(CONTENT)
+        part_path, file_hash, size = await manager.complete_file(session, 0)
+        assert size == len(CONTENT)
+        assert file_hash == hashlib.sha256(CONTENT).hexdigest()
+        with open(part_path, "rb") as f:
+            assert f.read() == CONTENT
+
+    asyncio.run(run())
+
+
+def test_disconnect_keeps_received_data_and_rehashes_in_new_process(tmp_path):
+    async def run():
+        manager = make_manager(tmp_path)
+        session = manager.create(TITLE_ID, USER_ID, [("a.txt", len(CONTENT))])
+        with pytest.raises(ConnectionError):
+            await manager.write_range(session, 0, 0, chunks(CONTENT[:6], error=ConnectionError()))
+
+        # 其他 worker 没有进程内的 hash 状态，从磁盘重新计算
+        other_manager = make_manager(tmp_path)
+        loaded = other_manager.load(session.session_id)
+        assert other_manager.to_public(loaded).files[0].received == 6
+        assert await other_manager.write_range(loaded, 0, 6, chunks(CONTENT[6:])) == len(CONTENT)
+        _, file_hash, _ = await other_manager.complete_file(loaded, 0)
+        assert file_hash == hashlib.sha256(CONTENT).hexdigest()
+
+    asyncio.run(run())
+
+
+def test_rejects_data_beyond_declared_size(tmp_path):
+    async def run():
+        manager = make_manager(tmp_path)
+        session = manager.create(TITLE_ID, USER_ID, [("a.txt", 4)])
+        with pytest.raises(UploadSessionError) as e:
+            await manager.write_range(session, 0, 0, chunks(b"0123", b"4"))
+        assert e.value.received == 0
+        # 超出之前收到的数据仍然保存
+        assert manager.get_received(session.session_id, 0) == 4
+
+    asyncio.run(run())
+
+
+def test_incomplete_and_completed_files(tmp_path):
+    async def run():
+        manager = make_manager(tmp_path)
+        session = manager.create(TITLE_ID, USER_ID, [("a.txt", len(CONTENT)), ("b.txt", 0)])
+        await manager.write_range(session, 0, 0, chunks(CONTENT[:3]))
+        with pytest.raises(UploadSessionError) as e:
+            await manager.complete_file(session, 0)
+        assert e.value.received == 3
+
+        _, file_hash, size = await manager.complete_file(session, 1)
+        assert (file_hash, size) == (hashlib.sha256(b"").hexdigest(), 0)
+        manager.mark_completed(session, 1, "000000", "success")
+
+        # 提交结果保存在会话信息中，再次读取时跳过已完成的文件
+        loaded = manager.load(session.session_id)
+        assert loaded.files[1].completed
+        assert not loaded.files[0].completed
+        with pytest.raises(UploadSessionError) as e:
+            await manager.write_range(loaded, 1, 0, chunks(b""))
+        assert e.value.status_code == 409
+
+    asyncio.run(run())
+
+
+def test_file_lock_rejects_concurrent_writer(tmp_path):
+    async def run():
+        manager = make_manager(tmp_path)
+        session = manager.create(TITLE_ID, USER_ID, [("a.txt", len(CONTENT))])
+        async with manager.lock_file(session, 0):
+            with pytest.raises(UploadSessionError) as e:
+                await manager.write_range(session, 0, 0, chunks(CONTENT))
+            assert e.value.status_code == 409
+        assert await manager.write_range(session, 0, 0, chunks(CONTENT)) == len(CONTENT)
+
+    asyncio.run(run())
@@ -0,0 +1,104 @@
+import pytest
+
+from app.utils import lru_cache
+from app.utils.lru_cache import LRUCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(lru_cache.time, "monotonic", fake_clock)
+    return fake_clock
+
+
+def test_evicts_least_recently_used():
+    evicted = []
+    cache = LRUCache(max_size=2, on_evict=lambda key, value: evicted.append(key))
+    cache.put("a", 1)
+    cache.put("b", 2)
+    # 访问 a 后 b 成为最久未使用的
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert evicted == ["b"]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_idle_ttl_expires_unused_entries(clock):
+    evicted = []
+    cache = LRUCache(max_size=10, idle_ttl=60, on_evict=lambda key, value: evicted.append(key))
+    cache.put("a", 1)
+    cache.put("b", 2)
+    clock.now += 50
+    # 访问后重新计时
+    assert cache.get("a") == 1
+    clock.now += 20
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert evicted == ["b"]
+    stats = cache.stats()
+    assert stats["expirations"] == 1
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+
+
+def test_replace_value_notifies_old_value():
+    evicted = []
+    cache = LRUCache(max_size=10, on_evict=lambda key, value: evicted.append((key, value)))
+    cache.put("a", 1)
+    cache.put("a", 2)
+
+    assert cache.get("a") == 2
+    assert evicted == [("a", 1)]
+
+
+def test_pop_does_not_notify_and_remove_if_does():
+    evicted = []
+    cache = LRUCache(max_size=10, on_evict=lambda key, value: evicted.append(key))
+    for key in [("t1", 1), ("t1", 2), ("t2", 1)]:
+        cache.put(key, key)
+
+    assert cache.pop(("t2", 1)) == ("t2", 1)
+    assert cache.remove_if(lambda key: key[0] == "t1") == 2
+    assert len(cache) == 0
+    assert sorted(evicted) == [("t1", 1), ("t1", 2)]
+
+
+def test_get_or_create_calls_factory_once():
+    calls = []
+    cache = LRUCache(max_size=10)
+
+    def factory():
+        calls.append(1)
+        return object()
+
+    value = cache.get_or_create("a", factory)
+    assert cache.get_or_create("a", factory) is value
+    assert len(calls) == 1
+
+
+def test_get_or_create_keeps_first_inserted_and_releases_loser():
+    evicted = []
+    cache = LRUCache(max_size=10, on_evict=lambda key, value: evicted.append((key, value)))
+    winner, loser = object(), object()
+
+    def factory():
+        # 创建期间其他线程先写入了同一个 key
+        cache.put("a", winner)
+        return loser
+
+    assert cache.get_or_create("a", factory) is winner
+    assert cache.get("a") is winner
+    assert evicted == [("a", loser)]
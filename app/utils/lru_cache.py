@@ -0,0 +1,168 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+
+class LRUCache:
+    """
+    线程安全的 LRU 缓存，按最大条目数淘汰最久未使用的对象，并淘汰空闲超时的对象
+    """
+
+    def __init__(self, max_size: int = 1024, idle_ttl: Optional[float] = None,
+                 on_evict: Optional[Callable[[Hashable, Any], None]] = None):
+        """
+        :param max_size: 最大条目数
+        :param idle_ttl: 空闲过期时间（秒），None 表示不过期
+        :param on_evict: 对象离开缓存时的回调，参数为 (key, value)，用于释放对象持有的资源
+        """
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.on_evict = on_evict
+        # key -> (value, 最近访问时间)
+        self._data: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        # 超出容量淘汰次数
+        self.evictions = 0
+        # 空闲过期淘汰次数
+        self.expirations = 0
+
+    def _is_expired(self, last_access: float, now: float) -> bool:
+        return self.idle_ttl is not None and now - last_access > self.idle_ttl
+
+    def _expire(self, now: float, removed: List[tuple[Hashable, Any]]):
+        # OrderedDict 按访问时间排序，从头部开始检查即可
+        while self._data:
+            key, (value, last_access) = next(iter(self._data.items()))
+            if not self._is_expired(last_access, now):
+                break
+            self._data.popitem(last=False)
+            removed.append((key, value))
+            self.expirations += 1
+
+    def _notify_evict(self, removed: List[tuple[Hashable, Any]]):
+        # 在锁外执行回调，避免回调耗时阻塞其他线程
+        if self.on_evict is None:
+            return
+        for key, value in removed:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                print(f'Error: lru cache on_evict failed, key: {key}, reason: {e}')
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        now = time.monotonic()
+        removed = []
+        with self._lock:
+            self._expire(now, removed)
+            item = self._data.get(key, None)
+            if item is None:
+                self.misses += 1
+                value = default
+            else:
+                self._data[key] = (item[0], now)
+                self._data.move_to_end(key)
+                self.hits += 1
+                value = item[0]
+        self._notify_evict(removed)
+        return value
+
+    def _insert_locked(self, key: Hashable, value: Any, now: float, removed: List[tuple[Hashable, Any]]):
+        # 写入对象并按容量淘汰，调用方持有 self._lock
+        self._data[key] = (value, now)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            evict_key, (evict_value, _) = self._data.popitem(last=False)
+            removed.append((evict_key, evict_value))
+            self.evictions += 1
+
+    def put(self, key: Hashable, value: Any):
+        now = time.monotonic()
+        removed = []
+        with self._lock:
+            self._expire(now, removed)
+            old_item = self._data.get(key, None)
+            if old_item is not None and old_item[0] is not value:
+                removed.append((key, old_item[0]))
+            self._insert_locked(key, value, now, removed)
+        self._notify_evict(removed)
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """
+        获取缓存对象，不存在时在锁外调用 factory 创建，写入时仍不存在才插入。
+        多个线程同时创建时保留先写入的对象，后创建的对象交给 on_evict 释放，不影响正在使用缓存对象的调用方
+        :param key:
+        :param factory:
+        :return: 缓存中的对象
+        """
+        value = self.get(key, None)
+        if value is not None:
+            return value
+        value = factory()
+        now = time.monotonic()
+        removed = []
+        with self._lock:
+            self._expire(now, removed)
+            item = self._data.get(key, None)
+            if item is None:
+                self._insert_locked(key, value, now, removed)
+            else:
+                removed.append((key, value))
+                value = item[0]
+                self._data[key] = (value, now)
+                self._data.move_to_end(key)
+        self._notify_evict(removed)
+        return value
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """
+        取出对象，不触发 on_evict，由调用方负责释放
+        """
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[0]
+
+    def remove_if(self, predicate: Callable[[Hashable], bool]) -> int:
+        """
+        删除 key 满足条件的所有对象
+        :param predicate:
+        :return: 删除的数量
+        """
+        with self._lock:
+            keys = [key for key in self._data.keys() if predicate(key)]
+            removed = [(key, self._data.pop(key)[0]) for key in keys]
+        self._notify_evict(removed)
+        return len(removed)
+
+    def clear(self):
+        with self._lock:
+            removed = [(key, item[0]) for key, item in self._data.items()]
+            self._data.clear()
+        self._notify_evict(removed)
+
+    def stats(self) -> Dict[str, int]:
+        removed = []
+        with self._lock:
+            self._expire(time.monotonic(), removed)
+            stats = {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+        self._notify_evict(removed)
+        return stats
+
+    def __contains__(self, key: Hashable) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, None)
+            return item is not None and not self._is_expired(item[1], now)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
@@ -0,0 +1,86 @@
+import threading
+from collections import deque
+from typing import Deque, Dict
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self.lock:
+            self.value += amount
+
+    def stats(self) -> int:
+        with self.lock:
+            return self.value
+
+
+class Summary:
+    """
+    观测值统计：总次数、总和、最大值，以及最近 window 个观测值的分位数
+    """
+
+    def __init__(self, window: int = 1024):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent: Deque[float] = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self.lock:
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+            self.recent.append(value)
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            recent = sorted(self.recent)
+            count, total, max_value = self.count, self.total, self.max
+
+        def percentile(p: float) -> float:
+            if not recent:
+                return 0.0
+            return round(recent[min(len(recent) - 1, int(len(recent) * p))], 3)
+
+        return {
+            "count": count,
+            "avg": round(total / count, 3) if count else 0.0,
+            "max": round(max_value, 3),
+            "p50": percentile(0.5),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99),
+        }
+
+
+class MetricsRegistry:
+    """
+    进程内指标，按名称注册计数器和观测值统计
+    """
+
+    def __init__(self):
+        self.counters: Dict[str, Counter] = {}
+        self.summaries: Dict[str, Summary] = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name: str) -> Counter:
+        with self.lock:
+            return self.counters.setdefault(name, Counter())
+
+    def summary(self, name: str) -> Summary:
+        with self.lock:
+            return self.summaries.setdefault(name, Summary())
+
+    def stats(self) -> Dict[str, object]:
+        with self.lock:
+            counters = dict(self.counters)
+            summaries = dict(self.summaries)
+        result = {name: counter.stats() for name, counter in counters.items()}
+        result.update({name: summary.stats() for name, summary in summaries.items()})
+        return result
+
+
+metrics = MetricsRegistry()
@@ -35,6 +35,7 @@ class RetrieverConfig(SQLModel):
     over_lap: int = Field(default=200, description="文本重叠长度")
     split_way: str = Field(default="Recursive", description="文本分段方式")
     top_k: int = Field(default=3, description="检索 top k")
+    context_max_tokens: int = Field(default=3000, description="检索上下文最大token数")
 
 
 class MultiRetrieverConfig(SQLModel):
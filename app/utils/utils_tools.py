@@ -28,3 +28,14 @@ def diff_models(a: BaseModel, b: BaseModel, prefix: str = "") -> Dict[str, Any]:
                 diffs[field_name] = (val_a, val_b)
 
     return diffs
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算文本的 token 数：中日韩字符按 1 个 token，其他字符按 4 个字符 1 个 token
+    :param text:
+    :return:
+    """
+    cjk_count = sum(1 for ch in text if '\u2e80' <= ch <= '\u9fff' or '\uac00' <= ch <= '\ud7af'
+                    or '\uf900' <= ch <= '\ufaff')
+    return cjk_count + (len(text) - cjk_count + 3) // 4